@@ -0,0 +1,279 @@
+# Benchmarks for make_array.py: times the generation of arrays of the example
+# designs (and of synthetic designs with large copy regions) at a range of sizes,
+# and writes the results out as JSON (with -o) so that runs can be compared.
+#
+# To compare the XML backends on the examples, up to 64x64:
+#   python benchmark.py -backends etree lxml -sizes 16 32 64 -synthetic
+#
+# To compare a change against the code before it:
+#   python benchmark.py -o before.json
+#   python benchmark.py -compare before.json
+
+
+import xml.etree.ElementTree as ET
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import make_array
+
+# resource, for the peak memory of each case, is only available on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+parser = argparse.ArgumentParser(description='Benchmark make_array.py across array sizes and templates.')
+parser.add_argument('-o', metavar='out-file', dest='output', default=None,
+                   help='If specified, write the results to this file, as JSON (for -compare, or make_array.py -calibration)')
+parser.add_argument('-designs', metavar='design', dest='designs', nargs='*',
+                   default=['led_example', 'ws2812_example'],
+                   help='Designs to array, without the .sch/.brd extension')
+parser.add_argument('-sizes', metavar='size', dest='sizes', type=int, nargs='*',
+                   default=[4, 8, 16, 32, 64, 128],
+                   help='Array sizes to generate; each size N generates an NxN array')
+parser.add_argument('-synthetic', metavar='wires', dest='synthetic', type=int, nargs='*', default=[1000, 5000],
+                   help='For each number, also benchmark a copy of the first design with this many wires in its board copy region')
+parser.add_argument('-syntheticSizes', metavar='size', dest='syntheticSizes', type=int, nargs='*',
+                   default=[4, 8, 16],
+                   help='Array sizes to generate for the synthetic designs')
+parser.add_argument('-s', '--stream', action='store_true',
+                   help='If specified, benchmark the streaming output mode instead of building the designs in memory')
+parser.add_argument('-t', '--tiled', action='store_true',
+                   help='If specified, benchmark the tiled output mode instead of building the designs in memory')
+parser.add_argument('-l', '--lazy', action='store_true',
+                   help='If specified, parse the designs lazily, passing their untouched sections through (the output is streamed)')
+parser.add_argument('-backends', metavar='backend', dest='backends', nargs='*', default=['etree'],
+                   choices=['etree', 'lxml'],
+                   help='XML backends to benchmark (see make_array.py -xmlBackend); every case is run with each one')
+parser.add_argument('-compare', metavar='previous results', dest='compare', default=None,
+                   help='If specified, compare the wall times against the results of a previous run')
+parser.add_argument('-case', dest='case', default=None,
+                   help=argparse.SUPPRESS)
+
+# Seconds, using the best clock available
+timer = getattr(time, 'perf_counter', time.time)
+
+# Name of the signal that holds the synthetic copy region
+SYNTHETIC_SIGNAL = 'SYNTHETIC'
+
+
+##################################################################################
+######## Synthetic designs
+##################################################################################
+
+def makeSyntheticDesign(baseDesign, wires, directory):
+    """ Make a copy of a design with a large copy region, to stress createBoardCopySignals
+
+    A new signal with the given number of wires (and a via for every tenth
+    wire) is added to the board, all inside the default copy region. The
+    wires are placed pseudo-randomly, but the same for every run. Returns
+    the name of the new design.
+
+    """
+    designName = os.path.join(directory, "%s_copy%i"%(os.path.basename(baseDesign), wires))
+    shutil.copy(baseDesign + ".sch", designName + ".sch")
+
+    Board = ET.parse(baseDesign + ".brd")
+    signals = Board.getroot().find("drawing").find("board").find("signals")
+
+    # Keep a margin inside the copy region, so that the wires are fully contained
+    defaults = make_array.parser.parse_args([baseDesign])
+    xMin, xMax = defaults.boardCopyXMin + 1, defaults.boardCopyXMax - 1
+    yMin, yMax = defaults.boardCopyYMin + 1, defaults.boardCopyYMax - 1
+
+    generator = random.Random(wires)
+    signal = ET.SubElement(signals, "signal")
+    signal.set('name', SYNTHETIC_SIGNAL)
+    for index in range(wires):
+        wire = ET.SubElement(signal, "wire")
+        wire.set('x1', '%.4f'%(generator.uniform(xMin, xMax)))
+        wire.set('y1', '%.4f'%(generator.uniform(yMin, yMax)))
+        wire.set('x2', '%.4f'%(generator.uniform(xMin, xMax)))
+        wire.set('y2', '%.4f'%(generator.uniform(yMin, yMax)))
+        wire.set('width', '0.254')
+        wire.set('layer', '1')
+        if index%10 == 0:
+            via = ET.SubElement(signal, "via")
+            via.set('x', wire.get('x2'))
+            via.set('y', wire.get('y2'))
+            via.set('extent', '1-16')
+            via.set('drill', '0.3')
+
+    Board.write(designName + ".brd", encoding="utf-8", xml_declaration=True)
+    return designName
+
+
+##################################################################################
+######## Running a case
+##################################################################################
+
+def runCase(case):
+    """ Generate one array, timing each phase
+
+    This runs in its own process (see measureCase), so that the peak memory
+    is for this case alone.
+
+    """
+    options = [case['design'], '-r', str(case['size']), '-c', str(case['size'])]
+    if case['zigzag']:
+        options.append('-z')
+    if case['stream']:
+        options.append('-s')
+    if case['tiled']:
+        options.append('--tiled')
+    if case['lazy']:
+        options.append('--lazy')
+    options += ['-xmlBackend', case['backend']]
+    make_array.args = make_array.parser.parse_args(options)
+
+    outputName = os.path.join(case['directory'], 'output')
+    phases = collections.OrderedDict()
+    start = timer()
+
+    phaseStart = timer()
+    make_array.loadDesign(case['design'])
+    phases['inspection'] = timer() - phaseStart
+
+    # writeSchematic and writeBoard, split into phases (streamed output is created
+    # as it's written)
+    phaseStart = timer()
+    make_array.configureArray()
+    make_array.buildSchematic()
+    make_array.buildBoard()
+    phases['creation'] = timer() - phaseStart
+
+    phaseStart = timer()
+    make_array.saveBoard(outputName + ".brd")
+    make_array.saveSchematic(outputName + ".sch")
+    phases['write'] = timer() - phaseStart
+
+    wallTime = timer() - start
+
+    result = collections.OrderedDict()
+    result['design'] = os.path.basename(case['design'])
+    result['rows'] = case['size']
+    result['cols'] = case['size']
+    result['zigzag'] = case['zigzag']
+    result['backend'] = make_array.xmlBackend
+    result['wallTime'] = wallTime
+    result['peakMemoryKB'] = peakMemoryKB()
+    result['inputSize'] = os.path.getsize(case['design'] + ".sch") + os.path.getsize(case['design'] + ".brd")
+    result['boardSize'] = os.path.getsize(outputName + ".brd")
+    result['schematicSize'] = os.path.getsize(outputName + ".sch")
+    result['phases'] = phases
+
+    os.remove(outputName + ".brd")
+    os.remove(outputName + ".sch")
+    return result
+
+def peakMemoryKB():
+    """ Get the peak memory of this process in KB, or None if it can't be measured here """
+    if resource == None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS gives it in bytes, rather than KB
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+def measureCase(case):
+    """ Run a case in a new Python process, and return its results """
+    command = [sys.executable, os.path.abspath(__file__), '-case', json.dumps(case)]
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8'), object_pairs_hook=collections.OrderedDict)
+
+
+##################################################################################
+######## Results
+##################################################################################
+
+def caseKey(result):
+    """ Identify a result, for matching it up with the same case in another run """
+    # Results from before there was a choice of backend used ElementTree
+    return (result['design'], result['rows'], result['cols'], result['zigzag'],
+        result.get('backend', 'etree'))
+
+def compareBackends(results):
+    """ Print the wall time of each case with each backend, relative to the first backend """
+    cases = collections.OrderedDict()
+    for result in results:
+        cases.setdefault(caseKey(result)[:-1], []).append(result)
+
+    for (design, rows, cols, zigzag), byBackend in cases.items():
+        first = byBackend[0]
+        print("%-28s %4ix%-4i %-6s "%(design, rows, cols, 'zigzag' if zigzag else '') + "  ".join(
+            "%s %8.3fs (%.2fx)"%(result['backend'], result['wallTime'], first['wallTime']/result['wallTime'])
+            for result in byBackend))
+
+def compareResults(results, previousResults):
+    """ Print the change in wall time of each case since a previous run """
+    previous = dict((caseKey(result), result) for result in previousResults)
+    for result in results:
+        before = previous.get(caseKey(result))
+        if before == None:
+            continue
+        print("%-28s %4ix%-4i %-6s %-5s %8.3fs -> %8.3fs (%+.0f%%)"%(result['design'], result['rows'],
+            result['cols'], 'zigzag' if result['zigzag'] else '', result['backend'], before['wallTime'],
+            result['wallTime'], 100.0*(result['wallTime']/before['wallTime'] - 1)))
+
+def main():
+    """ Run the benchmarks given on the command line """
+    args = parser.parse_args()
+
+    if args.case != None:
+        sys.stdout.write(json.dumps(runCase(json.loads(args.case))))
+        return
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    directory = tempfile.mkdtemp(prefix='make_array_benchmark_')
+    try:
+        designs = [(os.path.join(here, design), args.sizes) for design in args.designs]
+        for wires in args.synthetic:
+            designs.append((makeSyntheticDesign(designs[0][0], wires, directory), args.syntheticSizes))
+
+        results = []
+        for design, sizes in designs:
+            for size in sizes:
+                for zigzag in [False, True]:
+                    for backend in args.backends:
+                        result = measureCase({'design': design, 'size': size, 'zigzag': zigzag,
+                            'stream': args.stream, 'tiled': args.tiled,
+                            'lazy': args.lazy, 'backend': backend, 'directory': directory})
+                        print("%-28s %4ix%-4i %-6s %-5s %8.3fs %10s"%(result['design'], result['rows'],
+                            result['cols'], 'zigzag' if zigzag else '', result['backend'],
+                            result['wallTime'], '-' if result['peakMemoryKB'] == None
+                                else '%iKB'%(result['peakMemoryKB'])))
+                        results.append(result)
+    finally:
+        shutil.rmtree(directory)
+
+    report = collections.OrderedDict()
+    report['python'] = sys.version.split()[0]
+    report['numpy'] = make_array.numpy != None
+    report['mode'] = 'tiled' if args.tiled else 'stream' if args.stream else 'tree'
+    report['lazy'] = args.lazy
+    report['backends'] = sorted(set(result['backend'] for result in results))
+    report['results'] = results
+    if args.output != None:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if len(args.backends) > 1:
+        print("")
+        compareBackends(results)
+
+    if args.compare != None:
+        with open(args.compare) as previous:
+            compareResults(results, json.load(previous)['results'])
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,52 @@
 
 
 import xml.etree.ElementTree as ET
+import collections
 import copy
 import argparse
+import array
+import codecs
+import contextlib
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
 import math
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+
+# NumPy is optional; it is only used to speed up board placement.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# lxml is optional; it is used as the XML backend where it's installed.
+try:
+    from lxml import etree as lxmlEtree
+except ImportError:
+    lxmlEtree = None
+
+# zstandard is optional; it is only needed for reading and writing .zst files.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# tracemalloc is used for the memory figures in profiles, where it can measure the
+# peak of each phase (Python 3.9 and later).
+try:
+    import tracemalloc
+    if not hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc = None
+except ImportError:
+    tracemalloc = None
 
 parser = argparse.ArgumentParser(description='Create a array of parts for Eagle PCB. Tested with Eagle 6.5.0.')
 parser.add_argument('filepath', metavar='in-file',
@@ -16,6 +59,12 @@ parser.add_argument('-c', metavar='cols', dest='cols', type=int, default=4,
                    help='Number of columns in the array')
 parser.add_argument('-z', '--zigzag', action='store_true',
                    help='If specificed, connect the array elements in a zigzag pattern')
+parser.add_argument('-layout', dest='layout', choices=['grid', 'hex', 'circle', 'spiral'], default='grid',
+                   help='How to lay the parts out on the PCB: in a grid, a hexagonal grid (every other row moved along by half a column), with each row as a ring of a circle, or along a spiral (spacingX apart, with its turns spacingY apart)')
+parser.add_argument('-placements', metavar='file', dest='placements', default=None,
+                   help='If specified, place the parts on the PCB at the positions in this CSV file instead, one line of x, y and (optionally) rotation for each part')
+parser.add_argument('-chainOrder', dest='chainOrder', choices=['layout', 'hilbert', 'morton', 'nearest'], default='layout',
+                   help='Order in which to connect the parts in the serial chain (nIN_/nOUT_): in layout order, along a Hilbert or Morton curve, or from each part to the nearest unconnected one (then shortened with 2-opt); the parts are numbered in chain order, so designs with row or column nets must use the layout order')
 parser.add_argument('-spacingX', metavar='X spacing', dest='spacingX', type=int, default=10,
                    help='Amount of space between rows of parts on the PCB, in the default board units')
 parser.add_argument('-spacingY', metavar='Y spacing', dest='spacingY', type=int, default=-10,
@@ -32,654 +81,4516 @@ parser.add_argument('-boardCopyXMax', metavar='X copy extent maximum', dest='boa
                    help='X maximum extent of board copy region')
 parser.add_argument('-boardCopyYMax', metavar='Y copy extent maximum', dest='boardCopyYMax', type=int, default=10,
                    help='Y maximum extent of board copy region')
+parser.add_argument('-s', '--stream', action='store_true',
+                   help='If specified, stream the arrayed parts, nets and signals straight into the output files instead of building the arrayed designs in memory')
+parser.add_argument('-t', '--tiled', action='store_true',
+                   help='If specified, stream the output (as for --stream) from tiles: each kind of arrayed part, instance, element, net segment and signal item is built once, and written out for every position by filling in its position number, coordinates and rotation. This gives the same output, much faster for large arrays')
+parser.add_argument('-l', '--lazy', action='store_true',
+                   help='If specified, leave the sections of the designs that are never changed (libraries, settings, layers, design rules, autorouter and plain) unparsed, and copy them straight from the input files into the output files, which are streamed (as for --stream)')
+parser.add_argument('-xmlBackend', dest='xmlBackend', choices=['etree', 'lxml'], default='etree',
+                   help='XML library to parse and write the designs with: ElementTree (the default), or lxml, which keeps the DOCTYPE but takes more than twice the memory')
+parser.add_argument('-compress', dest='compress', choices=['gz', 'zst'], default=None,
+                   help='If specified, compress the output files with gzip or zstd (.brd.gz/.sch.gz or .brd.zst/.sch.zst). Compressed designs are read automatically')
+# The modes that do something other than generate the array; only one can be given
+modes = parser.add_mutually_exclusive_group()
+modes.add_argument('--script', action='store_true',
+                   help='If specified, write an Eagle script (in-file_array.scr) that builds the array when run on the original design, instead of writing a new board and schematic')
+parser.add_argument('-sheetPositions', metavar='positions per sheet', dest='sheetPositions', type=int, default=0,
+                   help='If specified, split the arrayed schematic across new sheets, with this many positions on each sheet')
+parser.add_argument('-j', '--jobs', metavar='jobs', dest='jobs', type=int, default=1,
+                   help='Number of worker processes to use. The board and schematic are generated in separate processes, and large arrays are split into chunks of positions that are generated in parallel')
+parser.add_argument('-chunkPositions', metavar='positions per chunk', dest='chunkPositions', type=int, default=0,
+                   help='If specified, the number of positions in each chunk generated by a worker process. By default, large arrays are split evenly between the workers')
+parser.add_argument('--profile', action='store_true',
+                   help='If specified, print the time and peak memory of each phase and creation function, and counts of the copies made and nets and signals created. Profiling runs everything in a single process')
+parser.add_argument('-profileFile', metavar='json file', dest='profileFile', default=None,
+                   help='If specified, profile the run as for --profile, and write the profile to this file as JSON')
+modes.add_argument('-resize', metavar=('previous output', 'rows', 'cols'), dest='resize', nargs=3, default=None,
+                   help='If specified, resize an earlier output of this design (eg: led_example_array), which has the given number of rows and columns, instead of generating the array from scratch. Only the positions that are added are generated, and changes made to the earlier output by hand are kept')
+modes.add_argument('-batch', metavar='configuration file', dest='batch', default=None,
+                   help='If specified, generate an array for each line of this file, reusing the parsed design. Each line holds the array options for one configuration (eg: -r 8 -c 8 -z), and the outputs are named after the configuration')
+parser.add_argument('-cache', metavar='directory', dest='cache', default=None,
+                   help='If specified, keep the generated array in this cache directory, and copy it from there (without parsing the design) when the same design is arrayed with the same options again')
+parser.add_argument('-cacheSize', metavar='megabytes', dest='cacheSize', type=int, default=1024,
+                   help='The most space the cache may take; the least recently used arrays are removed to keep it under this')
+parser.add_argument('-pnp', metavar='file', dest='pnp', default=None,
+                   help='If specified, also write the pick and place data (the name, value, package, position, rotation and side of every element on the arrayed board) to this file, as CSV, or as JSON if it ends in .json')
+parser.add_argument('-bom', metavar='file', dest='bom', default=None,
+                   help='If specified, also write a bill of materials for the arrayed board (the elements grouped by value, package and library) to this file, as CSV or JSON')
+parser.add_argument('-netlist', metavar='file', dest='netlist', default=None,
+                   help='If specified, also write the netlist of the arrayed board (the signal, element and pad of every connection) to this file, as CSV or JSON')
 
-args = parser.parse_args()
+modes.add_argument('--dry-run', action='store_true', dest='dryRun',
+                   help='If specified, only inspect the design, and print the template counts, the predicted size of the output, and the estimated time and peak memory of generating it in each output mode')
+parser.add_argument('-calibration', metavar='benchmark results', dest='calibration', default=None,
+                   help='If specified, estimate the time and peak memory of the output mode that benchmark.py measured in these results from them, instead of from the built-in calibration')
+parser.add_argument('-maxMemory', metavar='megabytes', dest='maxMemory', type=float, default=None,
+                   help='If specified, generate the array in an output mode that is estimated to need no more than this much memory, or refuse to generate it')
+parser.add_argument('-maxTime', metavar='seconds', dest='maxTime', type=float, default=None,
+                   help='If specified, generate the array in an output mode that is estimated to take no longer than this, or refuse to generate it')
 
+parser.add_argument('--check', action='store_true',
+                   help='If specified, check the output files for any reference to an arrayed (template) part or element that survived, and fail if one did')
 
-designName = args.filepath
-boardName = designName + ".brd"
-outputBoardName = designName + "_array" + ".brd"
-schematicName = designName + ".sch"
-outputSchematicName = designName + "_array" + ".sch"
+modes.add_argument('-w', '--watch', action='store_true',
+                   help='If specified, keep running after generating the array, and regenerate it each time the design\'s schematic or board is saved, re-parsing only the file that changed. The output is streamed (as for --stream). Stop with Ctrl-C')
+parser.add_argument('--verify', action='store_true',
+                   help='If specified, verify the connectivity of the output files after writing them: the chains, rows and columns, the nets every position joins, and that the schematic and board agree')
+modes.add_argument('-verifyOutput', metavar='previous output', dest='verifyOutput', default=None,
+                   help='If specified, verify the connectivity of an earlier output of this design (eg: led_example_array), generated with the same array options, instead of generating the array')
+
+# The options are parsed in main() when run as a script, or set up by an
+# ArrayGenerator when used as a library.
+args = None
 
 
 ##################################################################################
-######## Schematic inspection phase
+######## Profiling
 ##################################################################################
 
-Schematic= ET.parse(schematicName)
-schematicDrawing = Schematic.getroot().find("drawing").find("schematic")
-
-
-# Remove any part whose name ends in _, and store them for later duplication
-schematicParts = schematicDrawing.find("parts")
-schematicMatrixParts = ET.Element("parts")
-for part in reversed(schematicParts):
-    if part.get('name').endswith("_"):
-        schematicParts.remove(part)
-        schematicMatrixParts.append(part)
-
-# Remove any instance whose name ends in _, and store them for later duplication
-# Note that we are only considering things on the first schematic sheet!
-schematicInstances = schematicDrawing.find(".//instances")
-schematicMatrixInstances = ET.Element("instance")
-for instance in reversed(schematicInstances):
-    if instance.get('part').endswith("_"):
-        schematicInstances.remove(instance)
-        schematicMatrixInstances.append(instance)
-
-# Remove any net whose name ends in IN_ or OUT_, and store them for later duplication
-# Note that we are only considering things on the first schematic sheet!
-schematicNets = schematicDrawing.find(".//nets")
-schematicInputNets = ET.Element("nets")    # Serial nets (input to each position)
-schematicOutputNets = ET.Element("nets")   # Serial nets (output from each position)
-schematicRowNets = ET.Element("nets")      # Row-column matrix nets, row side
-schematicColNets = ET.Element("nets")      # Row-column matrix nets, column side
-for net in reversed(schematicNets):
-    if net.get('name').endswith("IN_"):
-        schematicNets.remove(net)
-        schematicInputNets.append(net)
-    elif net.get('name').endswith("OUT_"):
-        schematicNets.remove(net)
-        schematicOutputNets.append(net)
-    if net.get('name').endswith("ROW_"):
-        schematicNets.remove(net)
-        schematicRowNets.append(net)
-    if net.get('name').endswith("COL_"):
-        schematicNets.remove(net)
-        schematicColNets.append(net)
+# When profiling, each phase (the sections of this file: inspection, creation and
+# write out) and each call to a creation function is timed, along with
+# the peak memory allocated while it ran and the change in the process's resident
+# memory. When the output is streamed, the creation functions aren't called, and
+# the streaming generators that replace them are timed instead: only the time
+# spent making their items, and not the time spent writing the items out. Counters record the copies made and the nets and signals created or
+# merged, so that the template features responsible for a slow run can be found.
+# The profile is collected in a single process.
+#
+# The peak comes from tracemalloc, which only sees memory that Python allocates.
+# lxml builds its trees in C, so with lxml only the resident memory is reported.
+#
+# From the command line, use --profile or -profileFile. From another script, call
+# startProfile() before generating, and stopProfile() to get the results.
 
+# The profile being collected, or None when not profiling
+profile = None
 
-##################################################################################
-######## Board inspection phase
-##################################################################################
+# Counters, in the order they are reported
+PROFILE_COUNTERS = ['deepcopies', 'elements created', 'nets created', 'nets merged',
+    'signals created', 'signals merged', 'tiled copies', 'cache hits']
+
+# Memory at the start of each profiled block that is running, and the peak since
+profileFrames = []
+
+# Names of the generators that are profiled (see profiledGenerator)
+profiledGenerators = set()
+
+# Seconds, using the best clock available
+timer = getattr(time, 'perf_counter', time.time)
+
+def startProfile():
+    """ Start collecting a profile
+
+    Returns the profile, a dictionary with 'phases' and 'functions' entries
+    that give the calls, time (in seconds), peak memory and resident memory
+    change (in bytes, or None if they can't be measured) by name, and a
+    'counters' entry.
+
+    """
+    global profile
+
+    profile = collections.OrderedDict([
+        ('phases', collections.OrderedDict()),
+        ('functions', collections.OrderedDict()),
+        ('counters', collections.OrderedDict((name, 0) for name in PROFILE_COUNTERS)),
+    ])
+    if tracemalloc != None:
+        tracemalloc.start()
+
+    return profile
+
+def stopProfile():
+    """ Stop collecting the profile, and return it """
+    global profile
+
+    finished = profile
+    profile = None
+    if tracemalloc != None and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    return finished
+
+def residentMemory():
+    """ Get the resident memory of this process in bytes, or None if it can't be read (it's read from /proc, on Linux) """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+def profileCount(name, count=1):
+    """ Add to a counter, if profiling """
+    if profile != None:
+        profile['counters'][name] += count
+
+@contextlib.contextmanager
+def profiling(section, name):
+    """ Time a block of code as an entry in a section of the profile, along with its peak memory """
+    if profile == None:
+        yield
+        return
+
+    # Peaks are measured relative to the start of the block. Since there is only
+    # one peak to reset, the blocks that this one runs inside of keep their own.
+    tracing = tracemalloc != None and tracemalloc.is_tracing() and ET is not lxmlEtree
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        for frame in profileFrames:
+            frame[1] = max(frame[1], peak)
+        profileFrames.append([current, current])
+        tracemalloc.reset_peak()
+
+    resident = residentMemory()
+    start = timer()
+    try:
+        yield
+    finally:
+        entry = profileEntry(section, name)
+        entry['calls'] += 1
+        entry['time'] += timer() - start
+
+        if resident != None:
+            entry['residentChange'] = (entry['residentChange'] or 0) + residentMemory() - resident
+
+        if tracing:
+            peak = tracemalloc.get_traced_memory()[1]
+            for frame in profileFrames:
+                frame[1] = max(frame[1], peak)
+            startMemory, peakMemory = profileFrames.pop()
+            entry['peakMemory'] = max(entry['peakMemory'] or 0, peakMemory - startMemory)
+
+def profileEntry(section, name):
+    """ Get the entry for a name in a section of the profile, adding it if it's new """
+    return profile[section].setdefault(name, collections.OrderedDict([
+        ('calls', 0), ('time', 0.0), ('peakMemory', None), ('residentChange', None)]))
+
+def profiledFunction(function):
+    """ Decorate a function, so that its calls are profiled """
+    @functools.wraps(function)
+    def profiled(*arguments):
+        if profile == None:
+            return function(*arguments)
+        with profiling('functions', function.__name__):
+            return function(*arguments)
+
+    return profiled
+
+def profiledGenerator(function):
+    """ Decorate a generator function, so that the time spent making its items is profiled
+
+    Each generator counts as a call. Its memory isn't measured, since the
+    items it makes are written out and freed as it goes.
+
+    """
+    profiledGenerators.add(function.__name__)
+
+    @functools.wraps(function)
+    def profiled(*arguments):
+        items = function(*arguments)
+        if profile == None:
+            return items
+        return profiledItems(profileEntry('functions', function.__name__), items)
+
+    return profiled
+
+def profiledItems(entry, items):
+    """ Pass on the items of a generator, adding the time spent making each one to a profile entry """
+    entry['calls'] += 1
+    while True:
+        start = timer()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        finally:
+            entry['time'] += timer() - start
+        yield item
+
+def formatProfile(report):
+    """ Format a profile as a table """
+    lines = []
+    for section in ['phases', 'functions']:
+        lines.append('%-36s %8s %10s %12s %12s'%(section.capitalize(), 'Calls', 'Time (s)', 'Peak (KB)',
+            'RSS +/- (KB)'))
+        for name, entry in report[section].items():
+            peak = '-' if entry['peakMemory'] == None else '%i'%(entry['peakMemory']//1024)
+            resident = '-' if entry['residentChange'] == None else '%+i'%(entry['residentChange']//1024)
+            lines.append('  %-34s %8i %10.4f %12s %12s'%(name, entry['calls'], entry['time'], peak,
+                resident))
+        if section == 'functions' and any(name in profiledGenerators for name in report[section]):
+            lines.append('  (The output was streamed, so the streaming generators are listed in place of')
+            lines.append('  the creation functions, with the time spent making their items)')
+        lines.append('')
+
+    lines.append('Counters')
+    for name, count in report['counters'].items():
+        lines.append('  %-34s %8i'%(name, count))
+
+    return '\n'.join(lines)
+
+def copyElement(element):
+    """ Deep copy an element, counting the copy when profiling """
+    # lxml's shallow copy copies the whole element, without deepcopy's bookkeeping
+    newElement = copy.copy(element) if ET is lxmlEtree else copy.deepcopy(element)
+    if profile != None:
+        profileCount('deepcopies')
+        profileCount('elements created', sum(1 for item in newElement.iter()))
+
+    return newElement
 
-Board = ET.parse(boardName)
-BoardDrawing = Board.getroot().find("drawing").find("board")
-
-# Remove any element whose name ends in _, and store them for later duplication 
-boardElements = BoardDrawing.find("elements")
-boardMatrixElements = ET.Element("elements")
-for element in reversed(boardElements):
-    if element.get('name').endswith("_"):
-        boardElements.remove(element)
-        boardMatrixElements.append(element)
-
-
-# Remove any signal whose name ends in IN_ or OUT_, and store them for later duplication
-boardSignals = BoardDrawing.find("signals")
-boardInputSignals = ET.Element("signals")   # Serial signals (input to each position)
-boardOutputSignals = ET.Element("signals")  # Serial signals (output from each position)
-boardRowSignals = ET.Element("signals")     # Row-column matrix signals, row side
-boardColSignals = ET.Element("signals")     # Row-column matrix signals, column side
-for signal in reversed(boardSignals):
-    if signal.get('name').endswith("IN_"):
-        boardSignals.remove(signal)
-        boardInputSignals.append(signal)
-    if signal.get('name').endswith("OUT_"):
-        boardSignals.remove(signal)
-        boardOutputSignals.append(signal)
-    if signal.get('name').endswith("ROW_"):
-        boardSignals.remove(signal)
-        boardRowSignals.append(signal)
-    if signal.get('name').endswith("COL_"):
-        boardSignals.remove(signal)
-        boardColSignals.append(signal)
-
-# Remove any vias or wires that land in the copy region, and store them for later
-# duplication
-# This is sucky because they are inside signals...
-boardCopySignals = ET.Element("signals")
-for signal in boardSignals:
-    newSignal = ET.Element("signal")
-    newSignal.set('name', signal.get('name'))
-    for wire in signal.iter('wire'):
-        # Get the wire coordinates, oriented correctly
-        x1, x2 = sorted([float(wire.get('x1')), float(wire.get('x2'))])
-        y1, y2 = sorted([float(wire.get('y1')), float(wire.get('y2'))])
-        if x1 > args.boardCopyXMin and x2 < args.boardCopyXMax and y1 > args.boardCopyYMin and y2 < args.boardCopyYMax:
-            newSignal.append(wire)
-            # TODO: Delete the original
-
-    for via in signal.iter('via'):
-        # Get the wire coordinates, oriented correctly
-        x = float(via.get('x'))
-        y = float(via.get('y'))
-        if x > args.boardCopyXMin and x < args.boardCopyXMax and y > args.boardCopyYMin and y < args.boardCopyYMax:
-            newSignal.append(via)
-            # TODO: Delete the original
-
-    if sum(1 for i in newSignal.iter()) > 1:
-        boardCopySignals.append(newSignal)
 
 ##################################################################################
-######## Schematic creation functions
+######## XML backends and compressed files
 ##################################################################################
 
-def createSchematicParts(position):
-    """ Create all the Schematic parts needed for this position
-    
-    For each of the elements that were in the original board file,
-    create a copy of the element at the new location
+# The designs are parsed, copied and written with ElementTree, or with lxml if
+# -xmlBackend asks for it. lxml serializes small documents faster, but its trees
+# take more than twice the memory, and it's slower to copy large copy regions.
+# Everything uses the API that the two share, through the module global ET, which
+# is switched to the backend in use when a design is loaded. The arrays are the
+# same either way, though lxml keeps the DOCTYPE, writes 'UTF-8' in the XML
+# declaration and writes empty elements as <tag/> rather than <tag />.
+#
+# Unlike ElementTree, lxml moves an element when it's added to a new parent, so
+# elements from the design are never added to anything else, and children are
+# listed before being moved out of an element.
+XML_BACKENDS = collections.OrderedDict([
+    ('lxml', lxmlEtree),
+    # ET is ElementTree until a design is loaded
+    ('etree', ET),
+])
+
+# Name of the backend in use
+xmlBackend = 'etree'
+
+def setXmlBackend(name):
+    """ Switch to an XML backend by name """
+    global ET, xmlBackend
+
+    if XML_BACKENDS[name] == None:
+        raise SystemExit("The %s XML backend isn't installed"%(name))
+
+    ET = XML_BACKENDS[name]
+    xmlBackend = name
+
+def xmlParser():
+    """ Make a parser for the backend in use, or return None for its default
+
+    lxml's keeps comments and processing instructions, which ElementTree's drops.
 
     """
-    for part in schematicMatrixParts:
-        # Create a copy of them
-        newPart = copy.deepcopy(part)
+    if ET is lxmlEtree:
+        return ET.XMLParser(remove_comments=True, remove_pis=True)
+    return None
 
-        # Adjust the name
-    	newPart.set('name', newPart.get('name') + "%i"%(position))
+# The designs can also be read and written compressed, as name.brd.gz or (with the
+# zstandard module) name.brd.zst, and the same for the schematic. A document is
+# read from whichever of its files exists, and written compressed with -compress.
+COMPRESSION_SUFFIXES = ['', '.gz', '.zst']
 
-        schematicParts.append(newPart)
+# Compression levels, trading a little size for speed
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
 
-def createSchematicInstances(position):
-    """ Create all of the schematic instances needed for this position
+def designFile(name, extension):
+    """ Find the file holding a document (eg: name.brd, or name.brd.gz), or return the uncompressed name if there is none
 
-    For each of the elements that were in the original board file,
-    create a copy of the element at the new location
+    If there are several, the newest is used.
 
     """
-    for sourceInstance in schematicMatrixInstances:
-        # Create a copy of them
-        newInstance = copy.deepcopy(sourceInstance)
+    candidates = [name + extension + suffix for suffix in COMPRESSION_SUFFIXES
+        if os.path.exists(name + extension + suffix)]
+    if len(candidates) == 0:
+        return name + extension
+    return max(candidates, key=os.path.getmtime)
 
-        # Adjust the name
-        newInstance.set('part', sourceInstance.get('part') + "%i"%(position))
+def outputFile(name, extension):
+    """ Name the file to write a document to, compressed as given by -compress """
+    if args.compress != None:
+        return name + extension + '.' + args.compress
+    return name + extension
 
-        # Adjust the x and y position
-        translateSchematicElement(newInstance, position)
+def openDesignFile(filename, mode='rb'):
+    """ Open a document for reading ('rb') or writing ('wb', or 'w' for text), compressed according to its name """
+    binaryMode = mode[0] + 'b'
+    if filename.endswith('.gz'):
+        stream = gzip.open(filename, binaryMode, GZIP_LEVEL)
+    elif filename.endswith('.zst'):
+        if zstandard == None:
+            raise SystemExit("%s is compressed with zstd, which needs the zstandard module"%(filename))
+        if mode[0] == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(io.open(filename, 'rb'))
+        else:
+            stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(io.open(filename, 'wb'))
+    else:
+        stream = io.open(filename, binaryMode)
 
-        schematicInstances.append(newInstance)
+    if mode == 'w':
+        return io.TextIOWrapper(stream, encoding='utf-8', errors='xmlcharrefreplace')
+    return stream
 
+def documentSize(filename):
+    """ Get the size of a document in bytes, once decompressed """
+    if not filename.endswith(tuple(suffix for suffix in COMPRESSION_SUFFIXES if suffix != '')):
+        return os.path.getsize(filename)
 
-def translateSchematicElement(element, position):
-    """ Translate a schematic element to a new location
+    size = 0
+    with openDesignFile(filename) as source:
+        for piece in iter(lambda: source.read(1 << 16), b''):
+            size += len(piece)
+    return size
 
-    Translate a schematic element to a new location, based on it's position number
+def parseXml(filename):
+    """ Parse a (possibly compressed) document with the backend in use """
+    with openDesignFile(filename) as source:
+        return ET.parse(source, xmlParser())
 
-    """
-    xOffset = ((position-1)%args.cols)*args.schematicSpacingX
-    yOffset = ((position-1)/args.cols)*args.schematicSpacingY
+def iterparseXml(filename):
+    """ Iterate over the elements of a (possibly compressed) document as they finish parsing """
+    with openDesignFile(filename) as source:
+        for event, element in ET.iterparse(source):
+            yield element
 
-    if(element.get('x') != None):
-        element.set('x', str(float(element.get('x')) + xOffset))
-    if(element.get('y') != None):
-        element.set('y', str(float(element.get('y')) + yOffset))
+def writeXml(tree, filename):
+    """ Write a document (possibly compressed) with the backend in use """
+    with openDesignFile(filename, 'wb') as output:
+        tree.write(output, encoding="utf-8", xml_declaration=True)
 
-    if(element.get('x1') != None):
-        element.set('x1', str(float(element.get('x1')) + xOffset))
-    if(element.get('y1') != None):
-        element.set('y1', str(float(element.get('y1')) + yOffset))
+def xmlHeader(tree):
+    """ Get the XML declaration (and DOCTYPE, which lxml keeps) that writeXml starts a document with """
+    if ET is lxmlEtree:
+        doctype = tree.docinfo.doctype
+        return u"<?xml version='1.0' encoding='UTF-8'?>\n" + (doctype + u"\n" if doctype else u"")
+    return u"<?xml version='1.0' encoding='utf-8'?>\n"
 
-    if(element.get('x2') != None):
-        element.set('x2', str(float(element.get('x2')) + xOffset))
-    if(element.get('y2') != None):
-        element.set('y2', str(float(element.get('y2')) + yOffset))
 
-def updateSchematicNets(position):
-    """ Update non-array nets
+##################################################################################
+######## Lazy parsing
+##################################################################################
 
-    For each non-array net that has a segment with a arrayed position,
-    create a new copy of that segment and append it to the net.
+# With --lazy, the sections of the designs that are never read or changed are not
+# parsed. Each one is found in the raw file and replaced by a placeholder element
+# before the rest is parsed, and when the output is streamed, the placeholder is
+# written by copying the section's bytes (up to the next tag) straight from the
+# input file. This saves building the elements of large library sections, at the
+# cost of the copied sections keeping the input's formatting rather than
+# ElementTree's.
+
+# The sections that are passed through, by tag
+LAZY_SECTIONS = ['libraries', 'settings', 'layers', 'designrules', 'autorouter', 'plain']
+
+PASS_THROUGH_TAG = 'make-array-pass-through'
+
+LAZY_SECTION_PATTERN = re.compile(br'<(' + br'|'.join(tag.encode('ascii') for tag in LAZY_SECTIONS)
+    + br')\b[^>]*>')
+
+# Bytes read from a design at a time while it's scanned for the lazy sections
+LAZY_READ_SIZE = 1 << 16
+
+def parseDesign(filename):
+    """ Parse a schematic or board, leaving the lazy sections unparsed if --lazy was given
+
+    The file is read a piece at a time, and only what lies outside the lazy
+    sections is fed to the parser, so the sections are never held in memory.
+    Each placeholder records the file and the byte range that it stands for.
 
     """
-    for net in schematicNets:
-        for segment in net.iter('segment'):
-            shouldCopy = False
-            for pinref in segment.iter('pinref'):
-                if pinref.get('part').endswith('_'):
-                     shouldCopy = True
-            if shouldCopy:
-                newSegment = copy.deepcopy(segment)
-                for pinref in newSegment.iter('pinref'):
-                    if pinref.get('part').endswith('_'):
-                        pinref.set('part', pinref.get('part') + "%i"%(position))
-                for item in newSegment.iter():
-                    translateSchematicElement(item, position)
-                 
-                net.append(newSegment)
+    if not args.lazy:
+        return parseXml(filename)
 
+    parser = xmlParser() or ET.XMLParser()
+    with openDesignFile(filename) as source:
+        for piece in lazyPieces(source, os.path.abspath(filename)):
+            parser.feed(piece)
+    return ET.ElementTree(parser.close())
+
+def lazyPieces(source, filename):
+    """ Generate the bytes of a design, with each lazy section (and the text after it) replaced by a placeholder
+
+    The source is read LAZY_READ_SIZE bytes at a time, and a section's bytes
+    are dropped as it's scanned for its end, keeping only enough to find a
+    closing tag that is split between reads.
 
-def createSchematicInterconnectNets(position):
-    """ Create input, output, and interconnect nets for the new part
     """
+    data = b''
+    offset = 0          # Position of data in the file
+    state = 'scan'      # Looking for a section ('scan'), for its end ('close'), or for the next tag ('tail')
+    finished = False
+    while True:
+        if state == 'scan':
+            match = LAZY_SECTION_PATTERN.search(data)
+            if match != None:
+                yield data[:match.start()]
+                start = offset + match.start()
+                if match.group(0).endswith(b'/>'):
+                    state = 'tail'
+                else:
+                    state = 'close'
+                    closing = b'</' + match.group(1) + b'>'
+                offset += match.end()
+                data = data[match.end():]
+                continue
 
-    # For the first position, the arrayed nets (nIN_) are replaced with inputs to the array
-    if position == 1:
-        for net in schematicInputNets:
-            newNet = copy.deepcopy(net)
-            newNet.set('name', net.get('name')[:-1])
-            for pinref in newNet.iter('pinref'):
-                if pinref.get('part').endswith('_'):
-                    pinref.set('part', pinref.get('part') + "%i"%(position))
-            for wire in newNet.iter('wire'):
-                wire = translateSchematicElement(wire, position)
-            for label in newNet.iter('label'):
-                label = translateSchematicElement(label, position)
+            # Only the last tag can still turn out to start a section, once more is read
+            keep = data.rfind(b'<')
+            if keep == -1 or finished:
+                keep = len(data)
+            yield data[:keep]
+        elif state == 'close':
+            # Sections don't nest inside themselves, so the first closing tag ends it
+            end = data.find(closing)
+            if end != -1:
+                offset += end + len(closing)
+                data = data[end + len(closing):]
+                state = 'tail'
+                continue
+            if finished:
+                raise SystemExit("%s: the <%s> section isn't closed"%(filename, closing[2:-1].decode('ascii')))
+            keep = max(0, len(data) - len(closing) + 1)
+        else:
+            # The tail, up to the next tag, is passed through along with the section
+            end = data.find(b'<')
+            if end != -1 or finished:
+                if end == -1:
+                    end = len(data)
+                yield ET.tostring(ET.Element(PASS_THROUGH_TAG, {'file': filename,
+                    'start': str(start), 'end': str(offset + end)}))
+                offset += end
+                data = data[end:]
+                state = 'scan'
+                continue
+            keep = len(data)
 
-            # If a non-array part references the new input net, just append the segments
-            # from the input to the existing net.
-            shouldCreate = True
-            for existingNet in schematicNets:
-                if existingNet.get('name') == newNet.get('name'):
-                    shouldCreate = False
-                    for segment in newNet.iter('segment'):
-                        existingNet.append(segment)
-            # Otherwise, add the input net to the schematic.
-            if shouldCreate:
-                schematicNets.append(newNet)
+        offset += keep
+        data = data[keep:]
+        if finished:
+            return
+        piece = source.read(LAZY_READ_SIZE)
+        finished = not piece
+        data += piece
 
-    # For positions besides the first one, their inputs and output nets (nIN_ and nOUT_) are replaced
-    # by new nMID_x nets, which connect the output of the previous position to the input of the
-    # current position.
-    if position > 1:
-        for inputNet in schematicInputNets:
-            for outputNet in schematicOutputNets:
-                # Find a matching input and output pair
-                if inputNet.get('name')[:-3] == outputNet.get('name')[:-4]:
-                    # Create a new net, based on the matched input net
-                    newNet = copy.deepcopy(inputNet)
-                    newNet.set('name', inputNet.get('name')[:-3] + "MID_%i"%(position-1))
-                    # Update the pinrefs so that they point to the new parts
-                    for pinref in newNet.iter('pinref'):
-                         if pinref.get('part').endswith('_'):
-                             pinref.set('part', pinref.get('part') + "%i"%(position))
-                    # And shift all wires to the correct positions.
-                    for wire in newNet.iter('wire'):
-                         wire = translateSchematicElement(wire, position)
-                    for label in newNet.iter('label'):
-                         label = translateSchematicElement(label, position)
-
-                    # Copy in any segments from the matched output net,
-                    # after translating them to the correct positions.
-                    for segment in schematicOutputNets.iter('segment'):
-                        newSegment = copy.deepcopy(segment)
-                        for pinref in newSegment.iter('pinref'):
-                             if pinref.get('part').endswith('_'):
-                                 pinref.set('part', pinref.get('part') + "%i"%(position - 1))
-                        # And shift all wires to the correct positions.
-                        for wire in newSegment.iter('wire'):
-                             wire = translateSchematicElement(wire, position - 1)
-                        for label in newSegment.iter('label'):
-                             label = translateSchematicElement(label, position - 1)
+def copyPassThrough(write, placeholder):
+    """ Write out the section that a placeholder stands for, by copying it from the input file """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    remaining = int(placeholder.get('end')) - int(placeholder.get('start'))
+    with openDesignFile(placeholder.get('file')) as source:
+        source.seek(int(placeholder.get('start')))
+        while remaining > 0:
+            chunk = source.read(min(remaining, 1 << 16))
+            if not chunk:
+                raise SystemExit("%s changed while it was being arrayed"%(placeholder.get('file')))
+            remaining -= len(chunk)
+            write(decoder.decode(chunk, remaining == 0))
 
-                        newNet.append(newSegment)
 
-                    schematicNets.append(newNet)
+##################################################################################
+######## Schematic inspection phase
+##################################################################################
+
+# Each sheet of the schematic is inspected separately, since the instances and nets
+# are stored per sheet.
+SchematicSheet = collections.namedtuple('SchematicSheet',
+    ['sheet', 'instances', 'nets', 'matrixInstances', 'inputNets', 'outputNets', 'rowNets',
+     'colNets', 'netTemplates', 'instanceTemplates'])
 
-    # For the last position, the arrayed nets (nOUT_) are replaced with outputs from the array
-    if position == lastPosition:
-        for net in schematicOutputNets:
-            newNet = copy.deepcopy(net)
-            newNet.set('name', net.get('name')[:-1])
-            for pinref in newNet.iter('pinref'):
-                 if pinref.get('part').endswith('_'):
-                     pinref.set('part', pinref.get('part') + "%i"%(position))
-            for wire in newNet.iter('wire'):
-                 wire = translateSchematicElement(wire, position)
-            for label in newNet.iter('label'):
-                 label = translateSchematicElement(label, position)
+def inspectSchematicSheet(sheet):
+    """ Remove the arrayed instances and nets from a sheet, and store them for later duplication """
 
-            # If a non-array part references the new output net, just append the segments
-            # from the output to the existing net.
-            shouldCreate = True
-            for existingNet in schematicNets:
-                if existingNet.get('name') == newNet.get('name'):
-                    shouldCreate = False
-                    for segment in newNet.iter('segment'):
-                        existingNet.append(segment)
-            # Otherwise, add the input net to the schematic.
-            if shouldCreate:
-                schematicNets.append(newNet)
+    # Sheets without instances or nets get empty (detached) containers
+    instances = sheet.find("instances")
+    if instances == None:
+        instances = ET.Element("instances")
+    nets = sheet.find("nets")
+    if nets == None:
+        nets = ET.Element("nets")
 
-    # For each row, the row nets (nROW_) are replaced with a net corresponding
-    # to that row
-    for net in schematicRowNets:
-        newNet = copy.deepcopy(net)
-        newNet.set('name', net.get('name')[:-1] + "%i"%((position-1)/args.cols))
-        for pinref in newNet.iter('pinref'):
-             if pinref.get('part').endswith('_'):
-                 pinref.set('part', pinref.get('part') + "%i"%(position))
-        for wire in newNet.iter('wire'):
-             wire = translateSchematicElement(wire, position)
-        for label in newNet.iter('label'):
-             label = translateSchematicElement(label, position)
-
-        # If a non-array part references the new output net, just append the segments
-        # from the output to the existing net.
-        shouldCreate = True
-        for existingNet in schematicNets:
-            if existingNet.get('name') == newNet.get('name'):
-                shouldCreate = False
-                for segment in newNet.iter('segment'):
-                    existingNet.append(segment)
-        # Otherwise, add the input net to the schematic.
-        if shouldCreate:
-            schematicNets.append(newNet)
+    # Remove any instance whose name ends in _, and store them for later duplication
+    matrixInstances = ET.Element("instance")
+    for instance in reversed(instances):
+        if instance.get('part').endswith("_"):
+            instances.remove(instance)
+            matrixInstances.append(instance)
 
-    # For each column, the column nets (nCOL_) are replaced with a net corresponding
-    # to that column
-    for net in schematicColNets:
-        newNet = copy.deepcopy(net)
-        newNet.set('name', net.get('name')[:-1] + "%i"%((position-1)%args.cols))
-        for pinref in newNet.iter('pinref'):
-             if pinref.get('part').endswith('_'):
-                 pinref.set('part', pinref.get('part') + "%i"%(position))
-        for wire in newNet.iter('wire'):
-             wire = translateSchematicElement(wire, position)
-        for label in newNet.iter('label'):
-             label = translateSchematicElement(label, position)
-
-        # If a non-array part references the new output net, just append the segments
-        # from the output to the existing net.
-        shouldCreate = True
-        for existingNet in schematicNets:
-            if existingNet.get('name') == newNet.get('name'):
-                shouldCreate = False
-                for segment in newNet.iter('segment'):
-                    existingNet.append(segment)
-        # Otherwise, add the input net to the schematic.
-        if shouldCreate:
-            schematicNets.append(newNet)
+    # Remove any net whose name ends in IN_ or OUT_, and store them for later duplication
+    inputNets = ET.Element("nets")    # Serial nets (input to each position)
+    outputNets = ET.Element("nets")   # Serial nets (output from each position)
+    rowNets = ET.Element("nets")      # Row-column matrix nets, row side
+    colNets = ET.Element("nets")      # Row-column matrix nets, column side
+    for net in reversed(nets):
+        if net.get('name').endswith("IN_"):
+            nets.remove(net)
+            inputNets.append(net)
+        elif net.get('name').endswith("OUT_"):
+            nets.remove(net)
+            outputNets.append(net)
+        if net.get('name').endswith("ROW_"):
+            nets.remove(net)
+            rowNets.append(net)
+        if net.get('name').endswith("COL_"):
+            nets.remove(net)
+            colNets.append(net)
+
+    # Collect the segments of the remaining (non-array) nets that reference an arrayed
+    # part. These are the templates that get copied for each position. They are
+    # detached from their nets here, so they never reach the output, and the creation
+    # phase never has to rescan the nets as they grow.
+    netTemplates = []
+    for net in nets:
+        for segment in net.iter('segment'):
+            for pinref in segment.iter('pinref'):
+                if pinref.get('part').endswith('_'):
+                    netTemplates.append((net, segment))
+                    break
+    for net, segment in netTemplates:
+        net.remove(segment)
+
+    return SchematicSheet(sheet, instances, nets, matrixInstances, inputNets, outputNets,
+        rowNets, colNets, netTemplates, None)
+
+def loadSchematic(filename):
+    """ Parse a schematic, and pull out the arrayed parts, instances and nets for later duplication """
+    global Schematic, schematicDrawing, schematicParts, schematicMatrixParts
+    global schematicSheetList, schematicSheets, schematicChains
+
+    Schematic = parseDesign(filename)
+    schematicDrawing = Schematic.getroot().find("drawing").find("schematic")
+
+    # Remove any part whose name ends in _, and store them for later duplication
+    schematicParts = schematicDrawing.find("parts")
+    schematicMatrixParts = ET.Element("parts")
+    for part in reversed(schematicParts):
+        if part.get('name').endswith("_"):
+            schematicParts.remove(part)
+            schematicMatrixParts.append(part)
+
+    schematicSheetList = schematicDrawing.find("sheets")
+    schematicSheets = [inspectSchematicSheet(sheet) for sheet in schematicSheetList]
+
+    # Pair up the serial nets by name (nIN_ with nOUT_). The input and output of a
+    # chain can be on different sheets.
+    schematicChains = []
+    for inputSheet in schematicSheets:
+        for inputNet in inputSheet.inputNets:
+            for outputSheet in schematicSheets:
+                for outputNet in outputSheet.outputNets:
+                    if inputNet.get('name')[:-3] == outputNet.get('name')[:-4]:
+                        schematicChains.append((inputSheet.sheet, inputNet, outputSheet.sheet, outputNet))
 
 
 ##################################################################################
-######## Board creation functions
+######## Spatial index
 ##################################################################################
 
-def createBoardElements(position):
-    """ Create all of the board elements needed for this position
+# A uniform grid over the wires, vias and (optionally) polygons in the signals of a
+# board, for finding everything in a rectangular region without scanning every
+# signal. Each item is filed under every grid cell that its bounding box touches;
+# items that would cover too many cells (long airwires, board-sized polygons) are
+# kept in a separate list that every query checks.
+SpatialIndex = collections.namedtuple('SpatialIndex',
+    ['cellSize', 'cells', 'oversize', 'extent'])
 
-    For each of the elements that were in the original board file,
-    create a copy of the element at the new location
+# Each indexed item is stored with its document order, signal, and bounding box
+SpatialEntry = collections.namedtuple('SpatialEntry',
+    ['order', 'signal', 'item', 'xMin', 'yMin', 'xMax', 'yMax'])
 
-    """
-    for element in boardMatrixElements:
-        # Create a copy of the element
-        newElement = copy.deepcopy(element)
+# Items covering more than this many grid cells go in the oversize list
+SPATIAL_INDEX_MAX_CELLS = 16
 
-        # Adjust the name
-    	newElement.set('name', newElement.get('name') + "%i"%(position))
+def itemBounds(item):
+    """ Compute the bounding box (xMin, yMin, xMax, yMax) of a wire, via or polygon """
+    if item.tag == 'wire':
+        x1, x2 = sorted([float(item.get('x1')), float(item.get('x2'))])
+        y1, y2 = sorted([float(item.get('y1')), float(item.get('y2'))])
+        return x1, y1, x2, y2
 
-        # Adjust the x and y position
-        translateBoardElement(newElement, position)
+    if item.tag == 'polygon':
+        xs = [float(vertex.get('x')) for vertex in item.iter('vertex')]
+        ys = [float(vertex.get('y')) for vertex in item.iter('vertex')]
+        return min(xs), min(ys), max(xs), max(ys)
 
-        boardElements.append(newElement)
+    x = float(item.get('x'))
+    y = float(item.get('y'))
+    return x, y, x, y
 
-def rotatePoint(x,y,angle):
-    """ Rotate a board element location about the board origin
+def buildSpatialIndex(board, polygons=False, cellSize=None):
+    """ Build a spatial index over the wires and vias in the signals of a board
 
-    Rotates a part about the board origin
+    If polygons is set, signal polygons are indexed as well. The grid cell
+    size defaults to one that puts roughly one item in each cell.
 
     """
-    theta = math.radians(angle);
-    cs = math.cos(theta);
-    sn = math.sin(theta);
+    tags = ['wire', 'via']
+    if polygons:
+        tags.append('polygon')
 
-    px = x * cs - y * sn 
-    py = x * sn + y * cs
+    entries = []
+    for signalNumber, signal in enumerate(board.find("signals")):
+        for tagNumber, tag in enumerate(tags):
+            for itemNumber, item in enumerate(signal.iter(tag)):
+                entries.append(SpatialEntry((signalNumber, tagNumber, itemNumber), signal, item,
+                    *itemBounds(item)))
 
-    return px, py
+    if not entries:
+        return SpatialIndex(cellSize or 1.0, {}, [], (0, 0, -1, -1))
 
-def translateBoardElement(element, position):
-    """ Move a board element into position
+    if cellSize == None:
+        width = max(entry.xMax for entry in entries) - min(entry.xMin for entry in entries)
+        height = max(entry.yMax for entry in entries) - min(entry.yMin for entry in entries)
+        cellSize = max(width, height, 1.0) / max(1, int(math.sqrt(len(entries))))
 
-    Translate a board element to a new location, based on it's position number
+    cells = collections.defaultdict(list)
+    oversize = []
+    for entry in entries:
+        ix1, iy1 = int(math.floor(entry.xMin/cellSize)), int(math.floor(entry.yMin/cellSize))
+        ix2, iy2 = int(math.floor(entry.xMax/cellSize)), int(math.floor(entry.yMax/cellSize))
+        if (ix2 - ix1 + 1)*(iy2 - iy1 + 1) > SPATIAL_INDEX_MAX_CELLS:
+            oversize.append(entry)
+            continue
+        for ix in range(ix1, ix2 + 1):
+            for iy in range(iy1, iy2 + 1):
+                cells[(ix, iy)].append(entry)
+
+    extent = (min(ix for ix, iy in cells), min(iy for ix, iy in cells),
+        max(ix for ix, iy in cells), max(iy for ix, iy in cells)) if cells else (0, 0, -1, -1)
+
+    return SpatialIndex(cellSize, dict(cells), oversize, extent)
+
+def querySpatialIndex(index, xMin, yMin, xMax, yMax, tags=None, contained=True):
+    """ Find the indexed items in a region
+
+    Returns a list of (signal, item) pairs, in document order: by signal,
+    then wires before vias before polygons. If contained is set, only items
+    lying strictly inside the region are returned (the test used for the
+    board copy region); otherwise, any item whose bounding box overlaps the
+    region is returned. tags optionally limits the kinds of item returned.
 
     """
+    cellSize = index.cellSize
+    ix1 = max(int(math.floor(xMin/cellSize)), index.extent[0])
+    iy1 = max(int(math.floor(yMin/cellSize)), index.extent[1])
+    ix2 = min(int(math.floor(xMax/cellSize)), index.extent[2])
+    iy2 = min(int(math.floor(yMax/cellSize)), index.extent[3])
 
-    # Note: These are for an array; replace with something different to do
-    # arbitrary layout (spiral, circle, etc)
-    row = (position-1)/args.cols
-    col = (position-1)%args.cols
-    rotation = 0
+    candidates = {}
+    for ix in range(ix1, ix2 + 1):
+        for iy in range(iy1, iy2 + 1):
+            for entry in index.cells.get((ix, iy), ()):
+                candidates[entry.order] = entry
+    for entry in index.oversize:
+        candidates[entry.order] = entry
 
-    if args.zigzag:
-        if row%2 == 0:
-            xOffset = col*args.spacingX
-            yOffset = row*args.spacingY
+    found = []
+    for entry in candidates.values():
+        if tags != None and entry.item.tag not in tags:
+            continue
+        if contained:
+            inside = (entry.xMin > xMin and entry.xMax < xMax
+                and entry.yMin > yMin and entry.yMax < yMax)
         else:
-            xOffset = (args.cols-col-1)*args.spacingX
-            yOffset = row*args.spacingY
-            rotation = 180
+            inside = (entry.xMax >= xMin and entry.xMin <= xMax
+                and entry.yMax >= yMin and entry.yMin <= yMax)
+        if inside:
+            found.append(entry)
 
-    else:
-        xOffset = col*args.spacingX
-        yOffset = row*args.spacingY
-
-
-    if(element.get('x') != None):
-        px, py = rotatePoint(
-            float(element.get('x')),
-            float(element.get('y')),
-            rotation)
-        element.set('x', str(px + xOffset))
-        element.set('y', str(py + yOffset))
-
-    if(element.get('x1') != None):
-        px, py = rotatePoint(
-            float(element.get('x1')),
-            float(element.get('y1')),
-            rotation)
-        element.set('x1', str(px + xOffset))
-        element.set('y1', str(py + yOffset))
-
-    if(element.get('x2') != None):
-        px, py = rotatePoint(
-            float(element.get('x2')),
-            float(element.get('y2')),
-            rotation)
-        element.set('x2', str(px + xOffset))
-        element.set('y2', str(py + yOffset))
-
-    if(element.get('rot') != None):
-        element.set('rot', 'R%i'%(float(element.get('rot')[1:]) + rotation))
+    found.sort(key=lambda entry: entry.order)
+    return [(entry.signal, entry.item) for entry in found]
 
-def updateBoardSignals(position):
-    """" Hook the new element up to any non-array signals
 
-    For each non-array signal that had a arrayed contactref entry, add the new
-    element to it. This is mostly for power and ground, things that all of the
-    elements share in parallel.
+##################################################################################
+######## Board inspection phase
+##################################################################################
 
-    """
+def loadBoard(filename):
+    """ Parse a board, and pull out the arrayed elements, signals and copy region for later duplication """
+    global Board, BoardDrawing, boardElements, boardMatrixElements, boardSignals
+    global boardInputSignals, boardOutputSignals, boardRowSignals, boardColSignals
+    global boardSpatialIndex, boardSignalTemplates
+
+    Board = parseDesign(filename)
+    BoardDrawing = Board.getroot().find("drawing").find("board")
+
+    # Remove any element whose name ends in _, and store them for later duplication 
+    boardElements = BoardDrawing.find("elements")
+    boardMatrixElements = ET.Element("elements")
+    for element in reversed(boardElements):
+        if element.get('name').endswith("_"):
+            boardElements.remove(element)
+            boardMatrixElements.append(element)
+
+
+    # Remove any signal whose name ends in IN_ or OUT_, and store them for later duplication
+    boardSignals = BoardDrawing.find("signals")
+    boardInputSignals = ET.Element("signals")   # Serial signals (input to each position)
+    boardOutputSignals = ET.Element("signals")  # Serial signals (output from each position)
+    boardRowSignals = ET.Element("signals")     # Row-column matrix signals, row side
+    boardColSignals = ET.Element("signals")     # Row-column matrix signals, column side
+    for signal in reversed(boardSignals):
+        if signal.get('name').endswith("IN_"):
+            boardSignals.remove(signal)
+            boardInputSignals.append(signal)
+        if signal.get('name').endswith("OUT_"):
+            boardSignals.remove(signal)
+            boardOutputSignals.append(signal)
+        if signal.get('name').endswith("ROW_"):
+            boardSignals.remove(signal)
+            boardRowSignals.append(signal)
+        if signal.get('name').endswith("COL_"):
+            boardSignals.remove(signal)
+            boardColSignals.append(signal)
+
+    # The vias and wires that land in the copy region are duplicated for each position.
+    # This is sucky because they are inside signals... so index the signals spatially
+    # once, and look the copy region up in the index (see findBoardCopyItems), rather
+    # than checking every wire and via.
+    boardSpatialIndex = buildSpatialIndex(BoardDrawing)
+
+    # Collect the contactrefs of the remaining (non-array) signals that reference an
+    # arrayed element. These are the templates that get copied for each position, and
+    # are detached from their signals so that they never reach the output.
+    boardSignalTemplates = []
     for signal in boardSignals:
         for contactref in signal.iter('contactref'):
             if contactref.get('element').endswith('_'):
-                 newContactref = copy.deepcopy(contactref)
-                 newContactref.set('element', contactref.get('element') + "%i"%(position))
-                 signal.append(newContactref)
+                boardSignalTemplates.append((signal, contactref))
+    for signal, contactref in boardSignalTemplates:
+        signal.remove(contactref)
 
+    indexBoardSignals()
 
-def createBoardInterconnectSignals(position):
-    """ Create input, output, and interconnect signals for the new part
-    """
+def findBoardCopyItems(xMin, yMin, xMax, yMax):
+    """ Find the vias and wires that land in a copy region, grouped by signal, using the board's spatial index """
+    copyItems = collections.OrderedDict()
+    for signal, item in querySpatialIndex(boardSpatialIndex, xMin, yMin, xMax, yMax):
+        copyItems.setdefault(signal, []).append(item)
+        # TODO: Delete the original
 
-    # For the first position, the arrayed signals (nIN_) are replaced with inputs to the array
-    if position == 1:
-        for signal in boardInputSignals:
-            newSignal = copy.deepcopy(signal)
-            newSignal.set('name', signal.get('name')[:-1])
-            for contactref in newSignal.iter('contactref'):
-                 contactref.set('element', contactref.get('element') + "%i"%(position))
+    return copyItems
 
-            # If a non-array part references the new signal, just append the contactrefs
-            # from the new signal to the existing signal.
-            # Note: At some point, maybe we care about wires/etc here?
-            shouldCreate = True
-            for existingSignal in boardSignals:
-                if existingSignal.get('name') == newSignal.get('name'):
-                    shouldCreate = False
-                    for contactref in newSignal.iter('contactref'):
-                        existingSignal.append(contactref)
-            # Otherwise, add the new signal to the board.
-            if shouldCreate:
-                boardSignals.append(newSignal)
+##################################################################################
+######## Net and signal registry
+##################################################################################
 
-    # For positions besides the first one, their inputs and output signals (nIN_ and nOUT_) are replaced
-    # by new nMID_x signals, which connect the output of the previous position to the input of the
-    # current position.
-    if position > 1:
-        for inputSignal in boardInputSignals:
-            for outputSignal in boardOutputSignals:
-                # Find a matching input and output pair
-                if inputSignal.get('name')[:-3] == outputSignal.get('name')[:-4]:
-                    # Create a new signal, based on the matched input signal
-                    newSignal = copy.deepcopy(inputSignal)
-                    newSignal.set('name', newSignal.get('name')[:-3] + "MID_%i"%(position-1))
-                    # Modify all input contact refs to point to the current position
-                    for contactref in newSignal.iter('contactref'):
-                        contactref.set('element', contactref.get('element') + "%i"%(position))
-                    # Modify all output contact refs to point to the previous position
-                    for contactref in outputSignal.iter('contactref'):
-                        newContactref = copy.deepcopy(contactref)
-                        newContactref.set('element', contactref.get('element') + "%i"%(position-1))
-                        newSignal.append(newContactref)
-                    boardSignals.append(newSignal)
+# Index the nets and signals by name, so that merging a generated net into an
+# existing one is a dictionary lookup rather than a scan over the (growing) list.
+# To keep the index current, new nets and signals must be added through the
+# helpers below. The schematic nets are indexed per page (see SchematicPage),
+# since each sheet has its own list of nets.
+def indexBoardSignals():
+    """ Build the name index of the board signals """
+    global boardSignalIndex
 
+    boardSignalIndex = {}
+    for signal in boardSignals:
+        boardSignalIndex.setdefault(signal.get('name'), signal)
 
-    # For the last position, the arrayed signals (nOUT_) are replaced with outputs from the array
-    if position == lastPosition:
-        for signal in boardOutputSignals:
-            newSignal = copy.deepcopy(signal)
-            newSignal.set('name', signal.get('name')[:-1])
-            for contactref in newSignal.iter('contactref'):
-                 contactref.set('element', contactref.get('element') + "%i"%(position))
+def addSchematicNet(page, net):
+    """ Add a new net to a schematic page, and record it in the page's name index """
+    page.nets.append(net)
+    page.netIndex.setdefault(net.get('name'), net)
+    profileCount('nets created')
 
-            # If a non-array part references the new signal, just append the contactrefs
-            # from the new signal to the existing signal.
-            # Note: At some point, maybe we care about wires/etc here?
-            shouldCreate = True
-            for existingSignal in boardSignals:
-                if existingSignal.get('name') == newSignal.get('name'):
-                    shouldCreate = False
-                    for contactref in newSignal.iter('contactref'):
-                        existingSignal.append(contactref)
-            # Otherwise, add the new signal to the board.
-            if shouldCreate:
-                boardSignals.append(newSignal)
+def mergeSchematicNet(page, newNet):
+    """ Merge a generated net into a schematic page
 
-    # For each row, the row signals (nROW_) are replaced with a signal corresponding
-    # to that row
-    for signal in boardRowSignals:
-        newSignal = copy.deepcopy(signal)
-        newSignal.set('name', signal.get('name')[:-1] + "%i"%((position-1)/args.cols))
-        for contactref in newSignal.iter('contactref'):
-             contactref.set('element', contactref.get('element') + "%i"%(position))
-
-        # If this signal already exists, append the new contact reference to it.
-        # Note: At some point, maybe we care about wires/etc here?
-        shouldCreate = True
-        for existingSignal in boardSignals:
-            if existingSignal.get('name') == newSignal.get('name'):
-                shouldCreate = False
-                for contactref in newSignal.iter('contactref'):
-                    existingSignal.append(contactref)
-        # Otherwise, add the new signal to the board.
-        if shouldCreate:
-            boardSignals.append(newSignal)
+    If a net with the same name already exists on the page, the segments from
+    the new net are appended to it. Otherwise, the new net is added to the page.
 
-    # For each column, the column signals (nCOL_) are replaced with a signal corresponding
-    # to that column
-    for signal in boardColSignals:
-        newSignal = copy.deepcopy(signal)
-        newSignal.set('name', signal.get('name')[:-1] + "%i"%((position-1)%args.cols))
-        for contactref in newSignal.iter('contactref'):
-             contactref.set('element', contactref.get('element') + "%i"%(position))
-
-        # If this signal already exists, append the new contact reference to it.
-        # Note: At some point, maybe we care about wires/etc here?
-        shouldCreate = True
-        for existingSignal in boardSignals:
-            if existingSignal.get('name') == newSignal.get('name'):
-                shouldCreate = False
-                for contactref in newSignal.iter('contactref'):
-                    existingSignal.append(contactref)
-        # Otherwise, add the new signal to the board.
-        if shouldCreate:
-            boardSignals.append(newSignal)
+    """
+    existingNet = page.netIndex.get(newNet.get('name'))
+    if existingNet is None:
+        addSchematicNet(page, newNet)
+    else:
+        profileCount('nets merged')
+        for segment in list(newNet.iter('segment')):
+            existingNet.append(segment)
 
-def createBoardCopySignals(position):
-    """ Create an instance of all the wires and vias that were in the copy region """
-    for signal in boardCopySignals:
-        # Create a copy of the signal list, and translate the elemnts in it
-        newSignal = copy.deepcopy(signal)
-        for wire in newSignal.iter('wire'):
-            translateBoardElement(wire, position)
-        for via in newSignal.iter('via'):
-            translateBoardElement(via, position)
+def addBoardSignal(signal):
+    """ Add a new signal to the board, and record it in the name index """
+    boardSignals.append(signal)
+    boardSignalIndex.setdefault(signal.get('name'), signal)
+    profileCount('signals created')
 
-        # If this signal already exists, append the wires and vias to it.
-        shouldCreate = True
-        for existingSignal in boardSignals:
-            if existingSignal.get('name') == newSignal.get('name'):
-                shouldCreate = False
-                for wire in newSignal.iter('wire'):
-                    existingSignal.append(wire)
-                for via in newSignal.iter('via'):
-                    existingSignal.append(via)
-        # Otherwise, add the new signal to the board.
-        if shouldCreate:
-            boardSignals.append(newSignal)
-    
+def mergeBoardSignal(newSignal, tags):
+    """ Merge a generated signal into the board
+
+    If a signal with the same name already exists, the children of the new
+    signal with the given tags are appended to it, one tag at a time. Otherwise,
+    the new signal is added to the board.
+
+    """
+    existingSignal = boardSignalIndex.get(newSignal.get('name'))
+    if existingSignal is None:
+        addBoardSignal(newSignal)
+    else:
+        profileCount('signals merged')
+        for tag in tags:
+            for item in list(newSignal.iter(tag)):
+                existingSignal.append(item)
 
 ##################################################################################
-######## New part creation phase
+######## Placement table
 ##################################################################################
 
+# The board offset and rotation, and the schematic offset, of every position are
+# computed once per configuration and stored in a flat array of numbers
+# (PLACEMENT_FIELDS per position), which the board and schematic translation read
+# from (see boardOffset and schematicOffset). The board positions come from a
+# layout (-layout), or from a file of coordinates (-placements) that is read in a
+# single pass; the schematic is always a grid.
+placementTable = array.array('d')
 
-# Create a new part for each array position, that is:
-# * Shifted in the x and y directions
-# * Renamed according to it's instantion number
-lastPosition = args.rows*args.cols
-for position in range(1, lastPosition + 1):
+# Board x, board y, board rotation, schematic x and schematic y
+PLACEMENT_FIELDS = 5
 
-    # Create copies of the schematic parts and instances, update existing nets, and add
-    # intermediate nets.
-    createSchematicParts(position)
-    createSchematicInstances(position)
-    updateSchematicNets(position)
-    createSchematicInterconnectNets(position)
+def gridLayout(rowShift=0):
+    """ Lay the positions out in rows and columns
 
-    # Create copies of the board elements, update existing signals, and add intermediate
-    # signals to transfer data between positions
-    createBoardElements(position)
-    updateBoardSignals(position)
-    createBoardInterconnectSignals(position)
-    createBoardCopySignals(position)
+    If zigzag is set, every other row runs backwards and is rotated by 180
+    degrees. Every other row is also moved along by rowShift.
 
+    """
+    for position in range(1, lastPosition + 1):
+        row = (position-1)//args.cols
+        col = (position-1)%args.cols
+        rotation = 0
 
-##################################################################################
-######## Schematic Cleanup phase
-##################################################################################
+        if args.zigzag and row%2 == 1:
+            col = args.cols-col-1
+            rotation = 180
 
-# Now we need to clean up any segments of non-array nets that include a reference to
-# a pin on a array device.
-for net in schematicNets:
-    for segment in reversed(list(net)):
-        shouldDelete = False
-        for pinref in segment.iter('pinref'):
-            if pinref.get('part').endswith('_'):
-                 shouldDelete = True
-        if shouldDelete:
-            net.remove(segment)
+        yield col*args.spacingX + (row%2)*rowShift, row*args.spacingY, rotation
 
-##################################################################################
-######## Board Cleanup phase
-##################################################################################
+def hexLayout():
+    """ Lay the positions out in rows, with every other row moved along by half a column, as in a hexagonal grid """
+    return gridLayout(args.spacingX/2.0)
+
+def circleLayout():
+    """ Lay each row out as a ring, and each column as a spoke
+
+    The positions are spacingX apart around the innermost ring, the rings
+    are spacingY apart, and each position is rotated to face out from the
+    centre.
+
+    """
+    radius = args.cols*abs(args.spacingX)/(2*math.pi)
+    for position in range(1, lastPosition + 1):
+        row = (position-1)//args.cols
+        col = (position-1)%args.cols
+        angle = 360.0*col/args.cols
+        cs, sn = rotationCosSin(angle)
+        ringRadius = radius + row*abs(args.spacingY)
+
+        yield ringRadius*cs, ringRadius*sn, angle
+
+def spiralLayout():
+    """ Lay the positions out along a spiral, spacingX apart along it, with its turns spacingY apart
+
+    Each position is rotated to follow the spiral. The spiral starts a turn
+    out from the centre, so that the first positions aren't crowded together.
+
+    """
+    if args.spacingY == 0:
+        raise SystemExit("The spiral layout needs a Y spacing, for the distance between its turns")
+
+    pitch = abs(args.spacingY)/(2*math.pi)
+    theta = 2*math.pi
+    for position in range(1, lastPosition + 1):
+        radius = pitch*theta
+        yield radius*math.cos(theta), radius*math.sin(theta), math.degrees(theta)%360
+
+        # Step along the spiral by (about) spacingX
+        theta += abs(args.spacingX)/math.hypot(radius, pitch)
+
+def fileLayout(filename):
+    """ Read the positions from a CSV file, one line of x, y and (optionally) rotation for each
+
+    A header line, blank lines and lines starting with # are skipped.
+
+    """
+    with io.open(filename, 'r', encoding='utf-8') as placements:
+        for number, line in enumerate(placements, 1):
+            fields = [field.strip() for field in line.split(',')]
+            if fields == [''] or fields[0].startswith('#'):
+                continue
+            try:
+                values = [float(field) for field in fields[:3]]
+            except ValueError:
+                values = None
+            if values == None or len(values) < 2:
+                if number == 1:
+                    continue
+                raise SystemExit("%s, line %i: expected an x, a y and optionally a rotation"%(filename,
+                    number))
+
+            yield values[0], values[1], values[2] if len(values) > 2 else 0.0
+
+LAYOUTS = collections.OrderedDict([
+    ('grid', gridLayout),
+    ('hex', hexLayout),
+    ('circle', circleLayout),
+    ('spiral', spiralLayout),
+])
+
+# The serial chain (nIN_ -> nMID_x -> nOUT_) joins the positions in number order.
+# By default the positions take the layout's placements in order, so the chain
+# follows the layout (row by row, or back and forth with zigzag). A chain order
+# (-chainOrder) instead numbers the placements along a path between them, so that
+# the chain doesn't jump across the board; the schematic stays a grid, in chain
+# order. The space filling curves take O(N log N) time. The nearest neighbour
+# order searches a k-d tree that leaves out the placements already in the chain,
+# which takes about O(log N) for each step however the placements are spread (in
+# clusters far apart, or along a line).
+
+# Resolution of the space filling curves, in bits along each axis
+CURVE_BITS = 16
+
+# How far along the chain 2-opt looks for a pair of links to swap, and how many
+# times it goes over the chain
+TWO_OPT_WINDOW = 12
+TWO_OPT_PASSES = 2
+
+# Most points in a leaf of the nearest neighbour order's k-d tree
+NEAREST_LEAF_POINTS = 8
+
+def curveCoordinates(points):
+    """ Scale points onto the grid of a space filling curve, keeping their aspect ratio """
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+    xMin, yMin = min(xs), min(ys)
+    size = max(max(xs) - xMin, max(ys) - yMin)
+    scale = ((1 << CURVE_BITS) - 1)/size if size > 0 else 0
+    return [(int((x - xMin)*scale), int((y - yMin)*scale)) for x, y in points]
+
+def mortonIndex(x, y):
+    """ Find the distance of a point along a Morton (Z order) curve, by interleaving the bits of its coordinates """
+    index = 0
+    for bit in range(CURVE_BITS):
+        index |= ((x >> bit) & 1) << (2*bit) | ((y >> bit) & 1) << (2*bit + 1)
+    return index
+
+def hilbertIndex(x, y):
+    """ Find the distance of a point along a Hilbert curve """
+    index = 0
+    size = 1 << (CURVE_BITS - 1)
+    while size > 0:
+        rx = 1 if x & size else 0
+        ry = 1 if y & size else 0
+        index += size*size*((3*rx) ^ ry)
+        # Rotate the quadrant, so that the curve inside it runs the right way
+        if ry == 0:
+            if rx == 1:
+                x = size - 1 - x
+                y = size - 1 - y
+            x, y = y, x
+        x &= size - 1
+        y &= size - 1
+        size >>= 1
+    return index
+
+def curveOrder(curveIndex):
+    """ Make a chain order that sorts the points along a space filling curve """
+    def order(points):
+        indexes = [curveIndex(x, y) for x, y in curveCoordinates(points)]
+        return sorted(range(len(points)), key=indexes.__getitem__)
+
+    return order
+
+def nearestNeighbourOrder(points):
+    """ Make a chain order by always moving on to the nearest point not yet in the chain, then improve it with 2-opt
+
+    The chain starts at the first point. The points are kept in a k-d tree,
+    split at the median of the longer side of each branch, which counts the
+    points not yet taken in each branch and keeps their bounding box. Taking a
+    point updates these on the way up to the root, so the search only goes
+    into branches that still hold points closer than the best so far (ties go
+    to the point found first).
+
+    """
+    # The tree is kept in lists indexed by node number. Each node holds a range
+    # of treeOrder, and a leaf has no children (-1).
+    treeOrder = list(range(len(points)))
+    first, last, lower, upper, parent, live, boxes = [], [], [], [], [], [], []
+    leafOf = [0]*len(points)
+    taken = [False]*len(points)
+
+    def boundingBox(indexes):
+        xs = [points[index][0] for index in indexes]
+        ys = [points[index][1] for index in indexes]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def build(start, end, parentNode):
+        node = len(first)
+        box = boundingBox(treeOrder[start:end])
+        for values, value in ((first, start), (last, end), (lower, -1), (upper, -1), (parent, parentNode),
+                (live, end - start), (boxes, box)):
+            values.append(value)
+        if end - start <= NEAREST_LEAF_POINTS:
+            for index in treeOrder[start:end]:
+                leafOf[index] = node
+            return node
+
+        axis = 0 if box[2] - box[0] >= box[3] - box[1] else 1
+        treeOrder[start:end] = sorted(treeOrder[start:end], key=lambda index: points[index][axis])
+        middle = (start + end)//2
+        lower[node] = build(start, middle, node)
+        upper[node] = build(middle, end, node)
+        return node
+
+    def boxDistance(node, x, y):
+        """ Squared distance from a point to the nearest edge of a node's bounding box """
+        xMin, yMin, xMax, yMax = boxes[node]
+        dx = xMin - x if x < xMin else (x - xMax if x > xMax else 0)
+        dy = yMin - y if y < yMin else (y - yMax if y > yMax else 0)
+        return dx*dx + dy*dy
+
+    def take(index):
+        taken[index] = True
+        node = leafOf[index]
+        left = [other for other in treeOrder[first[node]:last[node]] if not taken[other]]
+        if len(left) > 0:
+            boxes[node] = boundingBox(left)
+        live[node] -= 1
+        # Once a box stays the same, so do the boxes above it
+        changed = True
+        node = parent[node]
+        while node >= 0:
+            live[node] -= 1
+            if changed:
+                a, b = lower[node], upper[node]
+                if live[a] == 0 or live[b] == 0:
+                    box = boxes[b if live[a] == 0 else a]
+                else:
+                    box = (min(boxes[a][0], boxes[b][0]), min(boxes[a][1], boxes[b][1]),
+                        max(boxes[a][2], boxes[b][2]), max(boxes[a][3], boxes[b][3]))
+                changed = box != boxes[node]
+                boxes[node] = box
+            node = parent[node]
+
+    def nearest(x, y):
+        best, bestDistance = None, None
+        # The nearer child is pushed last, so that it is searched first
+        branches = [(0, 0)]
+        while len(branches) > 0:
+            node, distance = branches.pop()
+            if best != None and distance >= bestDistance:
+                continue
+            if lower[node] < 0:
+                for index in treeOrder[first[node]:last[node]]:
+                    if taken[index]:
+                        continue
+                    dx, dy = points[index][0] - x, points[index][1] - y
+                    distance = dx*dx + dy*dy
+                    if best == None or distance < bestDistance:
+                        best, bestDistance = index, distance
+                continue
+            a, b = lower[node], upper[node]
+            if live[a] == 0 or live[b] == 0:
+                child = b if live[a] == 0 else a
+                branches.append((child, boxDistance(child, x, y)))
+                continue
+            aDistance, bDistance = boxDistance(a, x, y), boxDistance(b, x, y)
+            if aDistance < bDistance:
+                branches += [(b, bDistance), (a, aDistance)]
+            else:
+                branches += [(a, aDistance), (b, bDistance)]
+        return best
+
+    build(0, len(points), -1)
+    order = [0]
+    take(0)
+    for step in range(len(points) - 1):
+        x, y = points[order[-1]]
+        order.append(nearest(x, y))
+        take(order[-1])
+
+    return twoOpt(points, order)
+
+def twoOpt(points, order):
+    """ Shorten a chain by reversing the parts of it between pairs of links that cross
+
+    Only pairs of links within TWO_OPT_WINDOW of each other are tried, which
+    keeps each pass linear in the length of the chain. The first point stays
+    first.
 
+    """
+    def distance(a, b):
+        return math.hypot(points[a][0] - points[b][0], points[a][1] - points[b][1])
+
+    for chainPass in range(TWO_OPT_PASSES):
+        improved = False
+        for i in range(len(order) - 2):
+            for j in range(i + 2, min(i + TWO_OPT_WINDOW, len(order))):
+                a, b, c = order[i], order[i + 1], order[j]
+                # Reverse b..c, joining a to c and b to whatever followed c
+                before = distance(a, b)
+                after = distance(a, c)
+                if j + 1 < len(order):
+                    d = order[j + 1]
+                    before += distance(c, d)
+                    after += distance(b, d)
+                if after < before - 1e-9:
+                    order[i + 1:j + 1] = order[j:i:-1]
+                    improved = True
+        if not improved:
+            break
+
+    return order
+
+CHAIN_ORDERS = collections.OrderedDict([
+    ('hilbert', curveOrder(hilbertIndex)),
+    ('morton', curveOrder(mortonIndex)),
+    ('nearest', nearestNeighbourOrder),
+])
+
+@profiledFunction
+def orderChain(table):
+    """ Renumber the board placements in a placement table along the chain order """
+    placements = len(table)//PLACEMENT_FIELDS
+    points = [(table[index*PLACEMENT_FIELDS], table[index*PLACEMENT_FIELDS + 1])
+        for index in range(placements)]
+    order = CHAIN_ORDERS[args.chainOrder](points)
+    del points
+
+    boardFields = [table[index*PLACEMENT_FIELDS:index*PLACEMENT_FIELDS + 3] for index in order]
+    for position, fields in enumerate(boardFields):
+        table[position*PLACEMENT_FIELDS:position*PLACEMENT_FIELDS + 3] = fields
+
+def buildPlacementTable():
+    """ Compute the placement of every position, in a single pass over the layout """
+    global placementTable
+
+    if args.placements != None:
+        layout = fileLayout(args.placements)
+    else:
+        layout = LAYOUTS[args.layout]()
+
+    placementTable = array.array('d')
+    for index, (x, y, rotation) in enumerate(itertools.islice(layout, lastPosition)):
+        # If the schematic is split across sheets, the offset is relative to the
+        # first position on the position's sheet.
+        sheetIndex = index%args.sheetPositions if args.sheetPositions > 0 else index
+        placementTable.extend((x, y, rotation, (sheetIndex%args.cols)*args.schematicSpacingX,
+            (sheetIndex//args.cols)*args.schematicSpacingY))
 
-# Now we need to clean up any non-array signals that include a reference to
-# an input array element (since we canned those)
-for signal in boardSignals:
-    for contactref in reversed(list(signal)):
-        if contactref.get('element') != None and contactref.get('element').endswith('_'):
-            signal.remove(contactref)
+    placements = len(placementTable)//PLACEMENT_FIELDS
+    extra = next(layout, None) != None
+    layout.close()
+    if placements < lastPosition or extra:
+        raise SystemExit("%s has %s placements, but the array has %i positions"%(args.placements,
+            "more" if extra else "%i"%(placements), lastPosition))
+
+    if args.chainOrder != 'layout':
+        # Rows and columns are taken from the position numbers, which the chain order changes
+        if len(boardRowSignals) + len(boardColSignals) + sum(len(sheet.rowNets) + len(sheet.colNets)
+                for sheet in schematicSheets) > 0:
+            raise SystemExit("-chainOrder %s renumbers the positions, so it can't be used with row or column nets (nROW_ or nCOL_)"%(
+                args.chainOrder))
+        orderChain(placementTable)
 
 
 ##################################################################################
-######## Write out phase
+######## Board placement
 ##################################################################################
 
-Board.write(outputBoardName, encoding="utf-8", xml_declaration=True)
-Schematic.write(outputSchematicName, encoding="utf-8", xml_declaration=True)
+# All of the board template coordinates (x/y, x1/y1 and x2/y2 of every arrayed
+# element and copy region wire and via) are gathered into flat arrays, so that they
+# can be rotated and offset for a whole batch of positions at once. This uses NumPy
+# if it is available, and plain Python otherwise; both give the same results.
+boardPointsX = []
+boardPointsY = []
+
+# Number of positions to transform in each batch
+BOARD_PLACEMENT_BATCH = 256
+
+# Transformed coordinates for the current batch of positions, by position
+boardPointCache = {}
+
+def gatherBoardPoints(templates):
+    """ Add the coordinates of some board templates to the placement arrays
+
+    Returns the templates, with their index into the placement arrays filled in.
+
+    """
+    gathered = []
+    for template in templates:
+        gathered.append(template._replace(index=len(boardPointsX)))
+        for xKey, yKey, x, y in template.points:
+            # Points without an x coordinate are not translated; keep a
+            # placeholder so that the indices line up.
+            boardPointsX.append(x if x != None else 0.0)
+            boardPointsY.append(y if y != None else 0.0)
+    return gathered
+
+def rotationCosSin(angle):
+    """ Compute the cosine and sine of a rotation, in degrees
+
+    Quarter turns are looked up, so that rotating by 90, 180 or 270 degrees
+    is exact rather than picking up floating point error from the trig.
+
+    """
+    if angle % 90 == 0:
+        return {0: (1.0, 0.0), 90: (0.0, 1.0), 180: (-1.0, 0.0), 270: (0.0, -1.0)}[angle % 360]
+
+    theta = math.radians(angle)
+    return math.cos(theta), math.sin(theta)
+
+def transformBoardPoints(positions):
+    """ Rotate and offset the gathered board coordinates for a batch of positions
+
+    Returns a list of (xs, ys) coordinate lists, one for each position.
+
+    """
+    table = [boardOffset(position) for position in positions]
+    trig = [rotationCosSin(rotation) for xOffset, yOffset, rotation in table]
+
+    if numpy != None:
+        x = numpy.array(boardPointsX, dtype=float)[numpy.newaxis, :]
+        y = numpy.array(boardPointsY, dtype=float)[numpy.newaxis, :]
+        xOffset = numpy.array([row[0] for row in table], dtype=float)[:, numpy.newaxis]
+        yOffset = numpy.array([row[1] for row in table], dtype=float)[:, numpy.newaxis]
+        cs = numpy.array([row[0] for row in trig], dtype=float)[:, numpy.newaxis]
+        sn = numpy.array([row[1] for row in trig], dtype=float)[:, numpy.newaxis]
+
+        xs = ((x * cs - y * sn) + xOffset).tolist()
+        ys = ((x * sn + y * cs) + yOffset).tolist()
+        return list(zip(xs, ys))
+
+    points = list(zip(boardPointsX, boardPointsY))
+    transformed = []
+    for (xOffset, yOffset, rotation), (cs, sn) in zip(table, trig):
+        transformed.append((
+            [(x * cs - y * sn) + xOffset for x, y in points],
+            [(x * sn + y * cs) + yOffset for x, y in points]))
+    return transformed
+
+def boardPoints(position):
+    """ Look up the transformed board coordinates for a position
+
+    The coordinates are computed a batch of positions at a time, starting
+    from the requested one, and cached until a position outside the batch
+    is requested.
+
+    """
+    if position not in boardPointCache:
+        boardPointCache.clear()
+        positions = range(position, min(position + BOARD_PLACEMENT_BATCH, lastPosition + 1))
+        boardPointCache.update(zip(positions, transformBoardPoints(positions)))
+
+    return boardPointCache[position]
+
+
+##################################################################################
+######## Template compilation phase
+##################################################################################
+
+# A compiled template is a parsed-once copy of an arrayed part, instance or element.
+# The coordinates and rotation are stored as numbers and the name stem as a string,
+# so stamping out a position only has to fill in the offset, rotation and suffix
+# instead of deep-copying the XML and round-tripping every attribute through float().
+# lxml is much slower at making elements than at copying them, so with lxml each
+# template also keeps a copy of its element (the prototype) to stamp copies of.
+Template = collections.namedtuple('Template',
+    ['tag', 'attrib', 'text', 'tail', 'nameKey', 'name', 'points', 'rotation', 'children',
+     'index', 'prototype'])
+
+def compileTemplate(element, nameKey=None, translate=True):
+    """ Compile an element (and its children) into a template record
+
+    The name attribute (nameKey) is stored as a stem to be suffixed with the
+    position number. If translate is set, the x/y, x1/y1 and x2/y2 coordinates
+    and the rotation are parsed into numbers, to be offset for each position.
+    Children are compiled verbatim.
+
+    """
+    points = []
+    rotation = None
+    if translate:
+        for xKey, yKey in (('x', 'y'), ('x1', 'y1'), ('x2', 'y2')):
+            x = element.get(xKey)
+            y = element.get(yKey)
+            if x != None or y != None:
+                points.append((xKey, yKey,
+                    None if x == None else float(x),
+                    None if y == None else float(y)))
+        if element.get('rot') != None:
+            rotation = float(element.get('rot')[1:])
+
+    name = None
+    if nameKey != None:
+        name = element.get(nameKey)
+
+    children = [compileTemplate(child, translate=False) for child in element]
+    prototype = copy.copy(element) if ET is lxmlEtree else None
+
+    return Template(element.tag, dict(element.attrib), element.text, element.tail,
+        nameKey, name, points, rotation, children, None, prototype)
+
+def buildTemplate(template, attrib, parent=None):
+    """ Build a new element from a template, using the given attributes (as a child of parent, if given) """
+    if template.prototype is not None and parent is None:
+        element = copyElement(template.prototype)
+        for key, value in attrib.items():
+            if template.attrib.get(key) != value:
+                element.set(key, value)
+        return element
+
+    # With lxml, making the children in place saves moving them into their parent
+    if parent is None:
+        element = ET.Element(template.tag, attrib)
+    else:
+        element = ET.SubElement(parent, template.tag, attrib)
+    profileCount('elements created')
+    element.text = template.text
+    element.tail = template.tail
+    for child in template.children:
+        buildTemplate(child, child.attrib, element)
+    return element
+
+def stampSchematicTemplate(template, position):
+    """ Build a copy of a schematic template for this position
+
+    Equivalent to a deep copy of the template element that is renamed and
+    passed through translateSchematicElement.
+
+    """
+    xOffset, yOffset = schematicOffset(position)
+
+    attrib = dict(template.attrib)
+    if template.nameKey != None:
+        attrib[template.nameKey] = template.name + "%i"%(position)
+    for xKey, yKey, x, y in template.points:
+        if x != None:
+            attrib[xKey] = str(x + xOffset)
+        if y != None:
+            attrib[yKey] = str(y + yOffset)
+
+    return buildTemplate(template, attrib)
+
+def stampBoardTemplate(template, position):
+    """ Build a copy of a board template for this position
+
+    Equivalent to a deep copy of the template element that is renamed, then
+    rotated and moved by the position's board offset. The template must have
+    been gathered with gatherBoardPoints, so that its transformed coordinates
+    can be looked up from the batched placement.
+
+    """
+    xs, ys = boardPoints(position)
+    rotation = boardOffset(position)[2]
+
+    attrib = dict(template.attrib)
+    if template.nameKey != None:
+        attrib[template.nameKey] = template.name + "%i"%(position)
+    index = template.index
+    for xKey, yKey, x, y in template.points:
+        if x != None:
+            attrib[xKey] = str(xs[index])
+            attrib[yKey] = str(ys[index])
+        index += 1
+    if template.rotation != None:
+        attrib['rot'] = 'R%g'%(template.rotation + rotation)
+
+    return buildTemplate(template, attrib)
+
+def compileTemplates():
+    """ Compile the arrayed parts, instances, elements and copy region of the loaded design """
+    global schematicPartTemplates, schematicSheets, boardElementTemplates
+    global boardPointsX, boardPointsY, boardElementPoints, boardCopyRegion
+
+    boardPointsX = []
+    boardPointsY = []
+
+    schematicPartTemplates = [compileTemplate(part, 'name', translate=False)
+        for part in schematicMatrixParts]
+    schematicSheets = [sheet._replace(instanceTemplates=[compileTemplate(instance, 'part')
+        for instance in sheet.matrixInstances]) for sheet in schematicSheets]
+    boardElementTemplates = gatherBoardPoints([compileTemplate(element, 'name')
+        for element in boardMatrixElements])
+    boardElementPoints = len(boardPointsX)
+
+    boardCopyRegion = None
+    compileBoardCopyRegion()
+
+def compileBoardCopyRegion():
+    """ Compile the wires and vias in the copy region given by the current options, if it has changed
+
+    The copy region can change between configurations of a loaded design,
+    since it is looked up in the board's spatial index. Its points follow the
+    elements' in the placement arrays.
+
+    """
+    global boardCopySignalTemplates, boardCopyRegion
+
+    region = (args.boardCopyXMin, args.boardCopyYMin, args.boardCopyXMax, args.boardCopyYMax)
+    if region == boardCopyRegion:
+        return
+
+    del boardPointsX[boardElementPoints:]
+    del boardPointsY[boardElementPoints:]
+
+    # The copy region signals keep their name, and hold a list of wire and via templates
+    boardCopySignalTemplates = [(signal.get('name'),
+        gatherBoardPoints([compileTemplate(item) for item in items]))
+        for signal, items in findBoardCopyItems(*region).items()]
+    boardCopyRegion = region
+
+##################################################################################
+######## Schematic creation functions
+##################################################################################
+
+@profiledFunction
+def createSchematicParts(position):
+    """ Create all the Schematic parts needed for this position
+    
+    For each of the elements that were in the original board file,
+    create a copy of the element at the new location
+
+    """
+    for template in schematicPartTemplates:
+        # Create a renamed copy of the part
+        schematicParts.append(stampSchematicTemplate(template, position))
+
+@profiledFunction
+def createSchematicInstances(page, position):
+    """ Create all of the schematic instances needed for this position
+
+    For each of the arrayed instances that were on the page's sheet,
+    create a copy of the instance at the new location
+
+    """
+    for template in page.template.instanceTemplates:
+        # Create a renamed copy of the instance, moved to the new x and y position
+        page.instances.append(stampSchematicTemplate(template, position))
+
+
+def schematicOffset(position):
+    """ Look up the schematic x and y offset for a position number in the placement table """
+    index = (position - 1)*PLACEMENT_FIELDS
+    return placementTable[index + 3], placementTable[index + 4]
+
+def translateSchematicElement(element, position):
+    """ Translate a schematic element to a new location
+
+    Translate a schematic element to a new location, based on it's position number
+
+    """
+    xOffset, yOffset = schematicOffset(position)
+
+    for key, offset in (('x', xOffset), ('y', yOffset), ('x1', xOffset), ('y1', yOffset),
+            ('x2', xOffset), ('y2', yOffset)):
+        value = element.get(key)
+        if value != None:
+            element.set(key, str(float(value) + offset))
+
+def copySchematicSegment(segment, position):
+    """ Copy a segment of a non-array net for a position
+
+    The pinrefs to arrayed parts are pointed at the parts for this position,
+    and everything in the segment is moved to the new location.
+
+    """
+    newSegment = copyElement(segment)
+    for pinref in newSegment.iter('pinref'):
+        if pinref.get('part').endswith('_'):
+            pinref.set('part', pinref.get('part') + "%i"%(position))
+    for item in newSegment.iter():
+        translateSchematicElement(item, position)
+
+    return newSegment
+
+@profiledFunction
+def updateSchematicNets(page, position):
+    """ Update non-array nets
+
+    For each non-array net that has a segment with a arrayed position,
+    create a new copy of that segment and append it to the net (or, on a new
+    sheet, to the net's stand-in on that sheet). Only the template segments
+    found during inspection are copied, so the copies made for earlier
+    positions are never rescanned.
+
+    """
+    for net, segment in page.template.netTemplates:
+        page.netTargets[net].append(copySchematicSegment(segment, position))
+
+def moveSchematicNet(element, position):
+    """ Move a copied net (or net segment) to a position
+
+    Points the pinrefs to arrayed parts at the parts for this position, and
+    shifts the wires and labels to the correct positions.
+
+    """
+    for pinref in element.iter('pinref'):
+        if pinref.get('part').endswith('_'):
+            pinref.set('part', pinref.get('part') + "%i"%(position))
+    for wire in element.iter('wire'):
+        translateSchematicElement(wire, position)
+    for label in element.iter('label'):
+        translateSchematicElement(label, position)
+
+def stampSchematicNet(net, name, position):
+    """ Create a renamed copy of an arrayed net, moved to a position """
+    newNet = copyElement(net)
+    newNet.set('name', name)
+    moveSchematicNet(newNet, position)
+
+    return newNet
+
+def rowNetName(net, position):
+    """ Name of the row net (or signal) created from an nROW_ template for a position """
+    return net.get('name')[:-1] + "%i"%((position-1)//args.cols)
+
+def colNetName(net, position):
+    """ Name of the column net (or signal) created from an nCOL_ template for a position """
+    return net.get('name')[:-1] + "%i"%((position-1)%args.cols)
+
+# The row and column nets (nROW_ and nCOL_) are buses: each one connects a whole
+# row or column of positions. Rather than stamping the template net at every
+# position and merging the copies by name, each bus is built once, at the position
+# where it starts, from one stamped copy of the template and the segments for the
+# rest of its positions.
+def schematicBuses(page, position):
+    """ Find the row and column nets of a page that start at a position
+
+    A row net starts at the first position of its row on the page, and a
+    column net at its position in the first row on the page. Yields the
+    template net, the name of the new net, and the positions it connects.
+
+    """
+    template = page.template
+    if position == page.first or (position-1)%args.cols == 0:
+        rowEnd = min(((position-1)//args.cols + 1)*args.cols, page.last)
+        for net in template.rowNets:
+            yield net, rowNetName(net, position), range(position, rowEnd + 1)
+    if position < page.first + args.cols:
+        for net in template.colNets:
+            yield net, colNetName(net, position), range(position, page.last + 1, args.cols)
+
+def schematicBusNames(page):
+    """ Names of the row and column nets on a page that are built as buses, rather than merged into an existing net """
+    return set(name for position in range(page.first, page.last + 1)
+        for net, name, positions in schematicBuses(page, position) if name not in page.netIndex)
+
+def stampSchematicBusSegments(net, positions):
+    """ Generate copies of the segments of a row or column net, moved to each of a range of positions """
+    for position in positions:
+        for segment in net.iter('segment'):
+            newSegment = copyElement(segment)
+            moveSchematicNet(newSegment, position)
+            yield newSegment
+
+def stampSchematicBus(net, name, positions):
+    """ Create a row or column net, connecting all of its positions """
+    newNet = stampSchematicNet(net, name, positions[0])
+    for segment in stampSchematicBusSegments(net, positions[1:]):
+        newNet.append(segment)
+
+    return newNet
+
+def copySchematicNetShell(net, name):
+    """ Create an empty, renamed copy of a net """
+    newNet = ET.Element(net.tag, net.attrib)
+    profileCount('elements created')
+    newNet.text = net.text
+    newNet.tail = net.tail
+    newNet.set('name', name)
+
+    return newNet
+
+def stampSchematicMidNets(page, position):
+    """ Create the nMID_x nets on a page that connect the previous position to this one
+
+    For each matching input and output pair (nIN_ and nOUT_), creates a new
+    net based on the input net, and copies in the segments from the output net
+    of the previous position. If the input and output nets are on different
+    sheets, or the previous position is on a different page, each side is
+    created as a separate net (with the same name) on its own page.
+
+    """
+    for inputSheet, inputNet, outputSheet, outputNet in schematicChains:
+        if position > 1:
+            name = inputNet.get('name')[:-3] + "MID_%i"%(position-1)
+            inputHere = inputSheet is page.template.sheet
+            outputHere = outputSheet is page.template.sheet and position - 1 >= page.first
+
+            if inputHere or outputHere:
+                # Create a new net based on the matched input net, with the pinrefs
+                # pointing to the new parts and the wires shifted into place
+                if inputHere:
+                    newNet = stampSchematicNet(inputNet, name, position)
+                else:
+                    newNet = copySchematicNetShell(outputNet, name)
+
+                # Copy in any segments from the matched output net,
+                # after translating them to the correct positions.
+                if outputHere:
+                    for segment in outputNet.iter('segment'):
+                        newSegment = copyElement(segment)
+                        moveSchematicNet(newSegment, position - 1)
+                        newNet.append(newSegment)
+
+                yield newNet
+
+        # At the end of a page, the output side of the next nMID_x net is on this page
+        if position == page.last and position < lastPosition and outputSheet is page.template.sheet:
+            newNet = copySchematicNetShell(outputNet, inputNet.get('name')[:-3] + "MID_%i"%(position))
+            for segment in outputNet.iter('segment'):
+                newSegment = copyElement(segment)
+                moveSchematicNet(newSegment, position)
+                newNet.append(newSegment)
+
+            yield newNet
+
+@profiledFunction
+def createSchematicInterconnectNets(page, position, buses=None):
+    """ Create input, output, and interconnect nets for the new part
+
+    The row and column nets named in buses (see schematicBusNames) are built
+    whole where they start; the others are merged in position by position.
+
+    """
+    template = page.template
+
+    # For the first position, the arrayed nets (nIN_) are replaced with inputs to the array
+    if position == 1:
+        for net in template.inputNets:
+            # If a non-array part references the new input net, just append the segments
+            # from the input to the existing net. Otherwise, add the input net to the schematic.
+            mergeSchematicNet(page, stampSchematicNet(net, net.get('name')[:-1], position))
+
+    # For positions besides the first one, their inputs and output nets (nIN_ and nOUT_) are replaced
+    # by new nMID_x nets, which connect the output of the previous position to the input of the
+    # current position.
+    for newNet in stampSchematicMidNets(page, position):
+        addSchematicNet(page, newNet)
+
+    # For the last position, the arrayed nets (nOUT_) are replaced with outputs from the array
+    if position == lastPosition:
+        for net in template.outputNets:
+            # If a non-array part references the new output net, just append the segments
+            # from the output to the existing net. Otherwise, add the output net to the schematic.
+            mergeSchematicNet(page, stampSchematicNet(net, net.get('name')[:-1], position))
+
+    # The row and column nets that start here are added to the schematic with
+    # every position they connect
+    if buses != None:
+        for net, name, positions in schematicBuses(page, position):
+            if name in buses:
+                addSchematicNet(page, stampSchematicBus(net, name, positions))
+
+    # For each row, the row nets (nROW_) are replaced with a net corresponding
+    # to that row. If this net already exists, append the new segments to it.
+    # Otherwise, add the new net to the schematic.
+    for net in template.rowNets:
+        if buses == None or rowNetName(net, position) not in buses:
+            mergeSchematicNet(page, stampSchematicNet(net, rowNetName(net, position), position))
+
+    # For each column, the column nets (nCOL_) are replaced with a net corresponding
+    # to that column
+    for net in template.colNets:
+        if buses == None or colNetName(net, position) not in buses:
+            mergeSchematicNet(page, stampSchematicNet(net, colNetName(net, position), position))
+
+
+##################################################################################
+######## Schematic pages
+##################################################################################
+
+# The positions are generated one page at a time. Normally there is one page per
+# sheet, holding every position. If the schematic is split across sheets
+# (-sheetPositions), each group of positions gets a new page for every sheet that
+# has arrayed content; the new sheets are added to the end of the schematic, and
+# nets with the same name on different sheets are connected by Eagle.
+#
+# Pages are independent of each other, so they can be generated in parallel.
+SchematicPage = collections.namedtuple('SchematicPage',
+    ['template', 'sheet', 'instances', 'nets', 'netIndex', 'netTargets', 'first', 'last'])
+
+def hasArrayedContent(template):
+    """ Check if a sheet has anything that gets copied for each position """
+    return (len(template.instanceTemplates) > 0 or len(template.netTemplates) > 0
+        or len(template.inputNets) > 0 or len(template.outputNets) > 0
+        or len(template.rowNets) > 0 or len(template.colNets) > 0)
+
+def createSchematicPages():
+    """ Split the positions into pages, adding new sheets to the schematic as needed """
+    positionsPerPage = args.sheetPositions if args.sheetPositions > 0 else lastPosition
+
+    pages = []
+    for first in range(1, lastPosition + 1, positionsPerPage):
+        last = min(first + positionsPerPage - 1, lastPosition)
+        for template in schematicSheets:
+            if first == 1:
+                # The first page goes on the original sheet
+                sheet, instances, nets = template.sheet, template.instances, template.nets
+                netTargets = dict((net, net) for net, segment in template.netTemplates)
+            elif hasArrayedContent(template):
+                # Later pages get a new sheet with empty instances and nets, and a
+                # stand-in for each of the non-array nets that the positions connect to.
+                sheet = ET.Element("sheet")
+                sheet.text = template.sheet.text
+                sheet.tail = template.sheet.tail
+                for container in (template.instances, template.nets):
+                    newContainer = ET.SubElement(sheet, container.tag)
+                    newContainer.text = container.text
+                    newContainer.tail = container.tail
+                instances, nets = sheet
+                schematicSheetList.append(sheet)
+
+                netTargets = {}
+                for net, segment in template.netTemplates:
+                    if net not in netTargets:
+                        netTargets[net] = copySchematicNetShell(net, net.get('name'))
+                        nets.append(netTargets[net])
+            else:
+                continue
+
+            netIndex = {}
+            for net in nets:
+                netIndex.setdefault(net.get('name'), net)
+
+            pages.append(SchematicPage(template, sheet, instances, nets, netIndex, netTargets,
+                first, last))
+
+    return pages
+
+def removeSchematicPages(pages):
+    """ Remove the sheets that were added to the schematic for some pages """
+    for page in pages:
+        if page.sheet is not page.template.sheet:
+            schematicSheetList.remove(page.sheet)
+
+def generateSchematicPage(page):
+    """ Create the instances and nets for all of the positions on a page """
+    buses = schematicBusNames(page)
+    for position in range(page.first, page.last + 1):
+        createSchematicInstances(page, position)
+        updateSchematicNets(page, position)
+        createSchematicInterconnectNets(page, position, buses)
+
+def generateSchematicPages():
+    """ Create the instances and nets for every page """
+    for page in schematicPages:
+        generateSchematicPage(page)
+
+
+##################################################################################
+######## Board creation functions
+##################################################################################
+
+@profiledFunction
+def createBoardElements(position):
+    """ Create all of the board elements needed for this position
+
+    For each of the elements that were in the original board file,
+    create a copy of the element at the new location
+
+    """
+    for template in boardElementTemplates:
+        # Create a renamed copy of the element, moved to the new x and y position
+        boardElements.append(stampBoardTemplate(template, position))
+
+def boardOffset(position):
+    """ Look up the board x and y offset, and rotation, for a position number in the placement table """
+    index = (position - 1)*PLACEMENT_FIELDS
+    return placementTable[index], placementTable[index + 1], placementTable[index + 2]
+
+def copyBoardContactref(contactref, position):
+    """ Copy a contactref to an arrayed element, pointing it at the element for a position """
+    newContactref = copyElement(contactref)
+    newContactref.set('element', contactref.get('element') + "%i"%(position))
+
+    return newContactref
+
+@profiledFunction
+def updateBoardSignals(position):
+    """" Hook the new element up to any non-array signals
+
+    For each non-array signal that had a arrayed contactref entry, add the new
+    element to it. This is mostly for power and ground, things that all of the
+    elements share in parallel. Only the template contactrefs found during
+    inspection are copied, so the copies made for earlier positions are never
+    rescanned.
+
+    """
+    for signal, contactref in boardSignalTemplates:
+        signal.append(copyBoardContactref(contactref, position))
+
+def stampBoardSignal(signal, name, position):
+    """ Create a renamed copy of an arrayed signal, with the contactrefs pointing at a position """
+    newSignal = copyElement(signal)
+    newSignal.set('name', name)
+    for contactref in newSignal.iter('contactref'):
+        contactref.set('element', contactref.get('element') + "%i"%(position))
+
+    return newSignal
+
+def stampBoardMidSignals(position):
+    """ Create the nMID_x signals that connect the previous position to this one
+
+    For each matching input and output pair (nIN_ and nOUT_), creates a new
+    signal based on the input signal, and adds the output contactrefs of the
+    previous position.
+
+    """
+    for inputSignal in boardInputSignals:
+        for outputSignal in boardOutputSignals:
+            # Find a matching input and output pair
+            if inputSignal.get('name')[:-3] == outputSignal.get('name')[:-4]:
+                # Create a new signal, based on the matched input signal, with all
+                # input contact refs pointing to the current position
+                newSignal = stampBoardSignal(inputSignal,
+                    inputSignal.get('name')[:-3] + "MID_%i"%(position-1), position)
+                # Modify all output contact refs to point to the previous position
+                for contactref in outputSignal.iter('contactref'):
+                    newSignal.append(copyBoardContactref(contactref, position-1))
+
+                yield newSignal
+
+def boardBuses(position):
+    """ Find the row and column signals (nROW_ and nCOL_) that start at a position
+
+    A row signal starts at the beginning of its row, and a column signal in
+    the first row. Yields the template signal, the name of the new signal,
+    and the positions it connects (see schematicBuses).
+
+    """
+    if (position-1)%args.cols == 0:
+        for signal in boardRowSignals:
+            yield signal, rowNetName(signal, position), range(position,
+                min(position + args.cols, lastPosition + 1))
+    if position <= args.cols:
+        for signal in boardColSignals:
+            yield signal, colNetName(signal, position), range(position, lastPosition + 1, args.cols)
+
+def boardBusNames():
+    """ Names of the row and column signals that are built as buses, rather than merged into an existing signal """
+    return set(name for position in range(1, lastPosition + 1)
+        for signal, name, positions in boardBuses(position) if name not in boardSignalIndex)
+
+def stampBoardBusContactrefs(signal, positions):
+    """ Generate copies of the contactrefs of a row or column signal, for each of a range of positions """
+    for position in positions:
+        for contactref in signal.iter('contactref'):
+            yield copyBoardContactref(contactref, position)
+
+def stampBoardBus(signal, name, positions):
+    """ Create a row or column signal, connecting all of its positions """
+    newSignal = stampBoardSignal(signal, name, positions[0])
+    for contactref in stampBoardBusContactrefs(signal, positions[1:]):
+        newSignal.append(contactref)
+
+    return newSignal
+
+@profiledFunction
+def createBoardInterconnectSignals(position, buses=None):
+    """ Create input, output, and interconnect signals for the new part
+
+    The row and column signals named in buses (see boardBusNames) are built
+    whole where they start; the others are merged in position by position.
+
+    """
+
+    # For the first position, the arrayed signals (nIN_) are replaced with inputs to the array
+    if position == 1:
+        for signal in boardInputSignals:
+            # If a non-array part references the new signal, just append the contactrefs
+            # from the new signal to the existing signal. Otherwise, add the new signal
+            # to the board.
+            # Note: At some point, maybe we care about wires/etc here?
+            mergeBoardSignal(stampBoardSignal(signal, signal.get('name')[:-1], position),
+                ['contactref'])
+
+    # For positions besides the first one, their inputs and output signals (nIN_ and nOUT_) are replaced
+    # by new nMID_x signals, which connect the output of the previous position to the input of the
+    # current position.
+    if position > 1:
+        for newSignal in stampBoardMidSignals(position):
+            addBoardSignal(newSignal)
+
+    # For the last position, the arrayed signals (nOUT_) are replaced with outputs from the array
+    if position == lastPosition:
+        for signal in boardOutputSignals:
+            mergeBoardSignal(stampBoardSignal(signal, signal.get('name')[:-1], position),
+                ['contactref'])
+
+    # The row and column signals that start here are added to the board with
+    # every position they connect
+    if buses != None:
+        for signal, name, positions in boardBuses(position):
+            if name in buses:
+                addBoardSignal(stampBoardBus(signal, name, positions))
+
+    # For each row, the row signals (nROW_) are replaced with a signal corresponding
+    # to that row. If this signal already exists, append the new contact reference
+    # to it. Otherwise, add the new signal to the board.
+    for signal in boardRowSignals:
+        if buses == None or rowNetName(signal, position) not in buses:
+            mergeBoardSignal(stampBoardSignal(signal, rowNetName(signal, position), position),
+                ['contactref'])
+
+    # For each column, the column signals (nCOL_) are replaced with a signal corresponding
+    # to that column
+    for signal in boardColSignals:
+        if buses == None or colNetName(signal, position) not in buses:
+            mergeBoardSignal(stampBoardSignal(signal, colNetName(signal, position), position),
+                ['contactref'])
+
+def stampBoardCopySignal(name, templates, position):
+    """ Create a copy of a copy region signal, with its wires and vias translated to a position """
+    newSignal = ET.Element("signal")
+    profileCount('elements created')
+    newSignal.set('name', name)
+    for template in templates:
+        newSignal.append(stampBoardTemplate(template, position))
+
+    return newSignal
+
+@profiledFunction
+def createBoardCopySignals(position):
+    """ Create an instance of all the wires and vias that were in the copy region """
+    for name, templates in boardCopySignalTemplates:
+        # If this signal already exists, append the wires and vias to it.
+        # Otherwise, add the new signal to the board.
+        mergeBoardSignal(stampBoardCopySignal(name, templates, position), ['wire', 'via'])
+
+
+##################################################################################
+######## Streaming output
+##################################################################################
+
+# In streaming mode, the arrayed designs are never built in memory. Instead, the
+# untouched parts of the original documents are written out as they are, and the
+# arrayed parts, instances, elements, nets and signals are generated one at a time
+# as the containers that hold them are written. The output is the same as building
+# the tree and writing it, but memory stays proportional to the template rather
+# than to the size of the array.
+#
+# Note that this relies on the generated nets and signals only merging with
+# their own kind, ie: a ROW net created by the array never receives segments
+# from an IN or COL template with the same name.
+
+STREAM_PLACEHOLDER = 'make-array-placeholder'
+
+# Number of generated elements to serialize in each call to ElementTree
+STREAM_BATCH = 256
+
+def serializeElement(element):
+    """ Serialize an element (and its children) to text, without an XML declaration
+
+    Python 2's ElementTree has no 'unicode' encoding, so there the element is
+    serialized as UTF-8 and decoded.
+
+    """
+    if str is bytes:
+        return ET.tostring(element, encoding='utf-8').decode('utf-8')
+    return ET.tostring(element, encoding='unicode')
+
+def writeElements(write, elements):
+    """ Write a list of sibling elements, serializing them in a single batch """
+    if ET is lxmlEtree:
+        # lxml would move the elements into the wrapper, out of the design
+        write(u''.join(serializeElement(element) for element in elements))
+        return
+
+    wrapper = ET.Element(STREAM_PLACEHOLDER)
+    wrapper.extend(elements)
+    text = serializeElement(wrapper)
+    write(text[len('<%s>'%(STREAM_PLACEHOLDER)):-len('</%s>'%(STREAM_PLACEHOLDER))])
+
+def streamChildren(write, children):
+    """ Write a sequence of children
+
+    Each child is either an Element, which is written out whole (or copied
+    from the input file, for a lazy parsing placeholder), an (element,
+    children) pair, which is streamed in turn, or a function that writes
+    pre-rendered XML using the write function it is given.
+
+    """
+    batch = []
+    for child in children:
+        if ET.iselement(child) and child.tag != PASS_THROUGH_TAG:
+            batch.append(child)
+            if len(batch) == STREAM_BATCH:
+                writeElements(write, batch)
+                batch = []
+            continue
+
+        if batch:
+            writeElements(write, batch)
+            batch = []
+        if isinstance(child, tuple):
+            streamElement(write, child[0], child[1])
+        elif ET.iselement(child):
+            copyPassThrough(write, child)
+        else:
+            child(write)
+
+    if batch:
+        writeElements(write, batch)
+
+def streamElement(write, element, children):
+    """ Write an element, taking its children from an iterable
+
+    See streamChildren for the kinds of child. The output matches what
+    ElementTree would write for the element with those children.
+
+    """
+    # Let ElementTree format the tags, by writing a copy of the element with
+    # a single placeholder child and splitting around it.
+    shell = ET.Element(element.tag, element.attrib)
+    shell.text = element.text
+    shell.tail = element.tail
+    ET.SubElement(shell, STREAM_PLACEHOLDER)
+    placeholder = serializeElement(ET.Element(STREAM_PLACEHOLDER))
+    startTag, endTag = serializeElement(shell).split(placeholder)
+
+    children = iter(children)
+    for child in children:
+        write(startTag)
+        streamChildren(write, itertools.chain([child], children))
+        write(endTag)
+        return
+
+    shell.remove(shell[0])
+    write(serializeElement(shell))
+
+def streamDocument(tree, filename, expansions):
+    """ Write a document, generating the children of some elements on the fly
+
+    expansions maps container elements in the tree to functions that return
+    an iterable of their children (see streamElement). Everything else is
+    written out unchanged, in the same format as writeXml.
+
+    """
+    # Find the elements that have an expanded element (or a lazy parsing placeholder,
+    # which ElementTree can't write) somewhere below them
+    parents = dict((child, parent) for parent in tree.iter() for child in parent)
+    ancestors = set()
+    for element in itertools.chain(expansions, tree.iter(PASS_THROUGH_TAG)):
+        while element in parents:
+            element = parents[element]
+            ancestors.add(element)
+
+    def expandChildren(element):
+        for child in element:
+            if child in expansions:
+                yield (child, expansions[child]())
+            elif child in ancestors:
+                yield (child, expandChildren(child))
+            else:
+                yield child
+
+    root = tree.getroot()
+    with openDesignFile(filename, 'w') as output:
+        output.write(xmlHeader(tree))
+        streamElement(output.write, root, expandChildren(root))
+
+@profiledGenerator
+def streamStampedTemplates(existing, templates, stamp, positions):
+    """ Generate the existing children of a container, then a stamped copy of the templates for each position """
+    for item in existing:
+        yield item
+
+    if args.tiled:
+        for child in streamTiles(templateTiles(templates), positions):
+            yield child
+        return
+
+    for position in positions:
+        for template in templates:
+            yield stamp(template, position)
+
+@profiledGenerator
+def streamGrowingNet(newNet, template, positions, stampItems):
+    """ Generate the children of a new row or column net (a bus)
+
+    The net was created (as newNet) at its first position, and receives the
+    items that stampItems copies from the template for each of the following
+    positions (see stampSchematicBus and stampBoardBus).
+
+    """
+    for item in newNet:
+        yield item
+
+    if args.tiled:
+        for child in streamTiles(growingNetTiles(template, stampItems), positions):
+            yield child
+        return
+
+    for item in stampItems(template, positions):
+        yield item
+
+def schematicNetGrowth(page):
+    """ Find which existing nets on a page grow as the positions are added
+
+    Returns the segment templates that are copied into each existing net, and
+    the names of the new nets that get merged into an existing one.
+
+    """
+    template = page.template
+
+    templatesByNet = collections.defaultdict(list)
+    for net, segment in template.netTemplates:
+        templatesByNet[page.netTargets[net]].append(segment)
+
+    mergedNames = set(net.get('name')[:-1] for net in template.inputNets)
+    mergedNames.update(net.get('name')[:-1] for net in template.outputNets)
+    for position in range(page.first, page.last + 1):
+        if position == page.first or (position-1)%args.cols == 0:
+            mergedNames.update(rowNetName(net, position) for net in template.rowNets)
+        if position < page.first + args.cols:
+            mergedNames.update(colNetName(net, position) for net in template.colNets)
+
+    return templatesByNet, mergedNames
+
+@profiledGenerator
+def streamSchematicNetSegments(page, net, templates, positions):
+    """ Generate the segments appended to an existing net on a page for a range of positions """
+    name = net.get('name')
+    merges = page.netIndex.get(name) is net
+    template = page.template
+
+    tiles = itemTiles(templates) if args.tiled else None
+    if tiles != None and not merges:
+        for child in streamTiles(tiles, positions):
+            yield child
+        return
+
+    for position in positions:
+        if tiles != None:
+            for child in streamTiles(tiles, [position]):
+                yield child
+        else:
+            for segment in templates:
+                yield copySchematicSegment(segment, position)
+
+        if not merges:
+            continue
+
+        mergedNets = []
+        if position == 1:
+            mergedNets += [inputNet for inputNet in template.inputNets
+                if inputNet.get('name')[:-1] == name]
+        if position == lastPosition:
+            mergedNets += [outputNet for outputNet in template.outputNets
+                if outputNet.get('name')[:-1] == name]
+        mergedNets += [rowNet for rowNet in template.rowNets
+            if rowNetName(rowNet, position) == name]
+        mergedNets += [colNet for colNet in template.colNets
+            if colNetName(colNet, position) == name]
+
+        for mergedNet in mergedNets:
+            profileCount('nets merged')
+            for segment in stampSchematicNet(mergedNet, name, position).iter('segment'):
+                yield segment
+
+@profiledGenerator
+def streamSchematicNewNets(page, positions):
+    """ Generate the new nets created on a page at a range of positions, in the order the creation functions build them """
+    template = page.template
+    midTiles = schematicMidTiles(page) if args.tiled else None
+
+    for position in positions:
+        if position == 1:
+            for net in template.inputNets:
+                if net.get('name')[:-1] not in page.netIndex:
+                    yield stampSchematicNet(net, net.get('name')[:-1], position)
+
+        if midTiles != None and page.first < position < page.last:
+            profileCount('nets created', len(midTiles))
+            for child in streamTiles(midTiles, [position]):
+                yield child
+        else:
+            for newNet in stampSchematicMidNets(page, position):
+                yield newNet
+
+        if position == lastPosition:
+            for net in template.outputNets:
+                if net.get('name')[:-1] not in page.netIndex:
+                    yield stampSchematicNet(net, net.get('name')[:-1], position)
+
+        # Row and column nets are created where they start, and grow as they are written
+        for net, name, busPositions in schematicBuses(page, position):
+            if name not in page.netIndex:
+                newNet = stampSchematicNet(net, name, position)
+                yield (newNet, streamGrowingNet(newNet, net, busPositions[1:],
+                    stampSchematicBusSegments))
+
+def streamSchematicNets(page):
+    """ Generate the nets of a schematic page, in the order the creation functions build them """
+    templatesByNet, mergedNames = schematicNetGrowth(page)
+    positions = range(page.first, page.last + 1)
+
+    # Existing nets, with any new segments appended
+    for net in page.nets:
+        if net in templatesByNet or net.get('name') in mergedNames:
+            yield (net, itertools.chain(
+                net,
+                streamSchematicNetSegments(page, net, templatesByNet[net], positions)))
+        else:
+            yield net
+
+    # New nets, in the order they are created (tiled nets are counted as they are made)
+    for newNet in streamSchematicNewNets(page, positions):
+        if not callable(newNet):
+            profileCount('nets created')
+        yield newNet
+
+def streamSchematicPage(page):
+    """ Generate the children of a schematic page's sheet, with the instances and nets expanded """
+    for child in page.sheet:
+        if child is page.instances:
+            yield (child, streamStampedTemplates(page.instances, page.template.instanceTemplates,
+                stampSchematicTemplate, range(page.first, page.last + 1)))
+        elif child is page.nets:
+            yield (child, streamSchematicNets(page))
+        else:
+            yield child
+
+def boardSignalGrowth():
+    """ Find which existing board signals grow as the positions are added
+
+    Returns the contactref templates that are copied into each existing
+    signal, and the names of the new signals that get merged into an
+    existing one.
+
+    """
+    templatesBySignal = collections.defaultdict(list)
+    for signal, contactref in boardSignalTemplates:
+        templatesBySignal[signal].append(contactref)
+
+    mergedNames = set(signal.get('name')[:-1] for signal in boardInputSignals)
+    mergedNames.update(signal.get('name')[:-1] for signal in boardOutputSignals)
+    for position in range(1, lastPosition + 1, args.cols):
+        mergedNames.update(rowNetName(signal, position) for signal in boardRowSignals)
+    for position in range(1, min(args.cols, lastPosition) + 1):
+        mergedNames.update(colNetName(signal, position) for signal in boardColSignals)
+    mergedNames.update(name for name, templates in boardCopySignalTemplates)
+
+    return templatesBySignal, mergedNames
+
+@profiledGenerator
+def streamBoardSignalItems(signal, templates, positions):
+    """ Generate the items appended to an existing signal for a range of positions """
+    name = signal.get('name')
+    merges = boardSignalIndex.get(name) is signal
+    copySignals = [(copyName, copyTemplates) for copyName, copyTemplates in boardCopySignalTemplates
+        if copyName == name]
+
+    tiles = itemTiles(templates, ()) if args.tiled else None
+    if tiles != None and not merges:
+        for child in streamTiles(tiles, positions):
+            yield child
+        return
+    if tiles != None:
+        copySignals = [(copyName, copySignalTiles(copyTemplates)) for copyName, copyTemplates in copySignals]
+
+    for position in positions:
+        if tiles != None:
+            for child in streamTiles(tiles, [position]):
+                yield child
+        else:
+            for contactref in templates:
+                yield copyBoardContactref(contactref, position)
+
+        if not merges:
+            continue
+
+        mergedSignals = []
+        if position == 1:
+            mergedSignals += [template for template in boardInputSignals
+                if template.get('name')[:-1] == name]
+        if position == lastPosition:
+            mergedSignals += [template for template in boardOutputSignals
+                if template.get('name')[:-1] == name]
+        mergedSignals += [template for template in boardRowSignals
+            if rowNetName(template, position) == name]
+        mergedSignals += [template for template in boardColSignals
+            if colNetName(template, position) == name]
+
+        for template in mergedSignals:
+            profileCount('signals merged')
+            for contactref in stampBoardSignal(template, name, position).iter('contactref'):
+                yield contactref
+
+        for copyName, copyTemplates in copySignals:
+            profileCount('signals merged')
+            if tiles != None:
+                for child in streamTiles(copyTemplates, [position]):
+                    yield child
+                continue
+            newSignal = stampBoardCopySignal(copyName, copyTemplates, position)
+            for tag in ['wire', 'via']:
+                for item in newSignal.iter(tag):
+                    yield item
+
+@profiledGenerator
+def streamBoardNewSignals(positions):
+    """ Generate the new signals created at a range of positions, in the order the creation functions build them """
+    midTiles = boardMidTiles() if args.tiled else None
+
+    for position in positions:
+        if position == 1:
+            for signal in boardInputSignals:
+                if signal.get('name')[:-1] not in boardSignalIndex:
+                    yield stampBoardSignal(signal, signal.get('name')[:-1], position)
+
+        if position > 1 and midTiles != None:
+            profileCount('signals created', len(midTiles))
+            for child in streamTiles(midTiles, [position]):
+                yield child
+        elif position > 1:
+            for newSignal in stampBoardMidSignals(position):
+                yield newSignal
+
+        if position == lastPosition:
+            for signal in boardOutputSignals:
+                if signal.get('name')[:-1] not in boardSignalIndex:
+                    yield stampBoardSignal(signal, signal.get('name')[:-1], position)
+
+        # Row and column signals are created where they start, and grow as they are written
+        for signal, name, busPositions in boardBuses(position):
+            if name not in boardSignalIndex:
+                newSignal = stampBoardSignal(signal, name, position)
+                yield (newSignal, streamGrowingNet(newSignal, signal, busPositions[1:],
+                    stampBoardBusContactrefs))
+
+def streamBoardSignals():
+    """ Generate the signals of the arrayed board, in the order the creation functions build them """
+    templatesBySignal, mergedNames = boardSignalGrowth()
+    positions = range(1, lastPosition + 1)
+
+    # Existing signals, with any new contactrefs, wires and vias appended
+    for signal in boardSignals:
+        if signal in templatesBySignal or signal.get('name') in mergedNames:
+            yield (signal, itertools.chain(
+                signal,
+                streamBoardSignalItems(signal, templatesBySignal[signal], positions)))
+        else:
+            yield signal
+
+    # New signals, in the order they are created (tiled signals are counted as they are made)
+    for newSignal in streamBoardNewSignals(positions):
+        if not callable(newSignal):
+            profileCount('signals created')
+        yield newSignal
+
+
+##################################################################################
+######## Tiled output
+##################################################################################
+
+# In tiled mode (--tiled), the arrayed items are not built and serialized again
+# for every position. Each kind of item (a part, an instance, an element, a net
+# segment, a contactref, a copy region wire, an nMID_x net, ...) is built and
+# serialized once, as a tile: its XML text with holes where the position number,
+# coordinates and rotation go. The output is then written a block of positions at
+# a time, by filling in the holes of the tiles for each position in the block.
+#
+# The holes are filled in with the same arithmetic and formatting as the stamping
+# functions, so the output is the same as streaming it. Positions whose items
+# depend on more than the position number (the inputs and outputs of the array,
+# the start of each row, and the ends of each schematic page) are stamped as usual.
+
+Tile = collections.namedtuple('Tile', ['text', 'holes'])
+
+# Marks the holes in the serialized tiles: a private use character, which both XML
+# backends write out unescaped (lxml refuses control characters such as NUL)
+TILE_MARKER = u'\ue000'
+
+# Schematic items moved by moveSchematicNet (copySchematicSegment moves every item)
+SCHEMATIC_MOVED_TAGS = ('wire', 'label')
+
+def tileHole(holes, kind, value=None, shift=0):
+    """ Add a hole to a tile that is being built, and return the marker to put in its place
+
+    The hole is filled in for the position shift away from the one being
+    written, with one of:
+    * 'position': the position number
+    * 'x' or 'y': the schematic coordinate value, offset to the position
+    * 'boardX' or 'boardY': the board coordinate at index value of the placement arrays
+    * 'rotation': the rotation value, plus the board rotation of the position
+
+    """
+    holes.append((kind, value, shift))
+    return u'%s%i%s'%(TILE_MARKER, len(holes) - 1, TILE_MARKER)
+
+def compileTile(element, holes):
+    """ Serialize an element that has hole markers in its attributes into a tile """
+    pieces = serializeElement(element).split(TILE_MARKER)
+    text = u'%s'.join(piece.replace(u'%', u'%%') for piece in pieces[0::2])
+
+    return Tile(text, [holes[int(number)] for number in pieces[1::2]])
+
+def fillTile(tile, position):
+    """ Fill in the holes of a tile for a position, and return its XML text """
+    values = []
+    for kind, value, shift in tile.holes:
+        at = position + shift
+        if kind == 'position':
+            values.append("%i"%(at))
+        elif kind == 'x':
+            values.append(str(value + schematicOffset(at)[0]))
+        elif kind == 'y':
+            values.append(str(value + schematicOffset(at)[1]))
+        elif kind == 'boardX':
+            values.append(str(boardPoints(at)[0][value]))
+        elif kind == 'boardY':
+            values.append(str(boardPoints(at)[1][value]))
+        else:
+            values.append("%g"%(value + boardOffset(at)[2]))
+
+    return tile.text%tuple(values)
+
+def writeTiles(tiles, positions, write):
+    """ Write out the tiles filled in for each of a block of positions """
+    profileCount('tiled copies', len(tiles)*len(positions))
+    write(u''.join([fillTile(tile, position) for position in positions for tile in tiles]))
+
+def streamTiles(tiles, positions):
+    """ Generate stream children that write out the tiles for a range of positions, a block at a time """
+    if len(tiles) == 0:
+        return
+    for start in range(0, len(positions), STREAM_BATCH):
+        yield functools.partial(writeTiles, tiles, positions[start:start + STREAM_BATCH])
+
+def markTemplate(template, holes):
+    """ Build an element from a template, with holes for what stampSchematicTemplate or stampBoardTemplate fill in """
+    attrib = dict(template.attrib)
+    if template.nameKey != None:
+        attrib[template.nameKey] = template.name + tileHole(holes, 'position')
+
+    # Board templates have their points gathered into the placement arrays
+    index = template.index
+    for xKey, yKey, x, y in template.points:
+        if index != None:
+            if x != None:
+                attrib[xKey] = tileHole(holes, 'boardX', index)
+                attrib[yKey] = tileHole(holes, 'boardY', index)
+            index += 1
+        else:
+            if x != None:
+                attrib[xKey] = tileHole(holes, 'x', x)
+            if y != None:
+                attrib[yKey] = tileHole(holes, 'y', y)
+    if template.index != None and template.rotation != None:
+        attrib['rot'] = 'R' + tileHole(holes, 'rotation', template.rotation)
+
+    return buildTemplate(template, attrib)
+
+def markItems(element, holes, movedTags=None, shift=0):
+    """ Put holes into a copied element, for the changes made to it for a position
+
+    The pinrefs to arrayed parts and all contactrefs get the position number
+    appended, and the schematic items with a tag in movedTags (or every item,
+    if movedTags is None) are moved to the position.
+
+    """
+    for item in element.iter():
+        if item.tag == 'pinref' and item.get('part').endswith('_'):
+            item.set('part', item.get('part') + tileHole(holes, 'position', shift=shift))
+        if item.tag == 'contactref':
+            item.set('element', item.get('element') + tileHole(holes, 'position', shift=shift))
+        if movedTags == None or item.tag in movedTags:
+            for key in ['x', 'y', 'x1', 'y1', 'x2', 'y2']:
+                if item.get(key) != None:
+                    item.set(key, tileHole(holes, key[0], float(item.get(key)), shift))
+
+def templateTiles(templates):
+    """ Make a tile for each template, matching stampSchematicTemplate or stampBoardTemplate """
+    holes = []
+    return [compileTile(markTemplate(template, holes), holes) for template in templates]
+
+def itemTiles(items, movedTags=None):
+    """ Make a tile for each item, matching a copy of it made for a position
+
+    See markItems for movedTags. With the default, this matches
+    copySchematicSegment; with no moved tags, copyBoardContactref.
+
+    """
+    holes = []
+    tiles = []
+    for item in items:
+        newItem = copy.deepcopy(item)
+        markItems(newItem, holes, movedTags)
+        tiles.append(compileTile(newItem, holes))
+
+    return tiles
+
+def copySignalTiles(templates):
+    """ Make tiles for the wires and vias that stampBoardCopySignal creates, in the order they are merged """
+    holes = []
+    newSignal = ET.Element("signal")
+    for template in templates:
+        newSignal.append(markTemplate(template, holes))
+
+    return [compileTile(item, holes) for tag in ['wire', 'via'] for item in newSignal.iter(tag)]
+
+def schematicMidTiles(page):
+    """ Make tiles for the nMID_x nets that stampSchematicMidNets creates on a page
+
+    These match the nets created for every position on the page but the
+    first and last, where the chain continues from or onto another page.
+
+    """
+    holes = []
+    newNets = []
+    for inputSheet, inputNet, outputSheet, outputNet in schematicChains:
+        inputHere = inputSheet is page.template.sheet
+        outputHere = outputSheet is page.template.sheet
+        if not (inputHere or outputHere):
+            continue
+
+        name = inputNet.get('name')[:-3] + "MID_" + tileHole(holes, 'position', shift=-1)
+        if inputHere:
+            newNet = copy.deepcopy(inputNet)
+            newNet.set('name', name)
+            markItems(newNet, holes, SCHEMATIC_MOVED_TAGS)
+        else:
+            newNet = copySchematicNetShell(outputNet, name)
+
+        if outputHere:
+            for segment in outputNet.iter('segment'):
+                newSegment = copy.deepcopy(segment)
+                markItems(newSegment, holes, SCHEMATIC_MOVED_TAGS, shift=-1)
+                newNet.append(newSegment)
+
+        newNets.append(newNet)
+
+    return [compileTile(newNet, holes) for newNet in newNets]
+
+def boardMidTiles():
+    """ Make tiles for the nMID_x signals that stampBoardMidSignals creates """
+    holes = []
+    newSignals = []
+    for inputSignal in boardInputSignals:
+        for outputSignal in boardOutputSignals:
+            if inputSignal.get('name')[:-3] == outputSignal.get('name')[:-4]:
+                newSignal = copy.deepcopy(inputSignal)
+                newSignal.set('name', inputSignal.get('name')[:-3] + "MID_"
+                    + tileHole(holes, 'position', shift=-1))
+                markItems(newSignal, holes, ())
+                for contactref in outputSignal.iter('contactref'):
+                    newContactref = copy.deepcopy(contactref)
+                    markItems(newContactref, holes, (), shift=-1)
+                    newSignal.append(newContactref)
+
+                newSignals.append(newSignal)
+
+    return [compileTile(newSignal, holes) for newSignal in newSignals]
+
+def growingNetTiles(template, stampItems):
+    """ Make tiles for the items that a row or column net receives at each position (see streamGrowingNet) """
+    if stampItems is stampSchematicBusSegments:
+        movedTags, tag = SCHEMATIC_MOVED_TAGS, 'segment'
+    else:
+        movedTags, tag = (), 'contactref'
+    newNet = copy.deepcopy(template)
+    holes = []
+    markItems(newNet, holes, movedTags)
+
+    return [compileTile(item, holes) for item in newNet.iter(tag)]
+
+
+##################################################################################
+######## Parallel generation
+##################################################################################
+
+# With more than one job, the board and schematic are generated in their own
+# worker processes. Each of those can split its positions into chunks, which are
+# generated in parallel by a pool of workers. A worker writes the parts of each
+# container that come from its chunk (the new elements, the items added to each
+# existing signal, and the new signals created in the chunk) to temporary files,
+# which are then copied into the output in chunk order as it is streamed. Since
+# each container's children are generated in position order, the output is the
+# same as generating everything in a single process.
+#
+# Workers are forked, so that they share the parsed and inspected designs.
+# Where forking isn't available, everything runs in a single process.
+
+# Number of worker processes available to each document (see configureArray)
+workerJobs = 1
+
+# Smallest number of positions that is split into chunks by default
+MIN_CHUNK_POSITIONS = 256
+
+def forkContext():
+    """ Get the multiprocessing context for forked workers, or None if forking isn't available """
+    # Python 2 has no contexts (and doesn't support the pool as a context manager)
+    try:
+        return multiprocessing.get_context('fork')
+    except (AttributeError, ValueError):
+        return None
+
+def processPool(count):
+    """ Get a pool of worker processes for count independent jobs, or None to run them here """
+    context = forkContext()
+    if workerJobs <= 1 or count <= 1 or context == None:
+        return None
+
+    return context.Pool(min(workerJobs, count))
+
+def splitPositions(first, last):
+    """ Split a range of positions into the chunks that are generated by each worker """
+    count = last - first + 1
+    if args.chunkPositions > 0:
+        size = args.chunkPositions
+    elif workerJobs > 1 and count >= MIN_CHUNK_POSITIONS:
+        size = int(math.ceil(count/float(workerJobs)))
+    else:
+        size = count
+
+    return [range(start, min(start + size, last + 1)) for start in range(first, last + 1, size)]
+
+def writeFragment(children):
+    """ Stream a sequence of children to a temporary file, and return the name of the file """
+    handle, filename = tempfile.mkstemp(suffix='.xml', prefix='make_array_')
+    with io.open(handle, 'w', encoding='utf-8', errors='xmlcharrefreplace') as output:
+        streamChildren(output.write, children)
+
+    return filename
+
+def copyStreamedFile(filename):
+    """ Make a stream child that copies a file written by writeFragment, then deletes it """
+    def write(output):
+        with io.open(filename, 'r', encoding='utf-8') as streamed:
+            for chunk in iter(lambda: streamed.read(1 << 16), u''):
+                output(chunk)
+        os.remove(filename)
+
+    return write
+
+def copyFragments(results, key):
+    """ Make stream children that copy one fragment from each chunk, in chunk order
+
+    Empty fragments are left out (and deleted), so that an element that gets
+    no children is still written as an empty element, as it is by one process.
+
+    """
+    children = []
+    for fragments in results:
+        if os.path.getsize(fragments[key]) == 0:
+            os.remove(fragments[key])
+        else:
+            children.append(copyStreamedFile(fragments[key]))
+    return children
+
+def renderBoardChunk(positions):
+    """ Write the board fragments for a chunk of positions in a worker process
+
+    Returns a dictionary mapping each fragment to its file: 'elements' for the
+    new elements, 'signals' for the new signals, and the index of each
+    existing signal that grows for the items added to it.
+
+    """
+    templatesBySignal, mergedNames = boardSignalGrowth()
+
+    fragments = {'elements': writeFragment(streamStampedTemplates([], boardElementTemplates,
+        stampBoardTemplate, positions))}
+    for number, signal in enumerate(boardSignals):
+        if signal in templatesBySignal or signal.get('name') in mergedNames:
+            fragments[number] = writeFragment(streamBoardSignalItems(signal,
+                templatesBySignal[signal], positions))
+    fragments['signals'] = writeFragment(streamBoardNewSignals(positions))
+
+    return fragments
+
+def renderSchematicChunk(chunk):
+    """ Write the schematic fragments for a chunk of positions in a worker process
+
+    The chunk is a (page number, positions) pair, with a page number of None
+    for the parts. Returns a dictionary mapping each fragment to its file:
+    'parts' for the new parts, or for a page, 'instances' for the new
+    instances, 'nets' for the new nets, and the index of each existing net
+    that grows for the segments added to it.
+
+    """
+    pageNumber, positions = chunk
+    if pageNumber == None:
+        return {'parts': writeFragment(streamStampedTemplates([], schematicPartTemplates,
+            stampSchematicTemplate, positions))}
+
+    page = schematicPages[pageNumber]
+    templatesByNet, mergedNames = schematicNetGrowth(page)
+
+    fragments = {'instances': writeFragment(streamStampedTemplates([], page.template.instanceTemplates,
+        stampSchematicTemplate, positions))}
+    for number, net in enumerate(page.nets):
+        if net in templatesByNet or net.get('name') in mergedNames:
+            fragments[number] = writeFragment(streamSchematicNetSegments(page, net,
+                templatesByNet[net], positions))
+    fragments['nets'] = writeFragment(streamSchematicNewNets(page, positions))
+
+    return fragments
+
+def stitchBoardSignals(results):
+    """ Generate the signals of the arrayed board from the fragments written by each chunk """
+    templatesBySignal, mergedNames = boardSignalGrowth()
+
+    for number, signal in enumerate(boardSignals):
+        if signal in templatesBySignal or signal.get('name') in mergedNames:
+            yield (signal, itertools.chain(
+                signal,
+                copyFragments(results, number)))
+        else:
+            yield signal
+
+    for child in copyFragments(results, 'signals'):
+        yield child
+
+def stitchSchematicPage(page, results):
+    """ Generate the children of a schematic page's sheet from the fragments written by each chunk """
+    templatesByNet, mergedNames = schematicNetGrowth(page)
+
+    for child in page.sheet:
+        if child is page.instances:
+            yield (child, itertools.chain(page.instances, copyFragments(results, 'instances')))
+        elif child is page.nets:
+            nets = []
+            for number, net in enumerate(page.nets):
+                if net in templatesByNet or net.get('name') in mergedNames:
+                    nets.append((net, itertools.chain(
+                        net,
+                        copyFragments(results, number))))
+                else:
+                    nets.append(net)
+            yield (child, nets + copyFragments(results, 'nets'))
+        else:
+            yield child
+
+def streamBoard(filename):
+    """ Write the arrayed board, generating the new elements and signals as it goes """
+    chunks = splitPositions(1, lastPosition)
+    pool = processPool(len(chunks))
+    if pool == None:
+        streamDocument(Board, filename, {
+            boardElements: lambda: streamStampedTemplates(boardElements, boardElementTemplates,
+                stampBoardTemplate, range(1, lastPosition + 1)),
+            boardSignals: streamBoardSignals,
+        })
+        return
+
+    with pool:
+        results = pool.map(renderBoardChunk, chunks)
+
+    streamDocument(Board, filename, {
+        boardElements: lambda: itertools.chain(boardElements, copyFragments(results, 'elements')),
+        boardSignals: lambda: stitchBoardSignals(results),
+    })
+
+def streamSchematic(filename):
+    """ Write the arrayed schematic, generating the new parts, instances and nets as it goes """
+    chunks = [(None, positions) for positions in splitPositions(1, lastPosition)]
+    for pageNumber, page in enumerate(schematicPages):
+        chunks += [(pageNumber, positions) for positions in splitPositions(page.first, page.last)]
+
+    pool = processPool(len(chunks))
+    if pool == None:
+        expansions = {
+            schematicParts: lambda: streamStampedTemplates(schematicParts, schematicPartTemplates,
+                stampSchematicTemplate, range(1, lastPosition + 1)),
+        }
+        for page in schematicPages:
+            expansions[page.sheet] = lambda page=page: streamSchematicPage(page)
+        streamDocument(Schematic, filename, expansions)
+        return
+
+    with pool:
+        results = pool.map(renderSchematicChunk, chunks)
+
+    resultsByPage = collections.defaultdict(list)
+    for (pageNumber, positions), fragments in zip(chunks, results):
+        resultsByPage[pageNumber].append(fragments)
+
+    expansions = {
+        schematicParts: lambda: itertools.chain(schematicParts, copyFragments(resultsByPage[None], 'parts')),
+    }
+    for pageNumber, page in enumerate(schematicPages):
+        expansions[page.sheet] = lambda page=page, pageNumber=pageNumber: stitchSchematicPage(page,
+            resultsByPage[pageNumber])
+    streamDocument(Schematic, filename, expansions)
+
+def runDocumentProcesses(functions):
+    """ Run each function in its own worker process, splitting the jobs between them
+
+    Without more than one job, or where forking isn't available, the functions
+    are run one after the other in this process.
+
+    """
+    global workerJobs
+
+    context = forkContext()
+    if args.jobs <= 1 or context == None or profile != None:
+        for function in functions:
+            function()
+        return
+
+    workerJobs = max(1, args.jobs//len(functions))
+    processes = [context.Process(target=function) for function in functions]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    if any(process.exitcode != 0 for process in processes):
+        raise SystemExit("Error generating the arrayed designs")
+
+
+##################################################################################
+######## New part creation phase
+##################################################################################
+
+
+def configureArray():
+    """ Set up the positions for the array described by the current options
+
+    Create a new part for each array position, that is:
+    * Shifted in the x and y directions
+    * Renamed according to it's instantion number
+
+    """
+    global lastPosition, schematicPages, workerJobs
+
+    with profiling('phases', 'new part creation'):
+        lastPosition = args.rows*args.cols
+        workerJobs = args.jobs if forkContext() != None and profile == None else 1
+
+        # Compute the placement of every position up front, and of the copy region
+        buildPlacementTable()
+        compileBoardCopyRegion()
+        boardPointCache.clear()
+
+        # Split the positions into schematic pages (normally, one for each sheet)
+        schematicPages = createSchematicPages()
+
+def createSchematic():
+    """ Create the new parts, instances and nets of the arrayed schematic """
+    # Create copies of the schematic instances, update existing nets, and add
+    # intermediate nets, one page at a time.
+    generateSchematicPages()
+
+    # Create copies of the schematic parts
+    for position in range(1, lastPosition + 1):
+        createSchematicParts(position)
+
+def createBoard():
+    """ Create the new elements and signals of the arrayed board """
+    buses = boardBusNames()
+    for position in range(1, lastPosition + 1):
+        # Create copies of the board elements, update existing signals, and add intermediate
+        # signals to transfer data between positions
+        createBoardElements(position)
+        updateBoardSignals(position)
+        createBoardInterconnectSignals(position, buses)
+        createBoardCopySignals(position)
+
+
+##################################################################################
+######## Write out phase
+##################################################################################
+
+# The arrayed designs are built in memory and written out, unless streaming or tiled
+# output was requested, or the designs were parsed lazily (the unparsed sections can
+# only be copied while streaming). When there are workers to split chunks between,
+# the designs are always streamed, since the chunks are stitched together as the
+# output is written.
+def streamedOutput():
+    """ Check if the arrayed designs are generated as they are written, rather than built in memory first """
+    return args.stream or args.tiled or args.lazy or workerJobs > 1
+
+def buildBoard():
+    """ Create the new elements and signals of the arrayed board in memory, unless the output is streamed """
+    if not streamedOutput():
+        with profiling('phases', 'new part creation'):
+            createBoard()
+
+def saveBoard(filename):
+    """ Write out the arrayed board, creating the new elements and signals as they are written if the output is streamed """
+    with profiling('phases', 'write out'):
+        if streamedOutput():
+            streamBoard(filename)
+        else:
+            writeXml(Board, filename)
+
+def writeBoard(filename):
+    """ Generate and write out the arrayed board """
+    buildBoard()
+    saveBoard(filename)
+
+def buildSchematic():
+    """ Create the new parts, instances and nets of the arrayed schematic in memory, unless the output is streamed """
+    if not streamedOutput():
+        with profiling('phases', 'new part creation'):
+            createSchematic()
+
+def saveSchematic(filename):
+    """ Write out the arrayed schematic, creating the new parts, instances and nets as they are written if the output is streamed """
+    with profiling('phases', 'write out'):
+        if streamedOutput():
+            streamSchematic(filename)
+        else:
+            writeXml(Schematic, filename)
+
+def writeSchematic(filename):
+    """ Generate and write out the arrayed schematic """
+    buildSchematic()
+    saveSchematic(filename)
+
+def writeArray(outputName):
+    """ Generate and write out the arrayed board and schematic, as outputName.brd and outputName.sch """
+    writeExports()
+    runDocumentProcesses([lambda: writeBoard(outputFile(outputName, ".brd")),
+        lambda: writeSchematic(outputFile(outputName, ".sch"))])
+
+    if args.check:
+        checkTemplateReferences(outputName)
+    if args.verify:
+        verifyArray(outputName)
+
+# The attributes that name an arrayed (template) part or element, by tag
+TEMPLATE_REFERENCES = {
+    'part': 'name', 'instance': 'part', 'pinref': 'part',
+    'element': 'name', 'contactref': 'element',
+}
+
+def templateReference(element):
+    """ Describe the template that an element refers to, or return None if it doesn't refer to one """
+    key = TEMPLATE_REFERENCES.get(element.tag)
+    if key != None and element.get(key, '').endswith('_'):
+        return "%s '%s'"%(element.tag, element.get(key))
+    return None
+
+def checkTemplateReferences(outputName):
+    """ Check that no reference to a template survived into outputName.brd or outputName.sch
+
+    The templates are detached from the design when it is inspected, so this
+    should never fail; it raises an AssertionError if it does.
+
+    """
+    for filename in [designFile(outputName, ".brd"), designFile(outputName, ".sch")]:
+        for element in iterparseXml(filename):
+            reference = templateReference(element)
+            if reference != None:
+                raise AssertionError("%s still refers to the template %s"%(filename, reference))
+            element.clear()
+
+
+##################################################################################
+######## Script output
+##################################################################################
+
+# With --script, the array is written as an Eagle command script (eg:
+# led_example_array.scr) instead of as a new board and schematic. Run on the
+# original design (SCRIPT, in its schematic editor), the script builds the array
+# in place:
+# * The templates become the first position: the arrayed parts and nets are
+#   renamed (NAME) to what the first position calls them.
+# * The parts for the other positions are added to the schematic (ADD, and
+#   INVOKE for further gates), and their nets are drawn (NET).
+# * On the board, which Eagle keeps consistent with the schematic, the new
+#   elements are moved and rotated into place (MOVE, ROTATE), and the copy region
+#   is drawn for each position (WIRE, VIA). The signals follow from the nets.
+# * If the layout, placements file or chain order puts the first position
+#   somewhere other than the origin, the template elements are moved too. Their
+#   copy region would have to be redrawn, which a script can't do reliably, so
+#   such arrays are refused if the copy region has anything in it.
+#
+# The commands are made from the elements that the stamping functions build for
+# the XML output, and written out as they are generated. Junctions are left for
+# Eagle to set, and net labels and part attributes other than the value aren't
+# carried over.
+
+def scriptName(name):
+    """ Quote a name for a script command """
+    return u"'%s'"%(name.replace("'", "''"))
+
+def scriptPoint(element, xKey='x', yKey='y'):
+    """ Format a point of an element for a script command """
+    return u"(%.10g %.10g)"%(float(element.get(xKey)), float(element.get(yKey)))
+
+def scriptWire(element):
+    """ Format the end points of a wire (and its curve, if any) for a script command """
+    curve = u""
+    if element.get('curve') != None:
+        curve = u" %+g"%(float(element.get('curve')))
+    return scriptPoint(element, 'x1', 'y1') + curve + u" " + scriptPoint(element, 'x2', 'y2')
+
+def scriptDeviceName(part):
+    """ Name a part's device for ADD: the device set, with the technology and package variant filled in """
+    name = part.get('deviceset')
+    for placeholder, value in (('*', part.get('technology', '')), ('?', part.get('device', ''))):
+        if placeholder in name:
+            name = name.replace(placeholder, value)
+        else:
+            name += value
+    return name + "@" + part.get('library')
+
+def arrayedNetName(name, position):
+    """ Name of the net (or signal) that an arrayed net becomes at a position, or the name of a non-array net """
+    if name.endswith("IN_"):
+        return name[:-1] if position == 1 else name[:-3] + "MID_%i"%(position-1)
+    if name.endswith("OUT_"):
+        return name[:-1] if position == lastPosition else name[:-4] + "MID_%i"%(position)
+    if name.endswith("ROW_"):
+        return name[:-1] + "%i"%((position-1)//args.cols)
+    if name.endswith("COL_"):
+        return name[:-1] + "%i"%((position-1)%args.cols)
+    return name
+
+def scriptNet(name, net):
+    """ Generate the commands that draw the wires of a net (or net segment) """
+    for wire in net.iter('wire'):
+        yield u"NET %s %s;"%(scriptName(name), scriptWire(wire))
+
+def scriptSchematicPosition(sheet, position, added):
+    """ Generate the commands that add a position's instances and nets to a sheet
+
+    Parts whose name is in added already have a gate on an earlier sheet,
+    so their gates are invoked rather than added.
+
+    """
+    parts = dict((template.name, template.attrib) for template in schematicPartTemplates)
+    for template in sheet.instanceTemplates:
+        instance = stampSchematicTemplate(template, position)
+        name = instance.get('part')
+        orientation = instance.get('rot', 'R0')
+        if template.name in added:
+            yield u"INVOKE %s %s %s %s;"%(scriptName(name), scriptName(instance.get('gate')),
+                orientation, scriptPoint(instance))
+            continue
+
+        part = parts[template.name]
+        yield u"ADD %s %s %s %s %s;"%(scriptName(scriptDeviceName(part)), scriptName(name),
+            scriptName(instance.get('gate')), orientation, scriptPoint(instance))
+        if part.get('value') != None:
+            yield u"VALUE %s %s;"%(scriptName(name), scriptName(part.get('value')))
+
+    for net, segment in sheet.netTemplates:
+        for command in scriptNet(net.get('name'), copySchematicSegment(segment, position)):
+            yield command
+
+    for inputSheet, inputNet, outputSheet, outputNet in schematicChains:
+        if inputSheet is sheet.sheet:
+            name = arrayedNetName(inputNet.get('name'), position)
+            for command in scriptNet(name, stampSchematicNet(inputNet, name, position)):
+                yield command
+        if outputSheet is sheet.sheet and position < lastPosition:
+            name = arrayedNetName(outputNet.get('name'), position)
+            for command in scriptNet(name, stampSchematicNet(outputNet, name, position)):
+                yield command
+
+    arrayedNets = list(sheet.rowNets) + list(sheet.colNets)
+    if position == lastPosition:
+        arrayedNets += list(sheet.outputNets)
+    for net in arrayedNets:
+        name = arrayedNetName(net.get('name'), position)
+        for command in scriptNet(name, stampSchematicNet(net, name, position)):
+            yield command
+
+def scriptBoardElements(position):
+    """ Generate the commands that move and rotate a position's elements into place on the board """
+    for template in boardElementTemplates:
+        element = stampBoardTemplate(template, position)
+        yield u"MOVE %s %s;"%(scriptName(element.get('name')), scriptPoint(element))
+        if element.get('rot') != None:
+            yield u"ROTATE =%s %s;"%(element.get('rot'), scriptName(element.get('name')))
+
+def scriptBoardPosition(position, settings):
+    """ Generate the commands that place a position's elements, and draw its copy region, on the board
+
+    settings holds the current layer and drill, so that they are only
+    changed when they need to be.
+
+    """
+    for command in scriptBoardElements(position):
+        yield command
+
+    for name, templates in boardCopySignalTemplates:
+        name = scriptName(arrayedNetName(name, position))
+        for template in templates:
+            item = stampBoardTemplate(template, position)
+            if item.tag == 'wire':
+                if settings.get('layer') != item.get('layer'):
+                    settings['layer'] = item.get('layer')
+                    yield u"LAYER %s;"%(item.get('layer'))
+                yield u"WIRE %s %s %s;"%(name, item.get('width'), scriptWire(item))
+            elif item.tag == 'via':
+                if settings.get('drill') != item.get('drill'):
+                    settings['drill'] = item.get('drill')
+                    yield u"CHANGE DRILL %s;"%(item.get('drill'))
+                options = [item.get(key) for key in ('diameter', 'shape', 'extent')
+                    if item.get(key) != None]
+                yield u"VIA %s %s;"%(u" ".join([name] + options), scriptPoint(item))
+
+def scriptCommands():
+    """ Generate the commands of a script that builds the array in the original design """
+    yield u"# Generated by make_array.py: a %ix%i array of %s"%(args.rows, args.cols,
+        os.path.basename(args.filepath))
+    yield u"GRID MM;"
+    yield u"SET WIRE_BEND 2;"
+    yield u"SET CONFIRM YES;"
+
+    # The templates become the first position
+    for template in schematicPartTemplates:
+        yield u"NAME %s %s;"%(scriptName(template.name), scriptName(template.name + "1"))
+
+    # Parts that have instances on more than one sheet are added on the first
+    # of them, and invoked on the rest
+    added = set()
+    for number, sheet in enumerate(schematicSheets):
+        if not hasArrayedContent(sheet):
+            continue
+        yield u"EDIT .s%i;"%(number + 1)
+        for net in itertools.chain(sheet.inputNets, sheet.outputNets, sheet.rowNets, sheet.colNets):
+            yield u"NAME %s %s;"%(scriptName(net.get('name')),
+                scriptName(arrayedNetName(net.get('name'), 1)))
+        for position in range(2, lastPosition + 1):
+            for command in scriptSchematicPosition(sheet, position, added):
+                yield command
+        added.update(template.name for template in sheet.instanceTemplates)
+
+    yield u"EDIT .brd;"
+    if boardOffset(1) != (0, 0, 0):
+        for command in scriptBoardElements(1):
+            yield command
+    settings = {}
+    for position in range(2, lastPosition + 1):
+        for command in scriptBoardPosition(position, settings):
+            yield command
+
+    yield u"SET CONFIRM OFF;"
+    yield u"GRID LAST;"
+
+def writeScript(filename):
+    """ Generate and write out a script that builds the array in the original design """
+    if args.sheetPositions > 0:
+        raise SystemExit("Arrays that are split across sheets can't be written as scripts")
+    if boardOffset(1) != (0, 0, 0) and len(boardCopySignalTemplates) > 0:
+        raise SystemExit("The first position isn't at the origin, so the copy region of the templates can't be moved there by a script")
+
+    with profiling('phases', 'write out'):
+        with io.open(filename, 'w', encoding='utf-8') as output:
+            for command in scriptCommands():
+                output.write(command + u"\n")
+
+
+##################################################################################
+######## Exports
+##################################################################################
+
+# The assembly data for the arrayed board can be exported alongside it: the pick
+# and place positions of the elements (-pnp), a bill of materials (-bom), and the
+# pads joined by each signal (-netlist). Each is written as CSV, or as JSON if the
+# file name ends in .json. They are made from the templates, with the same
+# placement and naming as the generated board, so the output never has to be read
+# back. The rows are written as they are generated, except for the bill of
+# materials, which has to group the elements first.
+
+def exportValue(value):
+    """ Format a value for a CSV row, quoting it if needed """
+    value = u"%s"%(value)
+    if any(character in value for character in u',"\n'):
+        value = u'"%s"'%(value.replace(u'"', u'""'))
+    return value
+
+def writeExport(filename, fields, rows):
+    """ Write rows (lists of values, in the order of fields) to a CSV or JSON file """
+    asJSON = filename.lower().endswith('.json')
+    with io.open(filename, 'w', encoding='utf-8') as output:
+        if asJSON:
+            output.write(u"[")
+        else:
+            output.write(u",".join(fields) + u"\n")
+
+        separator = u"\n"
+        for row in rows:
+            if asJSON:
+                record = collections.OrderedDict(zip(fields, row))
+                output.write(separator + u"%s"%(json.dumps(record)))
+                separator = u",\n"
+            else:
+                output.write(u",".join(exportValue(value) for value in row) + u"\n")
+
+        if asJSON:
+            output.write(u"\n]\n")
+
+def arrayedElements():
+    """ Generate the elements of the arrayed board: the existing ones, then those of each position """
+    for element in boardElements:
+        yield element
+    for position in range(1, lastPosition + 1):
+        for template in boardElementTemplates:
+            yield stampBoardTemplate(template, position)
+
+def pickAndPlaceRows():
+    """ Generate the name, value, package, position, rotation and side of each element """
+    for element in arrayedElements():
+        rotation = element.get('rot', 'R0')
+        yield [element.get('name'), element.get('value', ''), element.get('package'),
+            float(element.get('x')), float(element.get('y')),
+            float(rotation.lstrip('MSR')), 'bottom' if 'M' in rotation else 'top']
+
+def billOfMaterialsRows():
+    """ Generate the quantity, value, package, library and names of each kind of element """
+    groups = collections.OrderedDict()
+    for element in arrayedElements():
+        key = (element.get('value', ''), element.get('package'), element.get('library'))
+        groups.setdefault(key, []).append(element.get('name'))
+
+    for (value, package, library), names in groups.items():
+        yield [len(names), value, package, library, u" ".join(names)]
+
+def netlistRows():
+    """ Generate the signal, element and pad of each contactref of the arrayed board """
+    for signal in boardSignals:
+        for contactref in signal.iter('contactref'):
+            yield [signal.get('name'), contactref.get('element'), contactref.get('pad')]
+
+    # The inputs and outputs of positions inside the array only become links if
+    # they are part of a chain (see stampBoardMidSignals)
+    chained = set()
+    for inputSignal in boardInputSignals:
+        for outputSignal in boardOutputSignals:
+            if inputSignal.get('name')[:-3] == outputSignal.get('name')[:-4]:
+                chained.update([inputSignal.get('name'), outputSignal.get('name')])
+
+    templates = [(signal.get('name'), contactref) for signal, contactref in boardSignalTemplates]
+    for signal in itertools.chain(boardInputSignals, boardOutputSignals, boardRowSignals,
+            boardColSignals):
+        templates += [(signal.get('name'), contactref) for contactref in signal.iter('contactref')]
+
+    for position in range(1, lastPosition + 1):
+        for name, contactref in templates:
+            if name.endswith("IN_") and position > 1 and name not in chained:
+                continue
+            if name.endswith("OUT_") and position < lastPosition and name not in chained:
+                continue
+            yield [arrayedNetName(name, position), contactref.get('element') + "%i"%(position),
+                contactref.get('pad')]
+
+def writeExports():
+    """ Write out the exports that were asked for """
+    with profiling('phases', 'exports'):
+        if args.pnp != None:
+            writeExport(args.pnp, ['name', 'value', 'package', 'x', 'y', 'rotation', 'side'],
+                pickAndPlaceRows())
+        if args.bom != None:
+            writeExport(args.bom, ['quantity', 'value', 'package', 'library', 'names'],
+                billOfMaterialsRows())
+        if args.netlist != None:
+            writeExport(args.netlist, ['signal', 'element', 'pad'], netlistRows())
+
+
+##################################################################################
+######## Cost estimate
+##################################################################################
+
+# Before a large array is generated, its cost can be estimated from the inspected
+# design (--dry-run). The templates are counted, and stamped once at a middle
+# position to measure how much each position adds to the output. The time and
+# peak memory for each output mode are then predicted from the output size, using
+# a line fitted to benchmark.py results: the calibration below, or a benchmark
+# report given with -calibration. With -maxMemory or -maxTime, a run that is
+# predicted to go over is switched to an output mode that fits, or refused.
+
+# For each XML backend and output mode, the seconds (after inspection) and the peak
+# memory (MB, less that of the parsed input) of a run, as a line over the output
+# size in MB. Fitted to benchmark.py runs of the example designs (up to 64x64) and
+# a synthetic copy region, with Python 3.11 (and lxml 6.1).
+DRY_RUN_CALIBRATION = {
+    'etree': {
+        'tree': {'seconds': (0.014, 0.124), 'memory': (12.95, 9.70)},
+        'stream': {'seconds': (-0.14, 0.161), 'memory': (14.98, 2.01)},
+        'tiled': {'seconds': (-0.054, 0.071), 'memory': (14.72, 2.00)},
+    },
+    'lxml': {
+        'tree': {'seconds': (-0.096, 0.237), 'memory': (24.21, 22.04)},
+        'stream': {'seconds': (-0.20, 0.265), 'memory': (30.12, 2.10)},
+        'tiled': {'seconds': (-0.026, 0.077), 'memory': (29.55, 2.05)},
+    },
+}
+
+# Peak memory (MB) taken by each MB of parsed input, for each XML backend
+INPUT_MEMORY = {'etree': 13.0, 'lxml': 32.0}
+
+# Output modes, in the order they are tried when a run has to be re-planned
+OUTPUT_MODES = ['tree', 'tiled', 'stream']
+
+def fitLine(points):
+    """ Fit y = a + b*x to a list of (x, y) points by least squares, returning (a, b) """
+    meanX = sum(x for x, y in points)/len(points)
+    meanY = sum(y for x, y in points)/len(points)
+    spread = sum((x - meanX)**2 for x, y in points)
+    if spread == 0:
+        return meanY, 0.0
+    slope = sum((x - meanX)*(y - meanY) for x, y in points)/spread
+    return meanY - slope*meanX, slope
+
+def loadCalibration(filename):
+    """ Fit the time and memory lines for an output mode to the results of a benchmark.py report
+
+    Only the results for the XML backend in use are fitted, and the built-in
+    calibration of that backend is used for the other modes.
+
+    """
+    with open(filename) as calibrationFile:
+        report = json.load(calibrationFile)
+
+    seconds = []
+    memory = []
+    # Results from before there was a choice of backend used ElementTree
+    for result in [result for result in report['results'] if result.get('backend', 'etree') == xmlBackend]:
+        outputMB = (result['boardSize'] + result['schematicSize'])/float(1 << 20)
+        inputMB = result.get('inputSize', 0)/float(1 << 20)
+        seconds.append((outputMB, result['wallTime'] - result['phases']['inspection']))
+        # The peak memory isn't measured everywhere
+        if result['peakMemoryKB'] != None:
+            memory.append((outputMB, result['peakMemoryKB']/1024.0 - INPUT_MEMORY[xmlBackend]*inputMB))
+    if not seconds:
+        raise SystemExit("%s has no results for the %s XML backend"%(filename, xmlBackend))
+
+    calibration = dict(DRY_RUN_CALIBRATION[xmlBackend])
+    calibration[report['mode']] = {'seconds': fitLine(seconds),
+        'memory': fitLine(memory) if memory else calibration[report['mode']]['memory']}
+    return calibration
+
+def outputMode():
+    """ Name the output mode that the current options use """
+    if args.tiled:
+        return 'tiled'
+    if args.stream or args.lazy or workerJobs > 1:
+        return 'stream'
+    return 'tree'
+
+def setOutputMode(mode):
+    """ Switch the current options to an output mode """
+    args.tiled = mode == 'tiled'
+    args.stream = mode == 'stream'
+
+def countTemplates():
+    """ Count the templates that the inspection phases found """
+    sheetCount = lambda field: sum(len(getattr(sheet, field)) for sheet in schematicSheets)
+    boardCopyItems = [template.tag for name, templates in boardCopySignalTemplates
+        for template in templates]
+
+    counts = collections.OrderedDict()
+    counts['parts'] = len(schematicPartTemplates)
+    counts['instances'] = sheetCount('instanceTemplates')
+    counts['elements'] = len(boardElementTemplates)
+    counts['input nets'] = sheetCount('inputNets')
+    counts['output nets'] = sheetCount('outputNets')
+    counts['row nets'] = sheetCount('rowNets')
+    counts['column nets'] = sheetCount('colNets')
+    counts['input signals'] = len(boardInputSignals)
+    counts['output signals'] = len(boardOutputSignals)
+    counts['row signals'] = len(boardRowSignals)
+    counts['column signals'] = len(boardColSignals)
+    counts['non-array net segments'] = sheetCount('netTemplates')
+    counts['non-array net pinrefs'] = sum(1 for sheet in schematicSheets
+        for net, segment in sheet.netTemplates for pinref in segment.iter('pinref'))
+    counts['non-array signal contactrefs'] = len(boardSignalTemplates)
+    counts['copy region wires'] = boardCopyItems.count('wire')
+    counts['copy region vias'] = boardCopyItems.count('via')
+    return counts
+
+def predictOutput():
+    """ Predict the contents and size (in bytes) of the arrayed designs
+
+    Each kind of template is stamped once, at a middle position, and its
+    serialized size taken as the size of every copy.
+
+    """
+    position = (lastPosition + 1)//2
+    size = lambda element: len(ET.tostring(element))
+    rows, cols = args.rows, args.cols
+
+    sheetNets = lambda field: [net for sheet in schematicSheets for net in getattr(sheet, field)]
+    arrayedNets = sheetNets('inputNets') + sheetNets('outputNets') + sheetNets('rowNets') + sheetNets('colNets')
+    arrayedSignals = (list(boardInputSignals) + list(boardOutputSignals) + list(boardRowSignals)
+        + list(boardColSignals))
+
+    # New nets and signals: the inputs and outputs that aren't merged into an
+    # existing net, a link between each pair of positions for each chain, and one
+    # for each row and column
+    existingNets = set(net.get('name') for sheet in schematicSheets for net in sheet.nets)
+    newNets = (sum(1 for net in sheetNets('inputNets') + sheetNets('outputNets')
+            if net.get('name')[:-1] not in existingNets)
+        + len(schematicChains)*(lastPosition - 1)
+        + rows*len(sheetNets('rowNets')) + cols*len(sheetNets('colNets')))
+    chainSignals = sum(1 for inputSignal in boardInputSignals for outputSignal in boardOutputSignals
+        if inputSignal.get('name')[:-3] == outputSignal.get('name')[:-4])
+    newSignals = (sum(1 for signal in list(boardInputSignals) + list(boardOutputSignals)
+            if signal.get('name')[:-1] not in boardSignalIndex)
+        + chainSignals*(lastPosition - 1)
+        + rows*len(boardRowSignals) + cols*len(boardColSignals))
+
+    stampedNets = [stampSchematicNet(net, net.get('name'), position) for net in arrayedNets]
+    stampedSegments = ([copySchematicSegment(segment, position)
+        for sheet in schematicSheets for net, segment in sheet.netTemplates]
+        + [segment for net in stampedNets for segment in net.iter('segment')])
+    stampedContactrefs = ([copyBoardContactref(contactref, position)
+        for signal, contactref in boardSignalTemplates]
+        + [contactref for signal in arrayedSignals
+            for contactref in stampBoardSignal(signal, signal.get('name'), position).iter('contactref')])
+
+    positionSize = (sum(size(stampSchematicTemplate(template, position))
+            for template in schematicPartTemplates)
+        + sum(size(stampSchematicTemplate(template, position))
+            for sheet in schematicSheets for template in sheet.instanceTemplates)
+        + sum(size(segment) for segment in stampedSegments)
+        + sum(size(stampBoardTemplate(template, position)) for template in boardElementTemplates)
+        + sum(size(contactref) for contactref in stampedContactrefs)
+        + sum(size(stampBoardTemplate(template, position))
+            for name, templates in boardCopySignalTemplates for template in templates))
+
+    # Every new net and signal gets a copy of its template's shell
+    netShell = max([size(copySchematicNetShell(net, net.get('name'))) for net in arrayedNets] + [0])
+    signalShell = max([size(ET.Element('signal', signal.attrib)) for signal in arrayedSignals] + [0])
+
+    inputSize = (documentSize(designFile(args.filepath, ".sch"))
+        + documentSize(designFile(args.filepath, ".brd")))
+
+    prediction = collections.OrderedDict()
+    prediction['parts'] = len(schematicParts) + lastPosition*len(schematicPartTemplates)
+    prediction['instances'] = (sum(len(sheet.instances) for sheet in schematicSheets)
+        + lastPosition*sum(len(sheet.instanceTemplates) for sheet in schematicSheets))
+    prediction['elements'] = len(boardElements) + lastPosition*len(boardElementTemplates)
+    prediction['nets'] = sum(len(sheet.nets) for sheet in schematicSheets) + newNets
+    prediction['segments'] = (sum(1 for sheet in schematicSheets for net in sheet.nets
+        for segment in net.iter('segment')) + lastPosition*len(stampedSegments))
+    prediction['signals'] = len(boardSignals) + newSignals
+    prediction['contactrefs'] = (sum(1 for signal in boardSignals
+        for contactref in signal.iter('contactref')) + lastPosition*len(stampedContactrefs))
+    prediction['copy region wires and vias'] = lastPosition*sum(len(templates)
+        for name, templates in boardCopySignalTemplates)
+    prediction['input bytes'] = inputSize
+    prediction['output bytes'] = (inputSize + lastPosition*positionSize
+        + newNets*netShell + newSignals*signalShell)
+    return prediction
+
+def estimateArray(inspectionSeconds, calibration):
+    """ Estimate the time (in seconds) and peak memory (in MB) of generating the array in each output mode """
+    prediction = predictOutput()
+    inputMB = prediction['input bytes']/float(1 << 20)
+    outputMB = prediction['output bytes']/float(1 << 20)
+
+    estimates = collections.OrderedDict()
+    for mode in OUTPUT_MODES:
+        seconds = calibration[mode]['seconds']
+        memory = calibration[mode]['memory']
+        estimates[mode] = (inspectionSeconds + max(0.0, seconds[0] + seconds[1]*outputMB),
+            INPUT_MEMORY[xmlBackend]*inputMB + memory[0] + memory[1]*outputMB)
+
+    return prediction, estimates
+
+def formatEstimate(counts, prediction, estimates):
+    """ Format the template counts, predicted output and estimates as a table """
+    lines = ['Dry run of a %ix%i array of %s'%(args.rows, args.cols, args.filepath), '', 'Templates']
+    for name, count in counts.items():
+        lines.append('  %-34s %12i'%(name, count))
+
+    lines += ['', 'Predicted output']
+    for name, count in prediction.items():
+        lines.append('  %-34s %12i'%(name, count))
+
+    lines += ['', '%-36s %12s %12s'%('Estimates', 'Time (s)', 'Peak (MB)')]
+    for mode, (seconds, memory) in estimates.items():
+        label = mode + (' (selected)' if mode == outputMode() else '')
+        lines.append('  %-34s %12.1f %12.0f'%(label, seconds, memory))
+
+    return '\n'.join(lines)
+
+def planArray(estimates):
+    """ Check the estimates against -maxMemory and -maxTime, switching the output mode if needed
+
+    The selected mode is kept if it fits; otherwise the first mode that fits
+    is used instead. If none fits, the run is refused.
+
+    """
+    fits = lambda mode: ((args.maxMemory == None or estimates[mode][1] <= args.maxMemory)
+        and (args.maxTime == None or estimates[mode][0] <= args.maxTime))
+
+    selected = outputMode()
+    if fits(selected):
+        return
+
+    for mode in OUTPUT_MODES:
+        if fits(mode):
+            print("Generating in %s mode, since %s mode is estimated to take %.1fs and %.0fMB"%(mode,
+                selected, estimates[selected][0], estimates[selected][1]))
+            setOutputMode(mode)
+            return
+
+    raise SystemExit("The array is estimated to take at least %.1fs and %.0fMB, over the limits"%(
+        min(seconds for seconds, memory in estimates.values()),
+        min(memory for seconds, memory in estimates.values())))
+
+def estimateLoadedArray(inspectionSeconds):
+    """ Estimate the loaded array as estimateArray, with the -calibration results or the built-in calibration """
+    calibration = DRY_RUN_CALIBRATION[xmlBackend]
+    if args.calibration != None:
+        calibration = loadCalibration(args.calibration)
+    return estimateArray(inspectionSeconds, calibration)
+
+def generateArray(designName, outputName):
+    """ Load the design and write out the array, in an output mode that fits -maxMemory and -maxTime """
+    start = timer()
+    loadDesign(designName)
+    configureArray()
+    if args.maxMemory != None or args.maxTime != None:
+        prediction, estimates = estimateLoadedArray(timer() - start)
+        planArray(estimates)
+    writeArray(outputName)
+
+
+##################################################################################
+######## Verification
+##################################################################################
+
+# The verifier (--verify, or -verifyOutput for an earlier output) checks the
+# connectivity of the arrayed designs, without having to open them in Eagle. Each
+# output file is read once, into a union-find over its pins (or pads) and its nets
+# (or signals, which are joined by name, as Eagle joins them across sheets). Then
+# the schematic and board are each checked for:
+# * the parts (or elements) of every position
+# * the serial chains: the input at position 1, each nMID_x joining the output of
+#   position x to the input of x+1, and the output at the last position
+# * the row and column nets, and the non-array nets that every position joins
+# * shorts between any two of the chain, row and column nets
+# * references to the templates
+# and the two are checked to agree on which parts each net connects. All of this
+# is near-linear in the size of the output.
+
+# Problems to list, before summarizing the rest
+VERIFY_MAX_PROBLEMS = 20
+
+# The connectivity of an output file. The union-find is held in parents and sizes;
+# nets are (None, name) nodes, and pins are tuples of their identifying attributes.
+# netParts holds the parts connected to each net, by name.
+Netlist = collections.namedtuple('Netlist', ['parents', 'sizes', 'netParts', 'parts', 'references'])
+
+def findComponent(netlist, node):
+    """ Find the representative of the connected component that a pin or net is in """
+    parents = netlist.parents
+    while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+    return node
+
+def joinComponents(netlist, a, b):
+    """ Join the connected components of two pins or nets, adding them if they are new """
+    for node in (a, b):
+        if node not in netlist.parents:
+            netlist.parents[node] = node
+            netlist.sizes[node] = 1
+
+    a = findComponent(netlist, a)
+    b = findComponent(netlist, b)
+    if a == b:
+        return
+    if netlist.sizes[a] < netlist.sizes[b]:
+        a, b = b, a
+    netlist.parents[b] = a
+    netlist.sizes[a] += netlist.sizes[b]
+
+def readNetlist(filename, netTag, pinTag, pinKeys, partTag):
+    """ Read the connectivity of an output file
+
+    Each pinTag element (pinref or contactref) is a pin, identified by its
+    pinKeys attributes, the first of which names its part. Pins are joined
+    to the netTag element (net or signal) that holds them. The names of the
+    partTag elements, and any references to templates, are collected too.
+
+    """
+    netlist = Netlist({}, {}, collections.defaultdict(set), set(), [])
+    pins = []
+    for element in iterparseXml(filename):
+        if element.tag == pinTag:
+            pins.append(tuple(element.get(key) for key in pinKeys))
+        elif element.tag == netTag:
+            name = element.get('name')
+            joinComponents(netlist, (None, name), (None, name))
+            for pin in pins:
+                joinComponents(netlist, (None, name), pin)
+                netlist.netParts[name].add(pin[0])
+            pins = []
+        elif element.tag == partTag:
+            netlist.parts.add(element.get('name'))
+
+        reference = templateReference(element)
+        if reference != None:
+            netlist.references.append(reference)
+        element.clear()
+
+    return netlist
+
+def templatePins(item, pinTag, pinKeys, position):
+    """ List the pins of an item's pinTag elements that are on arrayed parts, for a position """
+    pins = []
+    for pin in item.iter(pinTag):
+        values = [pin.get(key) for key in pinKeys]
+        if values[0].endswith('_'):
+            values[0] += "%i"%(position)
+            pins.append(tuple(values))
+    return pins
+
+def verifyNetlist(netlist, label, templateParts, pins, chains, rowNets, colNets, sharedNets, problem):
+    """ Check the connectivity of one output against the design
+
+    templateParts are the names of the arrayed parts (or elements), and
+    pins(item, position) lists an item's pins for a position. chains are
+    (input, output) net pairs, and sharedNets are (net, template) pairs of
+    the non-array nets and the items copied into them for each position.
+    Each problem found is passed to problem().
+
+    """
+    for name in templateParts:
+        missing = [name + "%i"%(position) for position in range(1, lastPosition + 1)
+            if name + "%i"%(position) not in netlist.parts]
+        if missing:
+            problem("%s: %i copies of %s are missing, eg: %s"%(label, len(missing), name, missing[0]))
+
+    def connected(name, expected, kind):
+        """ Check that pins are connected to a net, returning the net's component """
+        if (None, name) not in netlist.parents:
+            problem("%s: %s net %s is missing"%(label, kind, name))
+            return None
+        component = findComponent(netlist, (None, name))
+        for pin in expected:
+            if pin not in netlist.parents or findComponent(netlist, pin) != component:
+                problem("%s: %s isn't connected to %s net %s"%(label, '/'.join(pin), kind, name))
+        return component
+
+    # The chain, row and column nets must each be a component of their own
+    arrayNets = {}
+    def arrayNet(name, expected, kind):
+        component = connected(name, expected, kind)
+        if component != None and arrayNets.setdefault(component, name) != name:
+            problem("%s: %s net %s is shorted to %s"%(label, kind, name, arrayNets[component]))
+
+    for inputNet, outputNet in chains:
+        arrayNet(inputNet.get('name')[:-1], pins(inputNet, 1), 'input')
+        for position in range(1, lastPosition):
+            arrayNet(inputNet.get('name')[:-3] + "MID_%i"%(position),
+                pins(outputNet, position) + pins(inputNet, position + 1), 'chain')
+        arrayNet(outputNet.get('name')[:-1], pins(outputNet, lastPosition), 'output')
+
+    for net in rowNets:
+        for first in range(1, lastPosition + 1, args.cols):
+            arrayNet(rowNetName(net, first), [pin for position in range(first,
+                min(first + args.cols, lastPosition + 1)) for pin in pins(net, position)], 'row')
+    for net in colNets:
+        for first in range(1, min(args.cols, lastPosition) + 1):
+            arrayNet(colNetName(net, first), [pin for position in range(first, lastPosition + 1,
+                args.cols) for pin in pins(net, position)], 'column')
+
+    expectedByNet = collections.OrderedDict()
+    for net, template in sharedNets:
+        expected = expectedByNet.setdefault(net.get('name'), [])
+        for position in range(1, lastPosition + 1):
+            expected += pins(template, position)
+    for name, expected in expectedByNet.items():
+        connected(name, expected, 'shared')
+
+    if netlist.references:
+        problem("%s: %i references to templates remain, eg: %s"%(label, len(netlist.references),
+            netlist.references[0]))
+
+def compareNetlists(schematic, board, problem):
+    """ Check that each net connects the same parts in the schematic as on the board
+
+    Parts without a board element (supply symbols, frames, etc) are ignored.
+
+    """
+    for name in sorted(set(schematic.netParts) | set(board.netParts)):
+        schematicParts = schematic.netParts.get(name, set()) & board.parts
+        boardParts = board.netParts.get(name, set())
+        if schematicParts != boardParts:
+            problem("net %s differs between the schematic and board: %s only in the schematic, %s only on the board"%(
+                name, sorted(schematicParts - boardParts)[:3], sorted(boardParts - schematicParts)[:3]))
+
+def verifyArray(outputName):
+    """ Verify the connectivity of outputName.sch and outputName.brd against the loaded design and options
+
+    Prints a summary, or raises SystemExit listing the problems found.
+
+    """
+    problems = []
+
+    schematic = readNetlist(designFile(outputName, ".sch"), 'net', 'pinref', ['part', 'gate', 'pin'], 'part')
+    verifyNetlist(schematic, 'schematic', [part.get('name') for part in schematicMatrixParts],
+        lambda item, position: templatePins(item, 'pinref', ['part', 'gate', 'pin'], position),
+        [(inputNet, outputNet) for inputSheet, inputNet, outputSheet, outputNet in schematicChains],
+        [net for sheet in schematicSheets for net in sheet.rowNets],
+        [net for sheet in schematicSheets for net in sheet.colNets],
+        [pair for sheet in schematicSheets for pair in sheet.netTemplates], problems.append)
+
+    board = readNetlist(designFile(outputName, ".brd"), 'signal', 'contactref', ['element', 'pad'], 'element')
+    verifyNetlist(board, 'board', [element.get('name') for element in boardMatrixElements],
+        lambda item, position: templatePins(item, 'contactref', ['element', 'pad'], position),
+        [(inputSignal, outputSignal) for inputSignal in boardInputSignals for outputSignal in boardOutputSignals
+            if inputSignal.get('name')[:-3] == outputSignal.get('name')[:-4]],
+        list(boardRowSignals), list(boardColSignals), boardSignalTemplates, problems.append)
+
+    compareNetlists(schematic, board, problems.append)
+
+    if problems:
+        for text in problems[:VERIFY_MAX_PROBLEMS]:
+            print(text)
+        if len(problems) > VERIFY_MAX_PROBLEMS:
+            print("... and %i more"%(len(problems) - VERIFY_MAX_PROBLEMS))
+        raise SystemExit("%s failed verification, with %i problems"%(outputName, len(problems)))
+
+    print("Verified %s: %i positions, %i schematic nets, %i board signals"%(outputName,
+        lastPosition, len(schematic.netParts), len(board.netParts)))
+
+
+##################################################################################
+######## Incremental resize
+##################################################################################
+
+# An earlier output of this script can be resized without generating it again. The
+# design is loaded as usual, for its templates, but then the positions that were
+# dropped are removed from the earlier output and the new ones are added to it,
+# leaving the rest (and any changes made to it by hand) as it is. The generated
+# parts, instances and elements are recognized by their names: a template name
+# (ending in _) followed by the position number.
+#
+# The positions are numbered row by row, so changing the number of columns
+# renumbers the positions that are kept. Their names, and the nMID_x nets between
+# them, are updated in a single pass over the design. Only the positions that are
+# added get generated, and only the links of the chain that changed are rewired.
+# Zigzag arrays can only change their number of rows, since changing the number of
+# columns moves every other row.
+
+def resizedPosition(position, oldCols, newRows, newCols):
+    """ Find the new number of a position from the earlier array, or None if it is dropped """
+    row = (position-1)//oldCols
+    col = (position-1)%oldCols
+    if row >= newRows or col >= newCols:
+        return None
+    return row*newCols + col + 1
+
+def elementKey(element):
+    """ Describe an element and its children, ignoring whitespace, to find generated copies of it """
+    return (element.tag, tuple(sorted(element.attrib.items())), (element.text or '').strip(),
+        tuple(elementKey(child) for child in element))
+
+def removeMatching(container, items):
+    """ Remove a child of a container that matches (see elementKey) each of the given items """
+    keys = collections.Counter(elementKey(item) for item in items)
+    for child in list(container):
+        key = elementKey(child)
+        if keys[key] > 0:
+            keys[key] -= 1
+            container.remove(child)
+
+def loadResizeTarget(name):
+    """ Parse an earlier output of the loaded design, as the design to add the new positions to """
+    global Schematic, schematicDrawing, schematicParts, schematicSheetList
+    global Board, BoardDrawing, boardElements, boardSignals, boardSignalTemplates
+
+    Schematic = parseXml(designFile(name, ".sch"))
+    schematicDrawing = Schematic.getroot().find("drawing").find("schematic")
+    schematicParts = schematicDrawing.find("parts")
+    schematicSheetList = schematicDrawing.find("sheets")
+    if len(schematicSheetList) != len(schematicSheets):
+        raise SystemExit("%s.sch doesn't have the same sheets as the design"%(name))
+
+    Board = parseXml(designFile(name, ".brd"))
+    BoardDrawing = Board.getroot().find("drawing").find("board")
+    boardElements = BoardDrawing.find("elements")
+    boardSignals = BoardDrawing.find("signals")
+
+    # The non-array signals are found by name; any that were deleted by hand stay deleted
+    signalsByName = dict((signal.get('name'), signal) for signal in reversed(boardSignals))
+    boardSignalTemplates = [(signalsByName[signal.get('name')], contactref)
+        for signal, contactref in boardSignalTemplates if signal.get('name') in signalsByName]
+
+def resizePages():
+    """ Make a page for each sheet of the earlier output, holding every position """
+    pages = []
+    for template, sheet in zip(schematicSheets, schematicSheetList):
+        instances = sheet.find("instances")
+        if instances == None:
+            instances = ET.Element("instances")
+        nets = sheet.find("nets")
+        if nets == None:
+            nets = ET.Element("nets")
+
+        netIndex = {}
+        for net in nets:
+            netIndex.setdefault(net.get('name'), net)
+
+        netTargets = {}
+        for net, segment in template.netTemplates:
+            if net not in netTargets:
+                if net.get('name') not in netIndex:
+                    netIndex[net.get('name')] = copySchematicNetShell(net, net.get('name'))
+                    nets.append(netIndex[net.get('name')])
+                netTargets[net] = netIndex[net.get('name')]
+
+        pages.append(SchematicPage(template, sheet, instances, nets, netIndex, netTargets,
+            1, lastPosition))
+
+    return pages
+
+def removeDroppedPositions(dropped, outputMoves, midNames, emptiedNames, templateNetNames,
+        templateSignalNames):
+    """ Remove everything that was generated for the dropped positions
+
+    Removes the parts, instances and elements of the dropped positions, and
+    everything that refers to them. Stamped segments and copy region wires
+    without such a reference are found by stamping the templates again at
+    their old positions. Also removes the nMID_x nets named in midNames, the
+    output nets of the old last position if outputMoves is set, and the nets
+    named in emptiedNames that the array created but that are now empty.
+
+    """
+    oldLast = lastPosition
+    partNames = set(part.get('name') + "%i"%(position)
+        for part in schematicMatrixParts for position in dropped)
+    elementNames = set(element.get('name') + "%i"%(position)
+        for element in boardMatrixElements for position in dropped)
+
+    for part in list(schematicParts):
+        if part.get('name') in partNames:
+            schematicParts.remove(part)
+
+    for page, netNames in zip(schematicPages, templateNetNames):
+        template = page.template
+        for instance in list(page.instances):
+            if instance.get('part') in partNames:
+                page.instances.remove(instance)
+
+        stamped = collections.defaultdict(list)
+        for position in dropped:
+            for net in template.rowNets:
+                stamped[rowNetName(net, position)] += stampSchematicNet(net,
+                    rowNetName(net, position), position).findall('segment')
+            for net in template.colNets:
+                stamped[colNetName(net, position)] += stampSchematicNet(net,
+                    colNetName(net, position), position).findall('segment')
+        if outputMoves or oldLast in dropped:
+            for net in template.outputNets:
+                stamped[net.get('name')[:-1]] += stampSchematicNet(net,
+                    net.get('name')[:-1], oldLast).findall('segment')
+
+        for net in list(page.nets):
+            name = net.get('name')
+            if name in midNames:
+                page.nets.remove(net)
+                continue
+
+            for segment in list(net):
+                if any(pinref.get('part') in partNames for pinref in segment.iter('pinref')):
+                    net.remove(segment)
+            if name in stamped:
+                removeMatching(net, stamped[name])
+
+            if name in emptiedNames and name not in netNames and len(net.findall('segment')) == 0:
+                page.nets.remove(net)
+
+    for element in list(boardElements):
+        if element.get('name') in elementNames:
+            boardElements.remove(element)
+
+    stamped = collections.defaultdict(list)
+    for position in dropped:
+        for name, templates in boardCopySignalTemplates:
+            stamped[name] += list(stampBoardCopySignal(name, templates, position))
+    if outputMoves:
+        for signal in boardOutputSignals:
+            stamped[signal.get('name')[:-1]] += stampBoardSignal(signal,
+                signal.get('name')[:-1], oldLast).findall('contactref')
+
+    for signal in list(boardSignals):
+        name = signal.get('name')
+        if name in midNames:
+            boardSignals.remove(signal)
+            continue
+
+        for item in list(signal):
+            if item.tag == 'contactref' and item.get('element') in elementNames:
+                signal.remove(item)
+        if name in stamped:
+            removeMatching(signal, stamped[name])
+
+        if (name in emptiedNames and name not in templateSignalNames
+                and len(signal.findall('contactref')) == 0):
+            boardSignals.remove(signal)
+
+def renumberPositions(renumbered, midRenames):
+    """ Rename the parts, instances and elements of the kept positions that were renumbered
+
+    Also renames the nMID_x nets and signals between them, and every
+    reference to them.
+
+    """
+    if len(renumbered) == 0 and len(midRenames) == 0:
+        return
+
+    partNames = {}
+    for part in schematicMatrixParts:
+        for position, newPosition in renumbered.items():
+            partNames[part.get('name') + "%i"%(position)] = part.get('name') + "%i"%(newPosition)
+    elementNames = {}
+    for element in boardMatrixElements:
+        for position, newPosition in renumbered.items():
+            elementNames[element.get('name') + "%i"%(position)] = element.get('name') + "%i"%(newPosition)
+
+    for part in schematicParts:
+        part.set('name', partNames.get(part.get('name'), part.get('name')))
+    for sheet in schematicSheetList:
+        for instance in sheet.iter('instance'):
+            instance.set('part', partNames.get(instance.get('part'), instance.get('part')))
+        for pinref in sheet.iter('pinref'):
+            pinref.set('part', partNames.get(pinref.get('part'), pinref.get('part')))
+        for net in sheet.iter('net'):
+            net.set('name', midRenames.get(net.get('name'), net.get('name')))
+
+    for element in boardElements:
+        element.set('name', elementNames.get(element.get('name'), element.get('name')))
+    for signal in boardSignals:
+        signal.set('name', midRenames.get(signal.get('name'), signal.get('name')))
+        for contactref in signal.iter('contactref'):
+            contactref.set('element', elementNames.get(contactref.get('element'), contactref.get('element')))
+
+def chainPrefixes():
+    """ Find the name prefixes (the n of nMID_x) of the nets and signals that connect each position to the next """
+    prefixes = set(inputNet.get('name')[:-3]
+        for inputSheet, inputNet, outputSheet, outputNet in schematicChains)
+    prefixes.update(inputSignal.get('name')[:-3]
+        for inputSignal in boardInputSignals for outputSignal in boardOutputSignals
+        if inputSignal.get('name')[:-3] == outputSignal.get('name')[:-4])
+    return prefixes
+
+def resizeArray(previousName, oldRows, oldCols, outputName):
+    """ Resize an earlier output of the loaded design from oldRows x oldCols to the current size
+
+    The result is written to outputName.brd and outputName.sch.
+
+    """
+    global args, schematicPages
+
+    if args.sheetPositions > 0:
+        raise SystemExit("Arrays that are split across sheets can't be resized")
+    if args.zigzag and oldCols != args.cols:
+        raise SystemExit("Zigzag arrays can only be resized by changing the number of rows")
+    if args.layout != 'grid' or args.placements != None or args.chainOrder != 'layout':
+        raise SystemExit("Only arrays with the grid layout, chained in layout order, can be resized")
+
+    # Names of the nets and signals that were in the design before it was arrayed
+    templateNetNames = [set(net.get('name') for net in template.nets) for template in schematicSheets]
+    templateSignalNames = set(signal.get('name') for signal in boardSignals)
+
+    loadResizeTarget(previousName)
+
+    newArgs = args
+    oldLast = oldRows*oldCols
+    newLast = newArgs.rows*newArgs.cols
+    newPositions = dict((position, resizedPosition(position, oldCols, newArgs.rows, newArgs.cols))
+        for position in range(1, oldLast + 1))
+
+    dropped = [position for position in range(1, oldLast + 1) if newPositions[position] == None]
+    renumbered = dict((position, newPosition) for position, newPosition in newPositions.items()
+        if newPosition != None and newPosition != position)
+    added = set(range(1, newLast + 1)) - set(newPositions.values())
+
+    # Links in the chain (from a position to the next one) that are kept
+    keptLinks = dict((link, newPositions[link]) for link in range(1, oldLast)
+        if newPositions[link] != None and newPositions[link + 1] == newPositions[link] + 1)
+    outputMoves = newPositions[oldLast] != None and newPositions[oldLast] != newLast
+
+    # Remove and renumber using the old array, with the old placement
+    args = copy.copy(newArgs)
+    args.rows = oldRows
+    args.cols = oldCols
+    configureArray()
+    schematicPages = resizePages()
+
+    with profiling('phases', 'resize'):
+        prefixes = chainPrefixes()
+        midNames = set(prefix + "MID_%i"%(link) for prefix in prefixes
+            for link in range(1, oldLast) if link not in keptLinks)
+        emptiedNames = set()
+        for position in dropped:
+            for net in itertools.chain(boardRowSignals, *[template.rowNets for template in schematicSheets]):
+                emptiedNames.add(rowNetName(net, position))
+            for net in itertools.chain(boardColSignals, *[template.colNets for template in schematicSheets]):
+                emptiedNames.add(colNetName(net, position))
+
+        removeDroppedPositions(dropped, outputMoves, midNames, emptiedNames, templateNetNames,
+            templateSignalNames)
+
+        midRenames = dict((prefix + "MID_%i"%(link), prefix + "MID_%i"%(newLink))
+            for prefix in prefixes for link, newLink in keptLinks.items() if link != newLink)
+        renumberPositions(renumbered, midRenames)
+
+    # Add the new positions, and the links and output that changed, using the new array
+    args = newArgs
+    configureArray()
+    schematicPages = resizePages()
+    indexBoardSignals()
+
+    with profiling('phases', 'new part creation'):
+        for position in sorted(added):
+            createSchematicParts(position)
+            for page in schematicPages:
+                createSchematicInstances(page, position)
+                updateSchematicNets(page, position)
+                createSchematicInterconnectNets(page, position)
+
+            createBoardElements(position)
+            updateBoardSignals(position)
+            createBoardInterconnectSignals(position)
+            createBoardCopySignals(position)
+
+        # The links into an added position were made with it; these are the links
+        # between positions that were kept, but are now next to each other
+        keptTargets = set(keptLinks.values())
+        for link in range(1, newLast):
+            if link not in keptTargets and link + 1 not in added:
+                for page in schematicPages:
+                    for newNet in stampSchematicMidNets(page, link + 1):
+                        addSchematicNet(page, newNet)
+                for newSignal in stampBoardMidSignals(link + 1):
+                    addBoardSignal(newSignal)
+
+        # Likewise, the output is only made with the last position if that was added
+        if newLast not in added and newPositions[oldLast] != newLast:
+            for page in schematicPages:
+                for net in page.template.outputNets:
+                    mergeSchematicNet(page, stampSchematicNet(net, net.get('name')[:-1], newLast))
+            for signal in boardOutputSignals:
+                mergeBoardSignal(stampBoardSignal(signal, signal.get('name')[:-1], newLast),
+                    ['contactref'])
+
+    with profiling('phases', 'write out'):
+        writeXml(Board, outputFile(outputName, ".brd"))
+        writeXml(Schematic, outputFile(outputName, ".sch"))
+
+    if args.check:
+        checkTemplateReferences(outputName)
+    if args.verify:
+        verifyArray(outputName)
+
+
+##################################################################################
+######## Output cache
+##################################################################################
+
+# With -cache, each array that's generated is kept in the cache directory, keyed
+# by a hash of everything the output depends on: the design's .sch and .brd, the
+# options that shape the array, and this script. Generating the same array again
+# just copies the cached files into place, without parsing the design. Entries
+# are evicted least recently used first, once the cache grows past -cacheSize.
+
+# The options that change the output; the others (eg: --stream, -j) only change
+# how it's generated
+CACHE_OPTIONS = ['rows', 'cols', 'zigzag', 'spacingX', 'spacingY', 'schematicSpacingX',
+    'schematicSpacingY', 'boardCopyXMin', 'boardCopyYMin', 'boardCopyXMax', 'boardCopyYMax',
+    'sheetPositions', 'layout', 'chainOrder', 'compress']
+
+def cacheKey(designName):
+    """ Hash the design's files, the array options and this script into a cache key """
+    key = hashlib.sha1()
+    filenames = [os.path.abspath(__file__), designFile(designName, ".sch"), designFile(designName, ".brd")]
+    if args.placements != None:
+        filenames.append(args.placements)
+    for filename in filenames:
+        with open(filename, 'rb') as inputFile:
+            for piece in iter(lambda: inputFile.read(1 << 16), b''):
+                key.update(piece)
+        key.update(b'\x00')
+    options = [(name, getattr(args, name)) for name in CACHE_OPTIONS]
+    # The backends format the output differently
+    options.append(('xmlBackend', args.xmlBackend))
+    key.update(json.dumps(options).encode('utf-8'))
+    return key.hexdigest()
+
+def fetchCachedArray(key, outputName):
+    """ Copy a cached array to outputName.brd and outputName.sch, returning False if it isn't cached """
+    entry = os.path.join(args.cache, key)
+    try:
+        for extension in [".brd", ".sch"]:
+            shutil.copyfile(os.path.join(entry, "array" + extension), outputFile(outputName, extension))
+        # The modification time of the entry marks its last use
+        os.utime(entry, None)
+    except (IOError, OSError):
+        return False
+    return True
+
+def cacheSize(entry):
+    """ Total size, in bytes, of the files in a cache entry """
+    return sum(os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry))
+
+def storeCachedArray(key, outputName):
+    """ Add the array written to outputName.brd and outputName.sch to the cache, then evict old entries """
+    if not os.path.isdir(args.cache):
+        os.makedirs(args.cache)
+
+    # Fill the entry under a temporary name, so that it only appears once it's complete
+    staging = tempfile.mkdtemp(prefix='.make_array_', dir=args.cache)
+    for extension in [".brd", ".sch"]:
+        shutil.copyfile(outputFile(outputName, extension), os.path.join(staging, "array" + extension))
+    try:
+        os.rename(staging, os.path.join(args.cache, key))
+    except OSError:
+        # Another run stored the same array first
+        shutil.rmtree(staging)
+
+    evictCachedArrays()
+
+def evictCachedArrays():
+    """ Remove the least recently used entries until the cache fits in -cacheSize """
+    entries = []
+    for name in os.listdir(args.cache):
+        entry = os.path.join(args.cache, name)
+        if name.startswith('.') or not os.path.isdir(entry):
+            continue
+        try:
+            entries.append((os.path.getmtime(entry), cacheSize(entry), entry))
+        except OSError:
+            # Evicted by another run
+            continue
+
+    total = sum(size for lastUse, size, entry in entries)
+    limit = args.cacheSize*1024*1024
+    for lastUse, size, entry in sorted(entries):
+        if total <= limit:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+def writeCachedArray(designName, outputName):
+    """ Write out the array as writeArray, copying it from the cache if it was generated before
+
+    --check, --verify and the exports always generate the array, since
+    they come from the generation, but the array is still cached.
+
+    """
+    key = cacheKey(designName)
+    if not (args.check or args.verify or args.pnp != None or args.bom != None
+            or args.netlist != None):
+        with profiling('phases', 'cache lookup'):
+            if fetchCachedArray(key, outputName):
+                profileCount('cache hits')
+                return
+
+    generateArray(designName, outputName)
+    with profiling('phases', 'cache store'):
+        storeCachedArray(key, outputName)
+
+
+##################################################################################
+######## Library API
+##################################################################################
+
+# The phases above can also be driven from another script, to generate many
+# variants of a design without parsing it again for each one:
+#
+#   import make_array
+#   generator = make_array.ArrayGenerator('led_example')
+#   generator.generateAll([(4, 4, (10, -10), False), (8, 8, (12, -12), True)])
+#
+# Each configuration is written to its own pair of files, named after it (see
+# configurationName).
+
+# Options that are used while loading a design, and so can't change between configurations
+# (the board copy region can, since it's looked up in the board's spatial index)
+DESIGN_OPTIONS = ['lazy', 'xmlBackend']
+
+# The generator whose design is currently loaded
+loadedGenerator = None
+
+def loadDesign(designName, schematic=True, board=True):
+    """ Parse, inspect and compile designName.sch and designName.brd, using the current options
+
+    If schematic or board is cleared, that document is kept from the last
+    load of the same design instead of being parsed again.
+
+    """
+    setXmlBackend(args.xmlBackend)
+    if schematic:
+        with profiling('phases', 'schematic inspection'):
+            loadSchematic(designFile(designName, ".sch"))
+    if board:
+        with profiling('phases', 'board inspection'):
+            loadBoard(designFile(designName, ".brd"))
+    with profiling('phases', 'template compilation'):
+        compileTemplates()
+
+def setOptions(options, values):
+    """ Set options by name, as given on the command line (rows, cols, spacingX, zigzag, jobs, etc) """
+    for name, value in values.items():
+        if not hasattr(options, name):
+            raise TypeError("Unknown option '%s'"%(name))
+        setattr(options, name, value)
+
+def configurationName(designName, options):
+    """ Name the output files for a configuration, eg: led_example_array_8x8_10x-10_zigzag """
+    name = "%s_array_%ix%i_%gx%g"%(designName, options.rows, options.cols,
+        options.spacingX, options.spacingY)
+    if options.zigzag:
+        name += "_zigzag"
+    if options.placements != None:
+        name += "_" + os.path.splitext(os.path.basename(options.placements))[0]
+    elif options.layout != 'grid':
+        name += "_" + options.layout
+    if options.chainOrder != 'layout':
+        name += "_" + options.chainOrder
+    region = [getattr(options, option) for option in ['boardCopyXMin', 'boardCopyYMin',
+        'boardCopyXMax', 'boardCopyYMax']]
+    if region != [parser.get_default(option) for option in ['boardCopyXMin', 'boardCopyYMin',
+            'boardCopyXMax', 'boardCopyYMax']]:
+        name += "_copy%gx%g_%gx%g"%tuple(region)
+    return name
+
+class ArrayGenerator(object):
+    """ Generate arrays of a design, parsing and compiling its templates only once
+
+    The design is loaded into the module's globals, so only one design can be
+    loaded at a time; using a generator after another one has been used
+    loads its design again. The arrays are always streamed (see Streaming
+    output), which leaves the loaded design untouched for the next
+    configuration.
+
+    """
+
+    def __init__(self, designName, **options):
+        """ Load a design, with any of the command line options given by name """
+        self.designName = designName
+        self.options = parser.parse_args([designName])
+        setOptions(self.options, options)
+        self.load()
+
+    def load(self, schematic=True, board=True):
+        """ Load this generator's design into the module
+
+        If this generator's design is already loaded, only the schematic or
+        board can be loaded again (after it has changed, say).
+
+        """
+        global args, loadedGenerator
+
+        if loadedGenerator is not self:
+            schematic = board = True
+
+        args = self.options
+        loadedGenerator = None
+        loadDesign(self.designName, schematic, board)
+        loadedGenerator = self
+
+    def generate(self, rows, cols, spacing=None, zigzag=False, outputName=None, **options):
+        """ Write out the arrayed board and schematic for one configuration
+
+        spacing is the board (x, y) spacing, which defaults to the generator's.
+        Any other options are given by name. Returns the output name, without
+        the .brd or .sch extension.
+
+        """
+        configuration = copy.copy(self.options)
+        configuration.rows = rows
+        configuration.cols = cols
+        configuration.zigzag = zigzag
+        if spacing != None:
+            configuration.spacingX, configuration.spacingY = spacing
+        setOptions(configuration, options)
+
+        return self.generateFromOptions(configuration, outputName)
+
+    def generateAll(self, configurations):
+        """ Write out each (rows, cols, spacing, zigzag) configuration, and return the output names """
+        return [self.generate(rows, cols, spacing, zigzag)
+            for rows, cols, spacing, zigzag in configurations]
+
+    def generateFromOptions(self, options, outputName=None):
+        """ Write out the configuration given by a full set of options """
+        global args
+
+        for name in DESIGN_OPTIONS:
+            if getattr(options, name) != getattr(self.options, name):
+                raise ValueError("Option '%s' can't change once the design is loaded"%(name))
+
+        if loadedGenerator is not self:
+            self.load()
+        if outputName == None:
+            outputName = configurationName(self.designName, options)
+
+        args = copy.copy(options)
+        args.stream = True
+        configureArray()
+        try:
+            writeArray(outputName)
+        finally:
+            removeSchematicPages(schematicPages)
+
+        return outputName
+
+
+##################################################################################
+######## Watch mode
+##################################################################################
+
+# In watch mode (--watch), the design is loaded once, and the array is regenerated
+# each time the schematic or board is saved. Only the document that changed is
+# parsed again; the other is kept in memory, along with the interpreter and the
+# parsed options. Files are polled, since there's no portable way to be notified
+# of changes, and a change is only acted on once the file has stopped changing,
+# so that a half-written save isn't read.
+
+# Seconds between polls of the design files
+WATCH_INTERVAL = 0.2
+
+def designFileStates(designName, placements=None):
+    """ Get the (modification time, size) of designName.sch, designName.brd and any placements file, or None for a missing file """
+    filenames = [designFile(designName, ".sch"), designFile(designName, ".brd")]
+    if placements != None:
+        filenames.append(placements)
+    states = []
+    for filename in filenames:
+        try:
+            status = os.stat(filename)
+            states.append((status.st_mtime, status.st_size))
+        except OSError:
+            states.append(None)
+    return tuple(states)
+
+def watchDesign(options, outputName):
+    """ Generate the array, then regenerate it whenever the design changes, until interrupted
+
+    Failures to load or generate (eg: while the design is being edited) are
+    reported, and the next change is waited for.
+
+    """
+    designName = options.filepath
+    states = designFileStates(designName, options.placements)
+    generator = ArrayGenerator(designName, **dict((name, getattr(options, name))
+        for name in DESIGN_OPTIONS))
+    generator.generateFromOptions(options, outputName)
+    print("Wrote %s; watching %s.sch and %s.brd for changes"%(outputName, designName, designName))
+
+    pending = states
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        current = designFileStates(designName, options.placements)
+        if current == states or None in current:
+            continue
+        # Wait for the files to stop changing before reading them
+        if current != pending:
+            pending = current
+            continue
+
+        changed = [document for document, old, new in zip(['schematic', 'board', 'placements'],
+            states, current) if old != new]
+        states = current
+        start = timer()
+        try:
+            generator.load(schematic='schematic' in changed, board='board' in changed)
+            generator.generateFromOptions(options, outputName)
+        except (Exception, SystemExit) as error:
+            print("Couldn't regenerate %s after the %s changed: %s"%(outputName,
+                ' and '.join(changed), error))
+            continue
+
+        print("Regenerated %s after the %s changed, in %.2fs"%(outputName, ' and '.join(changed),
+            timer() - start))
+
+
+##################################################################################
+######## Command line
+##################################################################################
+
+# The option that chooses each mode, by its destination
+MODE_FLAGS = collections.OrderedDict([('script', '--script'), ('resize', '-resize'),
+    ('batch', '-batch'), ('watch', '--watch'), ('verifyOutput', '-verifyOutput'), ('dryRun', '--dry-run')])
+
+# Options that some modes would ignore: (destination, option, the modes it can't be used with)
+MODE_RESTRICTIONS = [
+    ('cache', '-cache', list(MODE_FLAGS)),
+    ('maxMemory', '-maxMemory', list(MODE_FLAGS)),
+    ('maxTime', '-maxTime', list(MODE_FLAGS)),
+    ('check', '--check', ['script', 'verifyOutput', 'dryRun']),
+    ('verify', '--verify', ['script', 'verifyOutput', 'dryRun']),
+    ('pnp', '-pnp', ['script', 'resize', 'verifyOutput', 'dryRun']),
+    ('bom', '-bom', ['script', 'resize', 'verifyOutput', 'dryRun']),
+    ('netlist', '-netlist', ['script', 'resize', 'verifyOutput', 'dryRun']),
+]
+
+def checkModeOptions(commandLine):
+    """ Refuse (through the parser) options that the chosen mode would silently ignore """
+    given = lambda name: getattr(commandLine, name) not in (None, False)
+    # The parser only sees one line of a batch at a time
+    chosen = [name for name in MODE_FLAGS if given(name)]
+    if len(chosen) > 1:
+        parser.error("%s can't be used with %s"%(MODE_FLAGS[chosen[1]], MODE_FLAGS[chosen[0]]))
+    mode = (chosen + [None])[0]
+    for name, flag, excluded in MODE_RESTRICTIONS:
+        if given(name) and mode in excluded:
+            parser.error("%s can't be used with %s"%(flag, MODE_FLAGS[mode]))
+    if given('calibration') and not (commandLine.dryRun or given('maxMemory') or given('maxTime')):
+        parser.error("-calibration only applies to --dry-run, -maxMemory and -maxTime")
+
+def main():
+    """ Array the design given on the command line """
+    global args
+
+    args = parser.parse_args()
+    commandLine = args
+    checkModeOptions(commandLine)
+
+    if commandLine.profile or commandLine.profileFile != None:
+        startProfile()
+
+    # In batch mode, each line's options are applied on top of the command line's
+    if commandLine.batch != None:
+        generator = ArrayGenerator(commandLine.filepath, **dict((name, getattr(commandLine, name))
+            for name in DESIGN_OPTIONS))
+        with open(commandLine.batch) as batchFile:
+            for line in batchFile:
+                if line.strip() == '' or line.strip().startswith('#'):
+                    continue
+                options = parser.parse_args([commandLine.filepath] + line.split(),
+                    namespace=copy.copy(commandLine))
+                checkModeOptions(options)
+                print(generator.generateFromOptions(options))
+    elif commandLine.watch:
+        try:
+            watchDesign(commandLine, commandLine.filepath + "_array")
+        except KeyboardInterrupt:
+            pass
+    elif commandLine.verifyOutput != None:
+        loadDesign(commandLine.filepath)
+        configureArray()
+        verifyArray(commandLine.verifyOutput)
+    elif commandLine.resize != None:
+        previousName, oldRows, oldCols = commandLine.resize
+        loadDesign(commandLine.filepath)
+        resizeArray(previousName, int(oldRows), int(oldCols), commandLine.filepath + "_array")
+    elif commandLine.dryRun:
+        start = timer()
+        loadDesign(commandLine.filepath)
+        configureArray()
+        prediction, estimates = estimateLoadedArray(timer() - start)
+        print(formatEstimate(countTemplates(), prediction, estimates))
+    elif commandLine.script:
+        loadDesign(commandLine.filepath)
+        configureArray()
+        writeScript(commandLine.filepath + "_array.scr")
+    elif commandLine.cache != None:
+        writeCachedArray(commandLine.filepath, commandLine.filepath + "_array")
+    else:
+        generateArray(commandLine.filepath, commandLine.filepath + "_array")
+
+    if profile != None:
+        report = stopProfile()
+        if commandLine.profile:
+            print(formatProfile(report))
+        if commandLine.profileFile != None:
+            with open(commandLine.profileFile, 'w') as profileFile:
+                json.dump(report, profileFile, indent=2)
+
+if __name__ == '__main__':
+    main()
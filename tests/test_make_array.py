@@ -0,0 +1,757 @@
+# Tests for make_array.py. Each test arrays one of the example designs in a
+# temporary directory, by running the script as it is run from the command line,
+# and checks the output files.
+#
+# Run with: python -m pytest tests
+
+
+import xml.etree.ElementTree as ET
+import collections
+import csv
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(os.path.dirname(HERE), 'make_array.py')
+
+# Seconds to wait for a watching script to (re)generate the array
+WATCH_TIMEOUT = 60
+
+
+def copyDesign(directory, design):
+    """ Copy an example design into a directory, and return its name there """
+    for extension in [".sch", ".brd"]:
+        shutil.copy(os.path.join(os.path.dirname(SCRIPT), design + extension), str(directory))
+    return os.path.join(str(directory), design)
+
+def runScript(directory, *options):
+    """ Run make_array.py in a directory with some options, and return its output """
+    command = [sys.executable, SCRIPT] + [str(option) for option in options]
+    return subprocess.check_output(command, cwd=str(directory), stderr=subprocess.STDOUT).decode('utf-8')
+
+def arrayDesign(directory, design, *options):
+    """ Array an example design in a directory, and return the parsed (schematic, board) """
+    copyDesign(directory, design)
+    runScript(directory, design, *options)
+    return readArray(os.path.join(str(directory), design + "_array"))
+
+def readArray(outputName):
+    """ Parse an arrayed schematic and board """
+    return ET.parse(outputName + ".sch").getroot(), ET.parse(outputName + ".brd").getroot()
+
+def elementKey(element):
+    """ Describe an element and its children in order, ignoring whitespace, to compare designs """
+    return (element.tag, sorted(element.attrib.items()), (element.text or '').strip(),
+        [elementKey(child) for child in element])
+
+def unorderedKey(element):
+    """ Describe an element and its children in any order, ignoring whitespace, to compare designs """
+    return (element.tag, sorted(element.attrib.items()), (element.text or '').strip(),
+        sorted(unorderedKey(child) for child in element))
+
+def assertSameArray(first, second):
+    """ Check that two parsed (schematic, board) pairs hold the same elements, in the same order """
+    for a, b in zip(first, second):
+        assert elementKey(a) == elementKey(b)
+
+
+##################################################################################
+######## Template copies
+##################################################################################
+
+def test_shared_nets_get_one_copy_per_position(tmp_path):
+    """ Each position joins the non-array nets and signals (GND, 5V) exactly once """
+    rows, cols = 32, 32
+    schematic, board = arrayDesign(tmp_path, 'ws2812_example', '-r', rows, '-c', cols)
+
+    for signal in board.iter('signal'):
+        if signal.get('name') not in ('GND', '5V'):
+            continue
+        pads = collections.Counter((contactref.get('element'), contactref.get('pad'))
+            for contactref in signal.iter('contactref'))
+        template = [('U1_', 'VDD'), ('C1_', '2')] if signal.get('name') == 'GND' else [('C1_', '1'), ('U1_', 'VSS')]
+        for position in range(1, rows*cols + 1):
+            for element, pad in template:
+                assert pads.pop((element + "%i"%(position), pad)) == 1
+        # Only the connections that weren't arrayed are left
+        assert all(count == 1 and not element.endswith('_') for (element, pad), count in pads.items())
+
+    for net in schematic.iter('net'):
+        if net.get('name') not in ('GND', '5V'):
+            continue
+        pins = collections.Counter((pinref.get('part'), pinref.get('pin'))
+            for pinref in net.iter('pinref'))
+        for position in range(1, rows*cols + 1):
+            assert pins[('U1_%i'%(position), 'VDD' if net.get('name') == 'GND' else 'VSS')] == 1
+            assert pins[('C1_%i'%(position), '2' if net.get('name') == 'GND' else '1')] == 1
+        assert not any(part.endswith('_') for part, pin in pins)
+
+
+##################################################################################
+######## Copy region
+##################################################################################
+
+def test_batch_configurations_can_change_the_copy_region(tmp_path):
+    """ Each configuration in a batch copies the wires and vias in its own copy region """
+    copyDesign(tmp_path, 'ws2812_example')
+    (tmp_path / 'batch.txt').write_text(u'-r 2 -c 3\n-r 2 -c 3 -boardCopyYMin 2\n')
+    names = runScript(tmp_path, 'ws2812_example', '-batch', 'batch.txt').split()
+    assert names == ['ws2812_example_array_2x3_10x-10', 'ws2812_example_array_2x3_10x-10_copy-10x2_10x10']
+
+    for name, region in zip(names, [[], ['-boardCopyYMin', 2]]):
+        (tmp_path / 'fresh').mkdir()
+        fresh = arrayDesign(tmp_path / 'fresh', 'ws2812_example', '-r', 2, '-c', 3, *region)
+        assertSameArray(readArray(str(tmp_path / name)), fresh)
+        shutil.rmtree(str(tmp_path / 'fresh'))
+
+    # The smaller region leaves out the wire that starts below it
+    wires = [len(readArray(str(tmp_path / name))[1].findall(".//signal[@name='5V']/wire")) for name in names]
+    assert wires[0] > wires[1]
+
+
+##################################################################################
+######## Row and column buses
+##################################################################################
+
+def test_row_and_column_buses_connect_whole_rows_and_columns(tmp_path):
+    """ Each nROWr net and signal joins the anodes of row r, and each nCOLc the cathodes of column c """
+    rows, cols = 5, 6
+    arrays = {}
+    for mode in [[], ['-z'], ['--stream'], ['--stream', '-z']]:
+        directory = tmp_path / ('led_example' + ''.join(mode))
+        directory.mkdir()
+        schematic, board = arrayDesign(directory, 'led_example', '-r', rows, '-c', cols, *mode)
+        for document, netTag, pinTag, partKey, pinKey in [(schematic, 'net', 'pinref', 'part', 'pin'),
+                (board, 'signal', 'contactref', 'element', 'pad')]:
+            buses = {}
+            for net in document.iter(netTag):
+                if 'ROW' in net.get('name') or 'COL' in net.get('name'):
+                    assert net.get('name') not in buses
+                    buses[net.get('name')] = set((pin.get(partKey), pin.get(pinKey)) for pin in net.iter(pinTag))
+
+            expected = {}
+            for position in range(1, rows*cols + 1):
+                expected.setdefault("1ROW%i"%((position - 1)//cols), set()).add(("LED1_%i"%(position), 'A'))
+                expected.setdefault("1COL%i"%((position - 1)%cols), set()).add(("LED1_%i"%(position), 'C'))
+            assert buses == expected
+        arrays[tuple(mode)] = schematic, board
+
+    # The streamed buses match the ones built in the tree
+    assertSameArray(arrays[()], arrays[('--stream',)])
+    assertSameArray(arrays[('-z',)], arrays[('--stream', '-z')])
+
+
+##################################################################################
+######## Placement
+##################################################################################
+
+def elementPlacements(board):
+    """ The (x, y, rot) of each arrayed LED1_ element on a board, in position order """
+    elements = dict((element.get('name'), element) for element in board.iter('element'))
+    return [(float(elements[name].get('x')), float(elements[name].get('y')), elements[name].get('rot'))
+        for name in sorted((name for name in elements if name.startswith('LED1_')), key=lambda name: int(name[5:]))]
+
+def test_placements_file_positions_the_elements(tmp_path):
+    """ Each position's element is placed (and rotated) as its line of the placements file says """
+    copyDesign(tmp_path, 'led_example')
+    (tmp_path / 'placements.csv').write_text(u'x,y,rotation\n0,0\n12.5,-4\n# skipped\n\n30,2,90\n-8,20,180\n')
+    runScript(tmp_path, 'led_example', '-r', 2, '-c', 2, '-placements', 'placements.csv')
+    board = readArray(str(tmp_path / "led_example_array"))[1]
+    # The template, LED1_, is at the origin, turned by 45 degrees
+    assert elementPlacements(board) == [(0.0, 0.0, 'R45'), (12.5, -4.0, 'R45'), (30.0, 2.0, 'R135'),
+        (-8.0, 20.0, 'R225')]
+
+    for rows, cols, count in [(1, 3, 'more'), (2, 3, '4')]:
+        try:
+            runScript(tmp_path, 'led_example', '-r', rows, '-c', cols, '-placements', 'placements.csv')
+        except subprocess.CalledProcessError as error:
+            assert ("placements.csv has %s placements, but the array has %i positions"%(count, rows*cols)
+                ).encode('ascii') in error.output
+        else:
+            assert False, "%i positions were placed from 4 placements"%(rows*cols)
+
+def test_hex_layout_moves_every_other_row_along(tmp_path):
+    """ The hex layout is the grid, with the odd rows moved along by half a column """
+    placements = elementPlacements(arrayDesign(tmp_path, 'led_example', '-r', 3, '-c', 2, '-layout', 'hex',
+        '-spacingX', 10, '-spacingY', 8)[1])
+    assert placements == [(0.0, 0.0, 'R45'), (10.0, 0.0, 'R45'), (5.0, 8.0, 'R45'), (15.0, 8.0, 'R45'),
+        (0.0, 16.0, 'R45'), (10.0, 16.0, 'R45')]
+
+
+def test_chain_orders_are_refused_with_row_and_column_buses(tmp_path):
+    """ Renumbering the positions along a chain order would break up the rows and columns """
+    copyDesign(tmp_path, 'led_example')
+    try:
+        runScript(tmp_path, 'led_example', '-r', 3, '-c', 3, '-chainOrder', 'nearest')
+    except subprocess.CalledProcessError as error:
+        assert b"can't be used with row or column nets" in error.output
+    else:
+        assert False, "a chain order renumbered an array with row and column buses"
+    assert not os.path.exists(str(tmp_path / "led_example_array.brd"))
+
+    copyDesign(tmp_path, 'ws2812_example')
+    assert "Verified" in runScript(tmp_path, 'ws2812_example', '-r', 3, '-c', 3, '-chainOrder', 'nearest', '--verify')
+
+def test_nearest_neighbour_order_is_as_quick_for_clusters(tmp_path):
+    """ Chaining placements in two small clusters far apart takes about as long as chaining evenly spread ones """
+    copyDesign(tmp_path, 'ws2812_example')
+    generator = random.Random(1)
+    seconds = {}
+    for name, offset, size in [('even', 0, 100), ('clusters', 1000, 1)]:
+        with open(str(tmp_path / (name + '.csv')), 'w') as placements:
+            for index in range(20000):
+                placements.write("%g,%g\n"%(generator.random()*size + offset*(index%2), generator.random()*size))
+        start = time.time()
+        # A dry run places the positions (and orders the chain) without writing the array
+        runScript(tmp_path, 'ws2812_example', '-r', 100, '-c', 200, '-placements', name + '.csv',
+            '-chainOrder', 'nearest', '--dry-run')
+        seconds[name] = time.time() - start
+    assert seconds['clusters'] < 2*seconds['even'] + 2, seconds
+
+
+##################################################################################
+######## Schematic sheets
+##################################################################################
+
+# Parts that are moved to the second sheet of the two sheet design
+SECOND_SHEET_PARTS = set(['JP1', 'JP2', 'JP3', 'SUPPLY_1', 'GND_1', 'GND_2', 'GND_3'])
+
+def twoSheetDesign(directory):
+    """ Split ws2812_example across two sheets, with the connectors and the 1OUT_ net on the second
+
+    The chain's input (1IN_) is left on the first sheet and its output on the
+    second, so the two have to be paired across sheets. The design is only
+    read by make_array.py, so the 1OUT_ pinref can name a gate on the other sheet.
+
+    """
+    name = copyDesign(directory, 'ws2812_example')
+    schematic = ET.parse(name + ".sch")
+    sheets = schematic.getroot().find('.//sheets')
+    first = sheets[0]
+    second = ET.SubElement(sheets, 'sheet')
+    for tag in ['plain', 'instances', 'busses', 'nets']:
+        ET.SubElement(second, tag)
+
+    for instance in list(first.find('instances')):
+        if instance.get('part') in SECOND_SHEET_PARTS:
+            first.find('instances').remove(instance)
+            second.find('instances').append(instance)
+    for net in list(first.find('nets')):
+        segments = [segment for segment in net.findall('segment') if net.get('name') == '1OUT_'
+            or all(pinref.get('part') in SECOND_SHEET_PARTS for pinref in segment.iter('pinref'))]
+        if not segments:
+            continue
+        secondNet = ET.SubElement(second.find('nets'), 'net', net.attrib)
+        for segment in segments:
+            net.remove(segment)
+            secondNet.append(segment)
+        if len(net) == 0:
+            first.find('nets').remove(net)
+
+    schematic.write(name + ".sch", encoding='utf-8', xml_declaration=True)
+    return name
+
+def test_sheets_are_arrayed_alike_in_every_mode(tmp_path):
+    """ A two sheet design, and one split across new sheets, verify, and serial, streamed and parallel runs agree """
+    rows, cols = 3, 4
+    for sheetOptions in [[], ['-sheetPositions', 5]]:
+        outputs = []
+        for mode in [[], ['--stream'], ['-j', 4]]:
+            directory = tmp_path / ('sheets' + ''.join(str(option) for option in sheetOptions + mode))
+            directory.mkdir()
+            twoSheetDesign(directory)
+            output = runScript(directory, 'ws2812_example', '-r', rows, '-c', cols, '--verify', '--check',
+                *(sheetOptions + mode))
+            assert "Verified ws2812_example_array" in output
+            outputs.append([open(str(directory / ("ws2812_example_array" + extension)), 'rb').read()
+                for extension in [".sch", ".brd"]])
+        assert all(output == outputs[0] for output in outputs[1:]), sheetOptions
+
+        sheets = ET.fromstring(outputs[0][0]).find('.//sheets')
+        sheetNets = [dict((net.get('name'), net) for net in sheet.iter('net')) for sheet in sheets]
+        # Each nMID_x net joins the output of x, on one sheet, to the input of x+1, on another
+        for position in range(1, rows*cols):
+            name = "1MID_%i"%(position)
+            sides = [sorted((pinref.get('part'), pinref.get('pin')) for pinref in nets[name].iter('pinref'))
+                for nets in sheetNets if name in nets]
+            assert sorted(sides) == sorted([[("U1_%i"%(position), 'DOUT')], [("U1_%i"%(position + 1), 'DIN')]])
+
+        if sheetOptions:
+            # Both sheets are split into 3 pages, and the pages of the first have their own GND and 5V
+            assert len(sheets) == 6
+            for nets in sheetNets[:3]:
+                assert 'GND' in nets and '5V' in nets
+        else:
+            assert len(sheets) == 2
+
+
+##################################################################################
+######## Parallel generation
+##################################################################################
+
+def test_parallel_generation_matches_a_single_process(tmp_path):
+    """ Splitting the positions into chunks for worker processes gives the same array """
+    for design, options in [('led_example', ['-r', 6, '-c', 5]), ('ws2812_example', ['-r', 5, '-c', 7, '-z'])]:
+        (tmp_path / 'single').mkdir()
+        (tmp_path / 'parallel').mkdir()
+        single = arrayDesign(tmp_path / 'single', design, *options)
+        parallel = arrayDesign(tmp_path / 'parallel', design, '-j', 4, '-chunkPositions', 4, *options)
+        assertSameArray(single, parallel)
+        shutil.rmtree(str(tmp_path / 'single'))
+        shutil.rmtree(str(tmp_path / 'parallel'))
+
+
+##################################################################################
+######## Template references
+##################################################################################
+
+# The attributes that name an arrayed (template) part or element, by tag
+TEMPLATE_REFERENCES = {
+    'part': 'name', 'instance': 'part', 'pinref': 'part',
+    'element': 'name', 'contactref': 'element',
+}
+
+def test_no_template_references_survive_in_any_output_mode(tmp_path):
+    """ The templates never reach the output, and streamed and tiled output match the tree output """
+    for design in ['led_example', 'ws2812_example']:
+        arrays = []
+        for mode in [[], ['--stream'], ['--tiled'], ['--lazy']]:
+            directory = tmp_path / (design + ''.join(mode))
+            directory.mkdir()
+            array = arrayDesign(directory, design, '-r', 5, '-c', 4, '-z', '--check', *mode)
+            for document in array:
+                for element in document.iter():
+                    key = TEMPLATE_REFERENCES.get(element.tag)
+                    assert key == None or not element.get(key).endswith('_')
+            arrays.append(array)
+
+        # Compared element by element, since lazy output keeps the input's formatting
+        # of the sections it passes through
+        for array in arrays[1:]:
+            assertSameArray(arrays[0], array)
+
+
+##################################################################################
+######## Lazy parsing
+##################################################################################
+
+def test_lazy_sections_split_between_reads_are_passed_through(tmp_path):
+    """ Reading the design a few bytes at a time, so tags are split between reads, gives the same lazy output """
+    for design in ['led_example', 'ws2812_example']:
+        arrays = []
+        for readSize in [1 << 16, 7]:
+            directory = tmp_path / ("%s_%i"%(design, readSize))
+            directory.mkdir()
+            copyDesign(directory, design)
+            command = ("import sys; sys.argv = %r; sys.path.insert(0, %r); import make_array; "
+                "make_array.LAZY_READ_SIZE = %i; make_array.main()")%(
+                [SCRIPT, design, '-r', '3', '-c', '4', '--lazy'], os.path.dirname(SCRIPT), readSize)
+            subprocess.check_output([sys.executable, '-c', command], cwd=str(directory), stderr=subprocess.STDOUT)
+            arrays.append([open(str(directory / (design + "_array" + extension)), 'rb').read()
+                for extension in [".sch", ".brd"]])
+        assert arrays[0] == arrays[1]
+
+
+##################################################################################
+######## XML backends
+##################################################################################
+
+def test_every_output_mode_writes_the_same_bytes_with_each_backend(tmp_path):
+    """ Streamed and tiled output are byte for byte the tree that the backend writes, down to the declaration and DOCTYPE """
+    backends = ['etree']
+    try:
+        import lxml
+        backends.append('lxml')
+    except ImportError:
+        pass
+
+    for backend in backends:
+        outputs = []
+        for mode in [[], ['--stream'], ['--tiled']]:
+            directory = tmp_path / (backend + ''.join(mode))
+            directory.mkdir()
+            copyDesign(directory, 'ws2812_example')
+            runScript(directory, 'ws2812_example', '-r', 4, '-c', 3, '-xmlBackend', backend, *mode)
+            outputs.append([open(str(directory / ("ws2812_example_array" + extension)), 'rb').read()
+                for extension in [".sch", ".brd"]])
+        assert all(output == outputs[0] for output in outputs[1:]), backend
+        if backend == 'lxml':
+            assert outputs[0][1].startswith(b"<?xml version='1.0' encoding='UTF-8'?>\n<!DOCTYPE eagle")
+
+
+##################################################################################
+######## Verifier
+##################################################################################
+
+def test_verifier_catches_a_dropped_chain_connection(tmp_path):
+    """ An output that verifies fails once a contactref is dropped from an nMID_x signal """
+    copyDesign(tmp_path, 'ws2812_example')
+    options = ['-r', 3, '-c', 4]
+    assert "Verified ws2812_example_array" in runScript(tmp_path, 'ws2812_example', '--verify', *options)
+    assert "Verified" in runScript(tmp_path, 'ws2812_example', '-verifyOutput', 'ws2812_example_array', *options)
+
+    boardName = str(tmp_path / "ws2812_example_array.brd")
+    board = ET.parse(boardName)
+    signal = board.find(".//signal[@name='1MID_5']")
+    signal.remove(signal.find('contactref'))
+    board.write(boardName, encoding='utf-8', xml_declaration=True)
+
+    try:
+        runScript(tmp_path, 'ws2812_example', '-verifyOutput', 'ws2812_example_array', *options)
+    except subprocess.CalledProcessError as error:
+        output = error.output.decode('utf-8')
+    else:
+        assert False, "the verifier passed a broken chain"
+    assert "failed verification" in output and "1MID_5" in output
+
+
+##################################################################################
+######## Watch mode
+##################################################################################
+
+def waitForLine(lines, start):
+    """ Wait for a line starting with start from a watching script's output, and return it """
+    deadline = time.time() + WATCH_TIMEOUT
+    while time.time() < deadline:
+        if lines and lines[-1] == None:
+            break
+        for line in list(lines):
+            if line != None and line.startswith(start):
+                lines.remove(line)
+                return line
+        time.sleep(0.05)
+    assert False, "the watching script didn't print %r; it printed %r"%(start, lines)
+
+def test_watch_regenerates_when_the_schematic_changes(tmp_path):
+    """ Saving the schematic while watching regenerates the array, which matches a fresh run """
+    options = ['-r', 3, '-c', 2]
+    copyDesign(tmp_path, 'ws2812_example')
+    process = subprocess.Popen([sys.executable, '-u', SCRIPT, 'ws2812_example', '--watch'] + [str(option) for option in options],
+        cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    lines = []
+    def read():
+        for line in iter(process.stdout.readline, b''):
+            lines.append(line.decode('utf-8'))
+        lines.append(None)
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        waitForLine(lines, "Wrote ws2812_example_array")
+
+        schematicName = str(tmp_path / "ws2812_example.sch")
+        with open(schematicName, 'rb') as schematic:
+            data = schematic.read()
+        with open(schematicName, 'wb') as schematic:
+            schematic.write(data.replace(b'<part name="C1_" library="adafruit"',
+                b'<part name="C1_" value="100nF" library="adafruit"'))
+        waitForLine(lines, "Regenerated ws2812_example_array after the schematic changed")
+        watched = readArray(str(tmp_path / "ws2812_example_array"))
+    finally:
+        process.kill()
+        process.wait()
+        reader.join()
+
+    values = [part.get('value') for part in watched[0].iter('part') if part.get('name').startswith('C1_')]
+    assert values == ['100nF']*6
+
+    (tmp_path / 'fresh').mkdir()
+    shutil.copy(schematicName, str(tmp_path / 'fresh'))
+    shutil.copy(str(tmp_path / "ws2812_example.brd"), str(tmp_path / 'fresh'))
+    runScript(tmp_path / 'fresh', 'ws2812_example', '--stream', *options)
+    assertSameArray(watched, readArray(str(tmp_path / 'fresh' / "ws2812_example_array")))
+
+
+##################################################################################
+######## Script output
+##################################################################################
+
+def partPlacements(schematic, board):
+    """ The (x, y, rot) of each schematic gate and board element, by (part, gate) and name """
+    placements = dict(((instance.get('part'), instance.get('gate')),
+        (float(instance.get('x')), float(instance.get('y')), instance.get('rot', 'R0')))
+        for instance in schematic.iter('instance'))
+    placements.update((element.get('name'),
+        (float(element.get('x')), float(element.get('y')), element.get('rot', 'R0')))
+        for element in board.iter('element'))
+    return placements
+
+def runCommands(script, placements):
+    """ Follow a script's NAME, ADD, MOVE and ROTATE commands, from the design's placements """
+    for line in script.splitlines():
+        words = line.rstrip(';').replace('(', '').replace(')', '').split()
+        if words[0] == 'NAME':
+            old, new = [word.strip("'") for word in words[1:]]
+            for key in list(placements):
+                if key == old:
+                    placements[new] = placements.pop(key)
+                elif isinstance(key, tuple) and key[0] == old:
+                    placements[(new, key[1])] = placements.pop(key)
+        elif words[0] == 'ADD':
+            # Adding a part to the schematic adds its element (if it has one) to the board, unplaced
+            part, gate = words[2].strip("'"), words[3].strip("'")
+            placements[(part, gate)] = (float(words[5]), float(words[6]), words[4])
+            placements.setdefault(part, (None, None, 'R0'))
+        elif words[0] == 'MOVE':
+            x, y, rot = placements[words[1].strip("'")]
+            placements[words[1].strip("'")] = (float(words[2]), float(words[3]), rot)
+        elif words[0] == 'ROTATE':
+            x, y, rot = placements[words[2].strip("'")]
+            placements[words[2].strip("'")] = (x, y, words[1].lstrip('='))
+    # Parts without a package (supply symbols) have no element to move
+    return dict((key, placement) for key, placement in placements.items() if placement[0] != None)
+
+def assertSamePlacements(expected, placements):
+    """ Check that every part of an array is where the script puts it """
+    assert set(expected) == set(placements)
+    for key in expected:
+        x, y, rot = placements[key]
+        assert (round(x, 3), round(y, 3), rot) == (round(expected[key][0], 3), round(expected[key][1], 3),
+            expected[key][2]), key
+
+def test_script_moves_every_part_to_its_place_in_the_array(tmp_path):
+    """ Running the script on the design places each part where the arrayed design has it """
+    design = readArray(copyDesign(tmp_path, 'ws2812_example'))
+    # The circle layout and nearest neighbour chain move the first position off
+    # the origin, which is only possible without a copy region
+    emptyRegion = ['-boardCopyXMin', 100, '-boardCopyXMax', 101]
+    for options, firstMoved in [([], False), (['-z'], False), (['-layout', 'hex', '-spacingX', 12], False),
+            (['-layout', 'circle'] + emptyRegion, True),
+            (['-layout', 'spiral', '-chainOrder', 'nearest'] + emptyRegion, True)]:
+        arguments = ['-r', 3, '-c', 4] + options
+        runScript(tmp_path, 'ws2812_example', '--script', *arguments)
+        script = open(str(tmp_path / "ws2812_example_array.scr")).read()
+        assert ("MOVE 'U1_1'" in script) == firstMoved
+        runScript(tmp_path, 'ws2812_example', *arguments)
+        assertSamePlacements(partPlacements(*readArray(str(tmp_path / "ws2812_example_array"))),
+            runCommands(script, partPlacements(*design)))
+
+    try:
+        runScript(tmp_path, 'ws2812_example', '--script', '-r', 3, '-c', 4, '-layout', 'circle')
+    except subprocess.CalledProcessError as error:
+        assert b"the copy region of the templates can't be moved" in error.output
+    else:
+        assert False, "the templates' copy region was left behind at the origin"
+
+
+##################################################################################
+######## Exports
+##################################################################################
+
+def readExport(filename):
+    """ Read the rows of a CSV or JSON export, as dicts """
+    with open(filename) as exported:
+        if filename.endswith('.json'):
+            return json.load(exported)
+        return list(csv.DictReader(exported))
+
+def test_exports_describe_the_arrayed_board(tmp_path):
+    """ The pick and place rows, bill of materials and netlist match the board, in the tree and tiled modes """
+    for design, options in [('ws2812_example', ['-z']), ('led_example', [])]:
+        for mode, extension in [([], '.csv'), (['--tiled'], '.json')]:
+            directory = tmp_path / (design + ''.join(mode))
+            directory.mkdir()
+            exports = dict((name, str(directory / (name + extension))) for name in ['pnp', 'bom', 'netlist'])
+            board = arrayDesign(directory, design, '-r', 3, '-c', 4, '-pnp', exports['pnp'],
+                '-bom', exports['bom'], '-netlist', exports['netlist'], *(options + mode))[1]
+            elements = dict((element.get('name'), element) for element in board.iter('element'))
+
+            placements = {}
+            for row in readExport(exports['pnp']):
+                element = elements[row['name']]
+                rotation = element.get('rot', 'R0')
+                assert (row['value'], row['package']) == (element.get('value', ''), element.get('package'))
+                assert row['side'] == ('bottom' if 'M' in rotation else 'top')
+                placements[row['name']] = (float(row['x']), float(row['y']), float(row['rotation']))
+            assert placements == dict((name, (float(element.get('x')), float(element.get('y')),
+                float(element.get('rot', 'R0').lstrip('MSR')))) for name, element in elements.items())
+
+            listed = []
+            for row in readExport(exports['bom']):
+                names = row['names'].split()
+                assert int(row['quantity']) == len(names)
+                for name in names:
+                    assert (row['value'], row['package'], row['library']) == (elements[name].get('value', ''),
+                        elements[name].get('package'), elements[name].get('library'))
+                listed += names
+            assert sorted(listed) == sorted(elements)
+
+            netlist = collections.Counter((row['signal'], row['element'], row['pad'])
+                for row in readExport(exports['netlist']))
+            assert netlist == collections.Counter((signal.get('name'), contactref.get('element'),
+                contactref.get('pad')) for signal in board.iter('signal') for contactref in signal.iter('contactref'))
+
+
+##################################################################################
+######## Profile
+##################################################################################
+
+def test_profile_times_the_creation_in_every_output_mode(tmp_path):
+    """ The functions table lists the creation functions, or the streaming generators that replace them """
+    copyDesign(tmp_path, 'ws2812_example')
+    (tmp_path / 'batch.txt').write_text(u'-r 3 -c 3\n')
+    for options, functions in [([], 'createBoardElements'), (['--stream'], 'streamBoardNewSignals'),
+            (['--tiled'], 'streamSchematicNewNets'), (['-batch', 'batch.txt'], 'streamBoardSignalItems')]:
+        runScript(tmp_path, 'ws2812_example', '-r', 4, '-c', 4, '-profileFile', 'profile.json', *options)
+        with open(str(tmp_path / 'profile.json')) as profileFile:
+            report = json.load(profileFile)
+        assert report['functions'][functions]['calls'] > 0, options
+        assert all(entry['time'] >= 0 for entry in report['functions'].values())
+
+    output = runScript(tmp_path, 'ws2812_example', '-r', 4, '-c', 4, '--profile', '--stream')
+    assert "the streaming generators are listed in place of" in output
+
+
+##################################################################################
+######## Resize
+##################################################################################
+
+# (design, old rows and columns, new rows and columns, options) to resize
+RESIZES = [
+    ('led_example', (3, 4), (5, 4), []),
+    ('led_example', (5, 4), (3, 4), []),
+    ('led_example', (3, 4), (3, 6), []),
+    ('led_example', (3, 6), (3, 4), []),
+    ('led_example', (3, 4), (5, 2), []),
+    ('ws2812_example', (3, 4), (2, 6), []),
+    ('ws2812_example', (2, 3), (4, 5), []),
+    ('ws2812_example', (4, 3), (2, 3), ['-z']),
+    ('ws2812_example', (2, 3), (5, 3), ['-z']),
+]
+
+def test_resizing_matches_generating_at_the_new_size(tmp_path):
+    """ Growing and shrinking the rows, columns or both gives the parts, nets and signals of a fresh array, which verify """
+    for number, (design, (oldRows, oldCols), (rows, cols), options) in enumerate(RESIZES):
+        directory = tmp_path / ("%s_%i"%(design, number))
+        directory.mkdir()
+        copyDesign(directory, design)
+        runScript(directory, design, '-r', rows, '-c', cols, *options)
+        fresh = readArray(str(directory / (design + "_array")))
+        runScript(directory, design, '-r', oldRows, '-c', oldCols, *options)
+        for extension in [".sch", ".brd"]:
+            os.rename(str(directory / (design + "_array" + extension)), str(directory / ("old" + extension)))
+
+        output = runScript(directory, design, '-r', rows, '-c', cols, '-resize', 'old', oldRows, oldCols,
+            '--verify', '--check', *options)
+        assert "Verified %s_array"%(design) in output
+        resized = readArray(str(directory / (design + "_array")))
+        for first, second in zip(fresh, resized):
+            assert unorderedKey(first) == unorderedKey(second), (design, oldRows, oldCols, rows, cols)
+
+def test_resizing_keeps_changes_made_by_hand(tmp_path):
+    """ A kept position's part keeps a value that was set in the earlier output """
+    copyDesign(tmp_path, 'ws2812_example')
+    runScript(tmp_path, 'ws2812_example', '-r', 2, '-c', 2)
+    schematic = ET.parse(str(tmp_path / "ws2812_example_array.sch"))
+    schematic.getroot().find(".//part[@name='C1_2']").set('value', '1uF')
+    schematic.write(str(tmp_path / "old.sch"), encoding='utf-8', xml_declaration=True)
+    os.rename(str(tmp_path / "ws2812_example_array.brd"), str(tmp_path / "old.brd"))
+
+    runScript(tmp_path, 'ws2812_example', '-r', 3, '-c', 3, '-resize', 'old', 2, 2)
+    parts = dict((part.get('name'), part) for part in readArray(str(tmp_path / "ws2812_example_array"))[0].iter('part'))
+    # Position 2 of the 2x2 array is position 2 of the 3x3 one too
+    assert parts['C1_2'].get('value') == '1uF'
+    assert parts['C1_9'].get('value') == None
+
+
+##################################################################################
+######## Cache
+##################################################################################
+
+def cacheHits(output):
+    """ Read the 'cache hits' count from a --profile run's output """
+    return [int(line.split()[-1]) for line in output.splitlines() if line.strip().startswith('cache hits')][0]
+
+def test_cache_reuses_an_array_until_the_design_or_options_change(tmp_path):
+    """ A repeated run copies the array from the cache, and a changed option or design generates it again """
+    copyDesign(tmp_path, 'led_example')
+    options = ['-r', 3, '-c', 4, '-cache', 'cache', '--profile']
+    outputName = str(tmp_path / "led_example_array")
+
+    assert cacheHits(runScript(tmp_path, 'led_example', *options)) == 0
+    first = readArray(outputName)
+    assert cacheHits(runScript(tmp_path, 'led_example', *options)) == 1
+    assertSameArray(first, readArray(outputName))
+
+    # Zig-zag numbering changes the array, so it isn't the cached one
+    assert cacheHits(runScript(tmp_path, 'led_example', '-z', *options)) == 0
+    (tmp_path / 'fresh').mkdir()
+    assertSameArray(readArray(outputName), arrayDesign(tmp_path / 'fresh', 'led_example', '-r', 3, '-c', 4, '-z'))
+
+    schematicName = str(tmp_path / "led_example.sch")
+    with open(schematicName, 'ab') as schematic:
+        schematic.write(b'\n')
+    assert cacheHits(runScript(tmp_path, 'led_example', *options)) == 0
+    assert len(os.listdir(str(tmp_path / 'cache'))) == 3
+
+
+##################################################################################
+######## Cost estimate
+##################################################################################
+
+def estimatedTimes(output):
+    """ Read the estimated seconds of each output mode from a --dry-run's output """
+    lines = output.splitlines()
+    start = [line.startswith('Estimates') for line in lines].index(True)
+    return dict((line.split()[0], float(line.split()[-2])) for line in lines[start + 1:] if line.strip())
+
+def test_dry_run_uses_the_calibration_of_the_backend(tmp_path):
+    """ --dry-run writes nothing, and -calibration only fits the results for the backend in use """
+    copyDesign(tmp_path, 'ws2812_example')
+    options = ['-r', 10, '-c', 10, '--dry-run', '-xmlBackend', 'etree']
+    builtIn = estimatedTimes(runScript(tmp_path, 'ws2812_example', *options))
+    assert set(builtIn) == set(['tree', 'tiled', 'stream'])
+    assert sorted(os.listdir(str(tmp_path))) == ['ws2812_example.brd', 'ws2812_example.sch']
+
+    # A benchmark report whose tree mode runs take 1000s after inspection
+    result = {'boardSize': 1 << 20, 'schematicSize': 1 << 20, 'inputSize': 0, 'wallTime': 1000.0,
+        'phases': {'inspection': 0.0}, 'peakMemoryKB': None}
+    for backend in ['lxml', 'etree']:
+        with open(str(tmp_path / (backend + ".json")), 'w') as reportFile:
+            json.dump({'mode': 'tree', 'results': [dict(result, backend=backend)]}, reportFile)
+
+    calibrated = estimatedTimes(runScript(tmp_path, 'ws2812_example', '-calibration', 'etree.json', *options))
+    assert calibrated['tree'] > 900 and calibrated['tiled'] == builtIn['tiled']
+    try:
+        runScript(tmp_path, 'ws2812_example', '-calibration', 'lxml.json', *options)
+    except subprocess.CalledProcessError as error:
+        assert b"no results for the etree XML backend" in error.output
+    else:
+        assert False, "results for another backend were used"
+
+
+##################################################################################
+######## Command line
+##################################################################################
+
+def test_options_a_mode_would_ignore_are_refused(tmp_path):
+    """ Combining options that can't apply together is an error, and writes nothing """
+    copyDesign(tmp_path, 'ws2812_example')
+    (tmp_path / 'batch.txt').write_text(u'-r 2 -c 2 --script\n')
+    for options in [['--script', '-maxTime', 5], ['--watch', '-batch', 'batch.txt', '--dry-run'],
+            ['-cache', 'cache', '--dry-run'], ['-calibration', 'results.json'], ['--script', '--check'],
+            ['-verifyOutput', 'ws2812_example_array', '-pnp', 'pnp.csv'], ['-batch', 'batch.txt']]:
+        process = subprocess.Popen([sys.executable, SCRIPT, 'ws2812_example', '-r', '2', '-c', '2']
+            + [str(option) for option in options], cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, error = process.communicate()
+        assert process.returncode == 2, options
+        assert any(reason in error for reason in [b"can't be used with", b"not allowed with", b"only applies to"])
+    assert sorted(os.listdir(str(tmp_path))) == ['batch.txt', 'ws2812_example.brd', 'ws2812_example.sch']
+
+def test_limits_apply_to_cached_runs(tmp_path):
+    """ -maxMemory plans a run that misses the cache, and a run that hits it just copies the array """
+    copyDesign(tmp_path, 'ws2812_example')
+    options = ['-r', 2, '-c', 2, '-cache', 'cache', '--profile']
+    try:
+        runScript(tmp_path, 'ws2812_example', '-maxMemory', 0.001, *options)
+    except subprocess.CalledProcessError as error:
+        assert b"over the limits" in error.output
+    else:
+        assert False, "an array over -maxMemory was generated"
+    assert cacheHits(runScript(tmp_path, 'ws2812_example', '-maxMemory', 1000, *options)) == 0
+    assert cacheHits(runScript(tmp_path, 'ws2812_example', '-maxMemory', 0.001, *options)) == 1